@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарки бота Оданна
+
+python benchmark.py model --dtypes float32 bfloat16 int8 --backends torch onnx
+python benchmark.py emotion
+python benchmark.py pipeline --users 20 --messages 10 --output pipeline.json
+python benchmark.py db --sizes 10000 100000 1000000 --output db.json
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import resource
+import sqlite3
+import sys
+import os
+import tempfile
+import time
+import json
+import uuid
+from collections import defaultdict
+from types import SimpleNamespace
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import odanna_bot
+from odanna_bot import (AIManager, DatabaseManager, EmotionAnalyzer, OdannaBot, ResponseCache,
+                        MODEL_NAME, DEVICE, EMOTION_LEXICON, ODANNA_SYSTEM_PROMPT)
+
+BENCHMARK_MESSAGE = "Оданна, расскажите о Небесной Гостинице"
+EMOTION_MESSAGES = [
+    "Привет",
+    "Как дела? Что нового в гостинице?",
+    "Мне очень грустно сегодня... Кажется, никто меня не понимает.",
+    "Спасибо вам огромное, я так рада, что всё получилось!",
+    "Меня ужасно бесит, что повар опять опоздал с ужином, сколько можно",
+    "Расскажите, пожалуйста, почему демоны и духи приходят именно в Небесную Гостиницу, "
+    "и что происходит с теми гостями, которые нарушают правила этого места?"
+]
+
+def _rss_mb() -> float:
+    """Пиковая резидентная память процесса, МБ"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _run_model_benchmark(config: dict) -> dict:
+    """Замер одной конфигурации модели (в отдельном процессе, чтобы память не смешивалась)"""
+    odanna_bot._import_ml()
+    torch = odanna_bot.torch
+    
+    rss_before = _rss_mb()
+    started = time.perf_counter()
+    ai = AIManager(model_name=config['model'], device=config['device'],
+                   dtype=config['dtype'], backend=config['backend'])
+    load_seconds = time.perf_counter() - started
+    if not ai.ready.is_set():
+        return dict(config, error="модель не загрузилась")
+    
+    tail, _ = ai._assemble_tail({
+        'user_message': BENCHMARK_MESSAGE, 'chat_history': [], 'empathy_level': 35,
+        'emotion': "нейтральное", 'scenario': "Небесная Гостиница"
+    })
+    
+    timings = []
+    for _ in range(config['warmup'] + config['runs']):
+        input_ids, attention_mask, past_key_values = ai._prepare_inputs([tail] * config['batch'])
+        started = time.perf_counter()
+        with torch.no_grad():
+            ai.model.generate(
+                input_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                min_new_tokens=config['new_tokens'],
+                max_new_tokens=config['new_tokens'],
+                do_sample=False,
+                pad_token_id=ai.tokenizer.pad_token_id,
+                eos_token_id=ai.tokenizer.eos_token_id
+            )
+        timings.append(time.perf_counter() - started)
+    timings = sorted(timings[config['warmup']:])
+    
+    generated = config['new_tokens'] * config['batch']
+    return dict(
+        config,
+        load_s=load_seconds,
+        tokens_per_s=generated / (sum(timings) / len(timings)),
+        p50_s=timings[len(timings) // 2],
+        rss_mb=_rss_mb() - rss_before
+    )
+
+def benchmark_model(args):
+    """Сравнение бэкендов и типов данных: токены в секунду и память"""
+    configs = [
+        {'model': args.model, 'device': args.device, 'backend': backend, 'dtype': dtype,
+         'new_tokens': args.new_tokens, 'batch': args.batch, 'runs': args.runs, 'warmup': args.warmup}
+        for backend in args.backends for dtype in args.dtypes
+    ]
+    
+    print(f"{'backend':<8} {'dtype':<9} {'загрузка, с':>11} {'токенов/с':>10} {'p50, с':>8} {'RSS, МБ':>8}")
+    context = multiprocessing.get_context('spawn')
+    for config in configs:
+        with context.Pool(1) as pool:
+            result = pool.apply(_run_model_benchmark, (config,))
+        if 'error' in result:
+            print(f"{result['backend']:<8} {result['dtype']:<9} {result['error']}")
+            continue
+        print(f"{result['backend']:<8} {result['dtype']:<9} {result['load_s']:>11.1f} "
+              f"{result['tokens_per_s']:>10.1f} {result['p50_s']:>8.2f} {result['rss_mb']:>8.0f}")
+
+def _legacy_analyze(text: str, lexicon: dict) -> list:
+    """Прежний алгоритм: отдельный поиск подстроки для каждого слова словаря"""
+    text_lower = text.lower()
+    return [emotion for emotion, words in lexicon.items() if any(word in text_lower for word in words)]
+
+def _expand_lexicon(lexicon: dict, factor: int) -> dict:
+    """Синтетически увеличенный словарь: к каждому слову добавляются уникальные окончания"""
+    return {
+        emotion: {f"{word.rstrip('*')}{suffix}{'*' if word.endswith('*') else ''}": weight
+                  for word, weight in entries.items() for suffix in [''] + [f"ъ{i}" for i in range(factor - 1)]}
+        for emotion, entries in lexicon.items()
+    }
+
+def benchmark_emotion(args):
+    """Анализ эмоций: прежний поиск подстрок против одного прохода по словам"""
+    with open(args.lexicon, encoding='utf-8') as f:
+        lexicon = json.load(f)
+    
+    print(f"{'словарь':<22} {'слов':>6} {'прежний, мкс':>13} {'новый, мкс':>11} {'ускорение':>10}")
+    for name, entries in [
+        ("встроенный", EmotionAnalyzer.BUILTIN_LEXICON),
+        ("emotion_lexicon.json", lexicon),
+        *[(f"x{factor}", _expand_lexicon(lexicon, factor)) for factor in args.scale]
+    ]:
+        legacy_lexicon = {emotion: [word.rstrip('*') for word in words] for emotion, words in entries.items()}
+        analyzer = EmotionAnalyzer(entries)
+        
+        timings = {}
+        for label, analyze in (('legacy', lambda text: _legacy_analyze(text, legacy_lexicon)),
+                               ('new', analyzer.labels)):
+            started = time.perf_counter()
+            for _ in range(args.iterations):
+                for text in EMOTION_MESSAGES:
+                    analyze(text)
+            timings[label] = (time.perf_counter() - started) / (args.iterations * len(EMOTION_MESSAGES)) * 1e6
+        
+        size = sum(len(words) for words in entries.values())
+        print(f"{name:<22} {size:>6} {timings['legacy']:>13.1f} {timings['new']:>11.1f} "
+              f"{timings['legacy'] / timings['new']:>9.1f}x")
+
+def _percentiles(samples: list) -> dict:
+    """p50/p95/p99 в миллисекундах"""
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    return {f"p{q}_ms": samples[min(len(samples) - 1, len(samples) * q // 100)] * 1000 for q in (50, 95, 99)}
+
+def _write_results(path: str, results: dict):
+    """Результаты в JSON для сравнения между запусками"""
+    if path:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Результаты записаны в {path}")
+
+def _build_stub_model(path: str):
+    """Крошечная случайная GPT-2 с обученным на промпте BPE: путь загрузки как у настоящей модели"""
+    from tokenizers import ByteLevelBPETokenizer
+    from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+    
+    bpe = ByteLevelBPETokenizer()
+    bpe.train_from_iterator([ODANNA_SYSTEM_PROMPT, *EMOTION_MESSAGES], vocab_size=2000,
+                            special_tokens=["<|endoftext|>"], show_progress=False)
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=bpe, eos_token="<|endoftext|>")
+    tokenizer.save_pretrained(path)
+    
+    config = GPT2Config(vocab_size=tokenizer.vocab_size, n_positions=1024, n_embd=64, n_layer=2, n_head=2,
+                        eos_token_id=tokenizer.eos_token_id, bos_token_id=tokenizer.eos_token_id)
+    GPT2LMHeadModel(config).save_pretrained(path)
+
+def _fake_update(user_id: int, text: str):
+    """Минимальный Update для handle_message: ответы никуда не отправляются"""
+    async def reply_text(*args, **kwargs):
+        return SimpleNamespace(edit_text=edit_text)
+    
+    async def edit_text(*args, **kwargs):
+        return None
+    
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id, username=f"user{user_id}", first_name="Гость", last_name=None),
+        message=SimpleNamespace(text=text, reply_text=reply_text)
+    )
+
+async def _drive_pipeline(bot: OdannaBot, args, stages: dict) -> float:
+    """Пользователи пишут параллельно, каждый — свои сообщения по порядку"""
+    async def user_session(user_id: int, messages: int):
+        for i in range(messages):
+            await bot.handle_message(_fake_update(user_id, EMOTION_MESSAGES[(user_id + i) % len(EMOTION_MESSAGES)]), None)
+    
+    # Прогрев отдельным пользователем: первые вызовы компилируют ядра и заполняют кэши сегментов
+    await user_session(0, args.warmup)
+    stages.clear()
+    
+    started = time.perf_counter()
+    await asyncio.gather(*(user_session(user_id, args.messages) for user_id in range(1, args.users + 1)))
+    return time.perf_counter() - started
+
+def benchmark_pipeline(args):
+    """Сквозная обработка сообщений: задержки по этапам и пропускная способность"""
+    if not args.stream:
+        odanna_bot.STREAM_RESPONSES = False
+    
+    with tempfile.TemporaryDirectory() as workdir:
+        model_name = args.model
+        if not model_name:
+            model_name = os.path.join(workdir, 'stub-model')
+            _build_stub_model(model_name)
+        ai = AIManager(model_name=model_name, device=args.device, dtype=args.dtype, backend=args.backend)
+        if not ai.ready.is_set():
+            print("Модель не загрузилась")
+            return
+        if args.no_cache:
+            ai.response_cache = ResponseCache(max_size=0)
+        
+        bot = OdannaBot("benchmark", db_path=os.path.join(workdir, 'benchmark.db'), ai=ai)
+        # Пользователи бенчмарка пишут чаще живых: лимит на пользователя не применяется
+        bot.admission.user_rate = 0
+        bot.debounce = args.debounce_ms / 1000
+        stages = defaultdict(list)
+        odanna_bot.STAGE_OBSERVERS.append(lambda name, seconds: stages[name].append(seconds))
+        try:
+            elapsed = asyncio.run(_drive_pipeline(bot, args, stages))
+        finally:
+            odanna_bot.STAGE_OBSERVERS.clear()
+            bot.inference.shutdown()
+            bot.storage.close()
+            bot.db.close()
+    
+    total = args.users * args.messages
+    results = {
+        'config': {key: value for key, value in vars(args).items() if key != 'handler'},
+        'messages': total,
+        'seconds': elapsed,
+        'messages_per_s': total / elapsed,
+        'stages': {name: dict(count=len(samples), **_percentiles(samples)) for name, samples in stages.items()}
+    }
+    
+    print(f"{total} сообщений за {elapsed:.2f} с: {results['messages_per_s']:.1f} сообщений/с")
+    print(f"{'этап':<14} {'вызовов':>8} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9}")
+    for name, row in sorted(results['stages'].items(), key=lambda item: -item[1]['p50_ms']):
+        print(f"{name:<14} {row['count']:>8} {row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} {row['p99_ms']:>9.2f}")
+    _write_results(args.output, results)
+
+def _populate_db(db: DatabaseManager, size: int, per_chat: int) -> list:
+    """Быстрое наполнение базы: одна транзакция executemany в обход DatabaseManager"""
+    chats = [(str(uuid.uuid4()), chat % 1000 + 1) for chat in range(max(1, size // per_chat))]
+    conn = sqlite3.connect(db.db_path)
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)',
+                         [(user_id, f"user{user_id}") for user_id in range(1, 1001)])
+        conn.executemany('INSERT INTO chats (chat_id, user_id, chat_name) VALUES (?, ?, ?)',
+                         [(chat_id, user_id, "Чат") for chat_id, user_id in chats])
+        conn.executemany(
+            'INSERT INTO messages (chat_id, user_id, message_text, response_text, emotion_analysis, empathy_level) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            ((chats[i % len(chats)][0], chats[i % len(chats)][1], EMOTION_MESSAGES[i % len(EMOTION_MESSAGES)],
+              "*кивает*", "нейтральное", 35) for i in range(size))
+        )
+    conn.close()
+    return chats
+
+def benchmark_db(args):
+    """Операции DatabaseManager при разном числе сохраненных сообщений"""
+    results = {'config': {key: value for key, value in vars(args).items() if key != 'handler'}, 'sizes': {}}
+    
+    print(f"{'сообщений':>10} {'операция':<22} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9}")
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as workdir:
+            db = DatabaseManager(os.path.join(workdir, 'benchmark.db'))
+            chats = _populate_db(db, size, args.per_chat)
+            
+            operations = {
+                'add_message': lambda chat_id, user_id: db.add_message(chat_id, user_id, "Привет", "*кивает*",
+                                                                        "нейтральное", 35),
+                'get_chat_history': lambda chat_id, user_id: db.get_chat_history(chat_id, 10),
+                'get_chat_state': lambda chat_id, user_id: db.get_chat_state(chat_id, 10),
+                'get_user_chats': lambda chat_id, user_id: db.get_user_chats(user_id),
+                'ignore_message': lambda chat_id, user_id: db.ignore_message(chat_id, "Привет"),
+            }
+            
+            results['sizes'][size] = {}
+            for name, operation in operations.items():
+                timings = []
+                for i in range(args.iterations):
+                    chat_id, user_id = chats[(i * 7919) % len(chats)]
+                    started = time.perf_counter()
+                    operation(chat_id, user_id)
+                    timings.append(time.perf_counter() - started)
+                row = _percentiles(timings)
+                results['sizes'][size][name] = row
+                print(f"{size:>10} {name:<22} {row['p50_ms']:>9.3f} {row['p95_ms']:>9.3f} {row['p99_ms']:>9.3f}")
+            db.close()
+    _write_results(args.output, results)
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки бота Оданна")
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    model = commands.add_parser('model', help="скорость генерации и память по бэкендам модели")
+    model.add_argument('--model', default=MODEL_NAME)
+    model.add_argument('--device', default=DEVICE)
+    model.add_argument('--backends', nargs='+', default=['torch'], choices=sorted(odanna_bot.MODEL_BACKENDS))
+    model.add_argument('--dtypes', nargs='+', default=['float32', 'bfloat16', 'int8'])
+    model.add_argument('--new-tokens', type=int, default=64)
+    model.add_argument('--batch', type=int, default=1)
+    model.add_argument('--runs', type=int, default=5)
+    model.add_argument('--warmup', type=int, default=1)
+    model.set_defaults(handler=benchmark_model)
+    
+    emotion = commands.add_parser('emotion', help="анализ эмоций: прежний алгоритм против нового")
+    emotion.add_argument('--lexicon', default=EMOTION_LEXICON)
+    emotion.add_argument('--iterations', type=int, default=2000)
+    emotion.add_argument('--scale', nargs='*', type=int, default=[10, 50])
+    emotion.set_defaults(handler=benchmark_emotion)
+    
+    pipeline = commands.add_parser('pipeline', help="сквозная обработка сообщений по этапам")
+    pipeline.add_argument('--model', default='', help="модель HF; по умолчанию крошечная случайная GPT-2")
+    pipeline.add_argument('--device', default='cpu')
+    pipeline.add_argument('--dtype', default='float32')
+    pipeline.add_argument('--backend', default='torch', choices=sorted(odanna_bot.MODEL_BACKENDS))
+    pipeline.add_argument('--users', type=int, default=20)
+    pipeline.add_argument('--messages', type=int, default=10)
+    pipeline.add_argument('--warmup', type=int, default=3)
+    pipeline.add_argument('--stream', action='store_true', help="потоковые ответы вместо батчинга")
+    pipeline.add_argument('--no-cache', action='store_true', help="без кэша ответов")
+    pipeline.add_argument('--debounce-ms', type=float, default=0, help="окно объединения сообщений")
+    pipeline.add_argument('--output', default='')
+    pipeline.set_defaults(handler=benchmark_pipeline)
+    
+    db = commands.add_parser('db', help="операции с базой при разном объеме истории")
+    db.add_argument('--sizes', nargs='+', type=int, default=[10_000, 100_000, 1_000_000])
+    db.add_argument('--per-chat', type=int, default=100)
+    db.add_argument('--iterations', type=int, default=1000)
+    db.add_argument('--output', default='')
+    db.set_defaults(handler=benchmark_db)
+    
+    args = parser.parse_args()
+    args.handler(args)
+
+if __name__ == '__main__':
+    main()
@@ -11,11 +11,29 @@ import json
 import asyncio
 import logging
 import re
+import random
+import time
+import queue
+import threading
+import multiprocessing
+import hashlib
+import bisect
+import heapq
+import signal
+import functools
+import cProfile
+import logging.handlers
+import shutil
+import tempfile
+from collections import deque, OrderedDict
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, TextStreamer
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+from asyncio_throttle import Throttler
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
 
 # Настройка логирования
@@ -25,9 +43,106 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Наблюдатели этапов обработки сообщения: callback(этап, длительность в секундах).
+# Вызываются из потоков генерации и базы данных; без наблюдателей замеры не ведутся
+STAGE_OBSERVERS: List[Callable[[str, float], None]] = []
+
+_NO_STAGE = nullcontext()
+
+def stage(name: str):
+    """Замер этапа обработки для наблюдателей STAGE_OBSERVERS"""
+    # Без наблюдателей — общий пустой контекст: ни генератора, ни чтения часов
+    return _measure_stage(name) if STAGE_OBSERVERS else _NO_STAGE
+
+@contextmanager
+def _measure_stage(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        for observer in STAGE_OBSERVERS:
+            observer(name, elapsed)
+
+def timed(name: str):
+    """Декоратор: замер каждого вызова функции как этапа name"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not STAGE_OBSERVERS:
+                return func(*args, **kwargs)
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
 # Конфигурация
 BOT_TOKEN = os.getenv('BOT_TOKEN', 'YOUR_BOT_TOKEN_HERE')
-DB_PATH = 'odanna_bot.db'
+MODEL_NAME = os.getenv('MODEL_NAME', 'microsoft/DialoGPT-medium')
+DEVICE = os.getenv('DEVICE', 'auto')  # auto | cpu | cuda
+MODEL_DTYPE = os.getenv('MODEL_DTYPE', 'auto')  # auto | float32 | float16 | bfloat16 | int8
+MODEL_BACKEND = os.getenv('MODEL_BACKEND', 'torch')  # torch | onnx
+ONNX_MODEL_DIR = os.getenv('ONNX_MODEL_DIR', 'onnx')  # Экспортированные графы ONNX, по каталогу на модель
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # Публичный адрес бота; пусто — long polling
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+HOST = os.getenv('HOST', '0.0.0.0')
+PORT = int(os.getenv('PORT', '8080'))
+DB_PATH = os.getenv('DB_PATH', 'odanna_bot.db')
+
+# Настройки SQLite
+DB_SYNCHRONOUS = os.getenv('DB_SYNCHRONOUS', 'NORMAL')  # В режиме WAL NORMAL не теряет целостность
+DB_CACHE_SIZE_KB = int(os.getenv('DB_CACHE_SIZE_KB', '20000'))
+DB_BUSY_TIMEOUT = 5.0
+# buffered — запись в фоне пачками (при сбое теряется не больше DB_WRITE_FLUSH_MS записей),
+# commit — обработчик ждет коммита своей пачки
+DB_DURABILITY = os.getenv('DB_DURABILITY', 'buffered')
+DB_WRITE_BATCH_SIZE = int(os.getenv('DB_WRITE_BATCH_SIZE', '200'))
+DB_WRITE_FLUSH_MS = float(os.getenv('DB_WRITE_FLUSH_MS', '20'))
+CHAT_CACHE_SIZE = int(os.getenv('CHAT_CACHE_SIZE', '10000'))  # Чатов в кэше состояния, 0 — отключить
+CHAT_CACHE_HISTORY = 20  # Последних сообщений чата в кэше
+CURRENT_CHAT_TTL = float(os.getenv('CURRENT_CHAT_TTL', '30'))  # Срок жизни активного чата в кэше, с; 0 — читать из базы
+DB_STATEMENT_CACHE = 256
+
+# Настройки инференса
+INFERENCE_MODE = os.getenv('INFERENCE_MODE', 'thread')  # thread | process | sharded
+INFERENCE_WORKERS = int(os.getenv('INFERENCE_WORKERS', '2'))
+INFERENCE_QUEUE_SIZE = int(os.getenv('INFERENCE_QUEUE_SIZE', '32'))
+INFERENCE_TIMEOUT = float(os.getenv('INFERENCE_TIMEOUT', '60'))
+SHARED_WEIGHTS = os.getenv('SHARED_WEIGHTS', '0') == '1'  # process/sharded: одна копия весов на все процессы (fork, CPU)
+MAX_NEW_TOKENS = 150
+PREFIX_CACHE = os.getenv('PREFIX_CACHE', '1') == '1'  # KV-кэш системного промпта
+PROMPT_TAIL_TOKENS = int(os.getenv('PROMPT_TAIL_TOKENS', '256'))  # Место под сценарий, историю и сообщение
+KV_CACHE_BUDGET_MB = int(os.getenv('KV_CACHE_BUDGET_MB', '512'))  # Память под KV-кэши чатов, 0 — отключить
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', '1') == '1'  # Потоковые ответы правкой сообщения
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))  # Не чаще одной правки в секунду на чат
+STREAM_PLACEHOLDER = "*задумчиво молчит...*"
+MESSAGE_DEBOUNCE_MS = float(os.getenv('MESSAGE_DEBOUNCE_MS', '500'))  # Пауза, после которой сообщения подряд становятся одной репликой
+SEGMENT_CACHE_SIZE = 4096  # Строк истории с закэшированной токенизацией
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '10000'))  # Ключей в кэше ответов, 0 — отключить
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '3600'))  # Время жизни ответа в кэше, с
+RESPONSE_CACHE_VARIANTS = 3  # Разных ответов на ключ, прежде чем кэш начинает отвечать
+RESPONSE_CACHE_CONTEXT = 4  # Последних строк истории в ключе
+EMOTION_LEXICON = os.getenv('EMOTION_LEXICON', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'emotion_lexicon.json'))
+EMOTION_THRESHOLD = 0.5  # Минимальный балл эмоции для метки
+REPEAT_MAX_NGRAM = 8  # Самый длинный повтор (в словах или токенах), который подавляется
+REPEAT_MIN_COPIES = 3  # Столько копий подряд останавливают генерацию
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', '8'))  # 1 — без батчинга
+BATCH_MAX_WAIT_MS = float(os.getenv('BATCH_MAX_WAIT_MS', '10'))
+METRICS = os.getenv('METRICS', '0') == '1'  # Замеры этапов и /metrics на HOST:PORT
+PROFILE = os.getenv('PROFILE', '0') == '1'  # Профилирование генерации с запуска; переключается /profile и SIGUSR1
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0.05'))  # Доля профилируемых генераций
+PROFILE_KIND = os.getenv('PROFILE_KIND', 'cprofile')  # cprofile | torch
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', '50'))  # Старые профили удаляются
+SLOW_LOG_MS = float(os.getenv('SLOW_LOG_MS', '0'))  # Генерации дольше — в PROFILE_DIR/slow.log; 0 — отключить
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip()}
+ADMISSION_CONCURRENCY = int(os.getenv('ADMISSION_CONCURRENCY', str(INFERENCE_WORKERS * BATCH_MAX_SIZE)))  # Генераций одновременно
+ADMISSION_QUEUE = int(os.getenv('ADMISSION_QUEUE', str(INFERENCE_QUEUE_SIZE)))  # Ожидающих допуска; сверх — запасной ответ
+ADMISSION_WAIT = float(os.getenv('ADMISSION_WAIT', '10'))  # Дольше ждать допуска нельзя — запасной ответ, с
+ADMISSION_RATE = int(os.getenv('ADMISSION_RATE', '0'))  # Новых генераций в секунду на весь бот, 0 — без ограничения
+USER_RATE_PER_MIN = float(os.getenv('USER_RATE_PER_MIN', '20'))  # Генераций на пользователя в минуту, 0 — без ограничения
+USER_BURST = int(os.getenv('USER_BURST', '5'))  # Генераций подряд сверх USER_RATE_PER_MIN
 
 # Системный промпт для Оданны
 ODANNA_SYSTEM_PROMPT = """Ты — **Оданна**, хозяин легендарной **"Небесной Гостиницы"**, нейтральной территории для богов и духов. Твоя сущность — могущественный демон. Веди себя согласно следующим правилам:
@@ -80,241 +195,1140 @@ class DatabaseManager:
     
     def __init__(self, db_path: str):
         self.db_path = db_path
+        # Подписчики на изменение состава истории чата: callback(chat_id)
+        self.history_listeners: List[Callable[[str], None]] = []
+        # Постоянное соединение на поток: без повторного открытия файла и с кэшем подготовленных запросов
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
         self.init_db()
     
+    def _connection(self) -> sqlite3.Connection:
+        """Соединение текущего потока"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # check_same_thread=False только ради close() из другого потока
+            conn = sqlite3.connect(self.db_path, timeout=DB_BUSY_TIMEOUT,
+                                   cached_statements=DB_STATEMENT_CACHE, check_same_thread=False)
+            conn.execute(f'PRAGMA synchronous = {DB_SYNCHRONOUS}')
+            conn.execute(f'PRAGMA cache_size = -{DB_CACHE_SIZE_KB}')
+            conn.execute('PRAGMA temp_store = MEMORY')
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+    
+    def close(self):
+        """Закрытие всех соединений"""
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+    
+    @contextmanager
+    def _transaction(self):
+        """Транзакция одной операции записи; внутри batch() — точка сохранения в общей транзакции"""
+        conn = self._connection()
+        if not getattr(self._local, 'in_batch', False):
+            with conn:
+                yield conn
+            return
+        
+        conn.execute('SAVEPOINT write_op')
+        try:
+            yield conn
+        except Exception:
+            # Откатывается только эта операция, остальные записи пачки сохраняются
+            conn.execute('ROLLBACK TO write_op')
+            conn.execute('RELEASE write_op')
+            raise
+        conn.execute('RELEASE write_op')
+    
+    @contextmanager
+    def batch(self):
+        """Группировка операций записи текущего потока в одну транзакцию"""
+        conn = self._connection()
+        conn.execute('BEGIN')
+        self._local.in_batch = True
+        try:
+            yield
+        except Exception:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+        finally:
+            self._local.in_batch = False
+    
+    def _notify_history_changed(self, chat_id: str):
+        """Оповещение подписчиков о том, что история чата изменилась"""
+        for listener in self.history_listeners:
+            listener(chat_id)
+    
+    # Миграции схемы: элемент i переводит базу с версии i на версию i + 1 (PRAGMA user_version)
+    MIGRATIONS: List[List[str]] = [
+        # 1: исходная схема (IF NOT EXISTS — базы, созданные до появления миграций)
+        [
+            # Таблица пользователей
+            '''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                gender TEXT DEFAULT 'unknown',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            ''',
+            # Таблица чатов
+            '''
+            CREATE TABLE IF NOT EXISTS chats (
+                chat_id TEXT PRIMARY KEY,
+                user_id INTEGER,
+                chat_name TEXT,
+                scenario TEXT,
+                empathy_level INTEGER DEFAULT 35,
+                message_count INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (user_id)
+            )
+            ''',
+            # Таблица сообщений
+            '''
+            CREATE TABLE IF NOT EXISTS messages (
+                message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id TEXT,
+                user_id INTEGER,
+                message_text TEXT,
+                response_text TEXT,
+                is_ignored BOOLEAN DEFAULT FALSE,
+                emotion_analysis TEXT,
+                empathy_level INTEGER,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (chat_id) REFERENCES chats (chat_id),
+                FOREIGN KEY (user_id) REFERENCES users (user_id)
+            )
+            '''
+        ],
+        # 2: индексы для истории чата и списка чатов пользователя
+        [
+            'CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages (chat_id, message_id)',
+            'CREATE INDEX IF NOT EXISTS idx_chats_user_activity ON chats (user_id, last_activity)'
+        ],
+        # 3: активный чат пользователя переживает перезапуск
+        [
+            '''
+            CREATE TABLE IF NOT EXISTS user_state (
+                user_id INTEGER PRIMARY KEY,
+                current_chat_id TEXT,
+                FOREIGN KEY (user_id) REFERENCES users (user_id),
+                FOREIGN KEY (current_chat_id) REFERENCES chats (chat_id)
+            )
+            '''
+        ]
+    ]
+    
     def init_db(self):
         """Инициализация базы данных"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Таблица пользователей
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            gender TEXT DEFAULT 'unknown',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
-        
-        # Таблица чатов
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS chats (
-            chat_id TEXT PRIMARY KEY,
-            user_id INTEGER,
-            chat_name TEXT,
-            scenario TEXT,
-            empathy_level INTEGER DEFAULT 35,
-            message_count INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (user_id)
-        )
-        ''')
-        
-        # Таблица сообщений
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id TEXT,
-            user_id INTEGER,
-            message_text TEXT,
-            response_text TEXT,
-            is_ignored BOOLEAN DEFAULT FALSE,
-            emotion_analysis TEXT,
-            empathy_level INTEGER,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (chat_id) REFERENCES chats (chat_id),
-            FOREIGN KEY (user_id) REFERENCES users (user_id)
-        )
-        ''')
-        
-        conn.commit()
-        conn.close()
+        conn = self._connection()
+        # WAL: читатели не блокируют писателя; режим сохраняется в файле базы
+        conn.execute('PRAGMA journal_mode = WAL')
+        self.migrate()
+    
+    def migrate(self):
+        """Обновление схемы существующей базы до последней версии"""
+        conn = self._connection()
+        while True:
+            # IMMEDIATE: несколько процессов, стартующих одновременно, мигрируют по очереди
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                version = conn.execute('PRAGMA user_version').fetchone()[0]
+                if version >= len(self.MIGRATIONS):
+                    conn.commit()
+                    return
+                
+                for statement in self.MIGRATIONS[version]:
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {version + 1}')
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            
+            logger.info(f"Схема базы данных обновлена до версии {version + 1}")
     
+    @timed('db.add_user')
     def add_user(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None, gender: str = 'unknown'):
         """Добавление или обновление пользователя"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        INSERT OR REPLACE INTO users 
-        (user_id, username, first_name, last_name, gender, last_activity)
-        VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-        ''', (user_id, username, first_name, last_name, gender))
-        
-        conn.commit()
-        conn.close()
+        with self._transaction() as conn:
+            conn.execute('''
+            INSERT OR REPLACE INTO users 
+            (user_id, username, first_name, last_name, gender, last_activity)
+            VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ''', (user_id, username, first_name, last_name, gender))
     
+    @timed('db.create_chat')
     def create_chat(self, user_id: int, chat_name: str, scenario: str = "Небесная Гостиница") -> str:
         """Создание нового чата"""
         chat_id = f"{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        INSERT INTO chats (chat_id, user_id, chat_name, scenario)
-        VALUES (?, ?, ?, ?)
-        ''', (chat_id, user_id, chat_name, scenario))
-        
-        conn.commit()
-        conn.close()
+        with self._transaction() as conn:
+            conn.execute('''
+            INSERT INTO chats (chat_id, user_id, chat_name, scenario)
+            VALUES (?, ?, ?, ?)
+            ''', (chat_id, user_id, chat_name, scenario))
         
         return chat_id
     
+    @timed('db.get_user_chats')
     def get_user_chats(self, user_id: int) -> List[Tuple]:
         """Получение списка чатов пользователя"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
+        return self._connection().execute('''
         SELECT chat_id, chat_name, scenario, message_count, last_activity
         FROM chats 
         WHERE user_id = ?
         ORDER BY last_activity DESC
-        ''', (user_id,))
-        
-        chats = cursor.fetchall()
-        conn.close()
-        
-        return chats
+        ''', (user_id,)).fetchall()
     
+    @timed('db.add_message')
     def add_message(self, chat_id: str, user_id: int, message_text: str, response_text: str = None, 
                    emotion_analysis: str = None, empathy_level: int = 35):
         """Добавление сообщения в чат"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        INSERT INTO messages 
-        (chat_id, user_id, message_text, response_text, emotion_analysis, empathy_level)
-        VALUES (?, ?, ?, ?, ?, ?)
-        ''', (chat_id, user_id, message_text, response_text, emotion_analysis, empathy_level))
-        
-        # Обновляем счетчик сообщений в чате
-        cursor.execute('''
-        UPDATE chats 
-        SET message_count = message_count + 1, last_activity = CURRENT_TIMESTAMP
-        WHERE chat_id = ?
-        ''', (chat_id,))
-        
-        conn.commit()
-        conn.close()
+        with self._transaction() as conn:
+            conn.execute('''
+            INSERT INTO messages 
+            (chat_id, user_id, message_text, response_text, emotion_analysis, empathy_level)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''', (chat_id, user_id, message_text, response_text, emotion_analysis, empathy_level))
+            
+            # Обновляем счетчик сообщений в чате
+            conn.execute('''
+            UPDATE chats 
+            SET message_count = message_count + 1, last_activity = CURRENT_TIMESTAMP
+            WHERE chat_id = ?
+            ''', (chat_id,))
     
+    @timed('db.get_chat_history')
     def get_chat_history(self, chat_id: str, limit: int = 20) -> List[Tuple]:
         """Получение истории чата"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
+        messages = self._connection().execute('''
         SELECT message_text, response_text, is_ignored, emotion_analysis, timestamp
         FROM messages 
         WHERE chat_id = ? 
-        ORDER BY timestamp DESC 
+        ORDER BY message_id DESC 
         LIMIT ?
-        ''', (chat_id, limit))
-        
-        messages = cursor.fetchall()
-        conn.close()
+        ''', (chat_id, limit)).fetchall()
         
         return list(reversed(messages))
     
+    @timed('db.ignore_message')
     def ignore_message(self, chat_id: str, message_text: str):
         """Пометить сообщение как игнорируемое"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        UPDATE messages 
-        SET is_ignored = TRUE 
-        WHERE chat_id = ? AND message_text = ?
-        ORDER BY timestamp DESC LIMIT 1
-        ''', (chat_id, message_text))
-        
-        conn.commit()
-        conn.close()
+        with self._transaction() as conn:
+            conn.execute('''
+            UPDATE messages 
+            SET is_ignored = TRUE 
+            WHERE message_id = (
+                SELECT message_id FROM messages
+                WHERE chat_id = ? AND message_text = ?
+                ORDER BY message_id DESC LIMIT 1
+            )
+            ''', (chat_id, message_text))
+        self._notify_history_changed(chat_id)
     
+    @timed('db.unignore_message')
     def unignore_message(self, chat_id: str, message_text: str):
         """Убрать пометку игнорирования сообщения"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        UPDATE messages 
-        SET is_ignored = FALSE 
-        WHERE chat_id = ? AND message_text = ?
-        ''', (chat_id, message_text))
-        
-        conn.commit()
-        conn.close()
+        with self._transaction() as conn:
+            conn.execute('''
+            UPDATE messages 
+            SET is_ignored = FALSE 
+            WHERE chat_id = ? AND message_text = ?
+            ''', (chat_id, message_text))
+        self._notify_history_changed(chat_id)
     
+    @timed('db.delete_chat')
     def delete_chat(self, chat_id: str):
         """Удаление чата и всех его сообщений"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
-        cursor.execute('DELETE FROM chats WHERE chat_id = ?', (chat_id,))
-        
-        conn.commit()
-        conn.close()
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
+            conn.execute('DELETE FROM chats WHERE chat_id = ?', (chat_id,))
+            conn.execute('DELETE FROM user_state WHERE current_chat_id = ?', (chat_id,))
+        self._notify_history_changed(chat_id)
     
+    @timed('db.get_current_chat')
+    def get_current_chat(self, user_id: int) -> Optional[str]:
+        """Активный чат пользователя"""
+        result = self._connection().execute(
+            'SELECT current_chat_id FROM user_state WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        
+        return result[0] if result else None
+    
+    @timed('db.set_current_chat')
+    def set_current_chat(self, user_id: int, chat_id: str):
+        """Сохранение активного чата пользователя"""
+        with self._transaction() as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO user_state (user_id, current_chat_id)
+                VALUES (?, ?)
+            ''', (user_id, chat_id))
+    
+    @timed('db.get_chat_empathy_level')
     def get_chat_empathy_level(self, chat_id: str) -> int:
         """Получение уровня эмпатии для чата"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT empathy_level FROM chats WHERE chat_id = ?', (chat_id,))
-        result = cursor.fetchone()
-        conn.close()
+        result = self._connection().execute(
+            'SELECT empathy_level FROM chats WHERE chat_id = ?', (chat_id,)
+        ).fetchone()
         
         return result[0] if result else 35
     
+    @timed('db.get_chat_state')
+    def get_chat_state(self, chat_id: str, history_limit: int) -> Optional[Tuple]:
+        """Состояние чата: (empathy_level, message_count, scenario, последние сообщения)"""
+        row = self._connection().execute(
+            'SELECT empathy_level, message_count, scenario FROM chats WHERE chat_id = ?', (chat_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return row + (self.get_chat_history(chat_id, history_limit),)
+    
+    @timed('db.update_chat_empathy')
     def update_chat_empathy(self, chat_id: str, empathy_level: int):
         """Обновление уровня эмпатии чата"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self._transaction() as conn:
+            conn.execute('''
+            UPDATE chats 
+            SET empathy_level = ?
+            WHERE chat_id = ?
+            ''', (empathy_level, chat_id))
+
+class ChatState:
+    """Закэшированное состояние чата"""
+    __slots__ = ('empathy_level', 'message_count', 'scenario', 'history')
+    
+    def __init__(self, empathy_level: int, message_count: int, scenario: str, history: List[Tuple]):
+        self.empathy_level = empathy_level
+        self.message_count = message_count
+        self.scenario = scenario
+        # Последние CHAT_CACHE_HISTORY сообщений: всегда полный хвост истории
+        self.history = deque(history, maxlen=CHAT_CACHE_HISTORY)
+
+class ChatStateCache:
+    """LRU-кэш состояний чатов"""
+    
+    def __init__(self, max_size: int = CHAT_CACHE_SIZE):
+        self.max_size = max_size
+        self._states: OrderedDict = OrderedDict()  # {chat_id: ChatState}
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, chat_id: str) -> Optional[ChatState]:
+        state = self._states.get(chat_id)
+        if state is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._states.move_to_end(chat_id)
+        return state
+    
+    def put(self, chat_id: str, state: ChatState):
+        if self.max_size <= 0:
+            return
+        self._states[chat_id] = state
+        self._states.move_to_end(chat_id)
+        if len(self._states) > self.max_size:
+            self._states.popitem(last=False)
+    
+    def invalidate(self, chat_id: str):
+        self._states.pop(chat_id, None)
+
+class CurrentChatCache:
+    """LRU-кэш активных чатов пользователей над таблицей user_state
+    
+    Запись живет ttl секунд: реплики бота делят базу, и смена чата в другой
+    реплике становится видна здесь не позже чем через ttl.
+    """
+    
+    def __init__(self, max_size: int = CHAT_CACHE_SIZE, ttl: float = CURRENT_CHAT_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._chats: OrderedDict = OrderedDict()  # {user_id: (chat_id, истекает)}
+    
+    def get(self, user_id: int) -> Optional[str]:
+        entry = self._chats.get(user_id)
+        if entry is None:
+            return None
+        chat_id, expires = entry
+        if time.monotonic() >= expires:
+            del self._chats[user_id]
+            return None
+        self._chats.move_to_end(user_id)
+        return chat_id
+    
+    def put(self, user_id: int, chat_id: Optional[str]):
+        # Отсутствие чата не кэшируется: пользователь без чата получит его с первым сообщением
+        if self.max_size <= 0 or self.ttl <= 0 or chat_id is None:
+            return
+        self._chats[user_id] = (chat_id, time.monotonic() + self.ttl)
+        self._chats.move_to_end(user_id)
+        if len(self._chats) > self.max_size:
+            self._chats.popitem(last=False)
+    
+    def __len__(self) -> int:
+        return len(self._chats)
+
+class AsyncDatabase:
+    """Асинхронный API к DatabaseManager: запросы выполняются по очереди в выделенном потоке
+    
+    Подряд идущие записи объединяются в одну транзакцию: пачка коммитится через
+    DB_WRITE_FLUSH_MS, по достижении DB_WRITE_BATCH_SIZE записей или перед ближайшим чтением,
+    поэтому чтения всегда видят предыдущие записи.
+    
+    Состояние чатов (эмпатия, счетчик, сценарий, последние сообщения) кэшируется и обновляется
+    при записи, поэтому обычное сообщение обходится без чтений из базы.
+    Методы вызываются только из цикла событий.
+    """
+    
+    # Записи, которые в режиме buffered не ждут коммита
+    WRITE_BEHIND_METHODS = {'add_user', 'add_message', 'update_chat_empathy', 'set_current_chat'}
+    WRITE_METHODS = WRITE_BEHIND_METHODS | {'create_chat', 'ignore_message', 'unignore_message', 'delete_chat'}
+    
+    def __init__(self, db: DatabaseManager, durability: str = DB_DURABILITY,
+                 batch_size: int = DB_WRITE_BATCH_SIZE, flush_ms: float = DB_WRITE_FLUSH_MS):
+        if durability not in ('buffered', 'commit'):
+            raise ValueError(f"Неизвестный режим DB_DURABILITY: {durability}")
+        self.db = db
+        self.durability = durability
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000
+        self.write_batches = 0  # Транзакций записи
+        self.writes = 0  # Операций записи
+        self.chat_cache = ChatStateCache()
+        self._loading: Dict[str, bool] = {}  # {chat_id: была ли запись во время загрузки}
+        self._requests: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._worker, name='database', daemon=True)
+        self._thread.start()
+    
+    def _worker(self):
+        """Поток базы данных: выполняет запросы в порядке поступления, записи — пачками"""
+        pending = None  # Чтение, прервавшее набор пачки записей
+        while True:
+            request = pending if pending is not None else self._requests.get()
+            pending = None
+            if request is None:
+                break
+            
+            if request[0] not in self.WRITE_METHODS:
+                self._execute(request)
+                continue
+            
+            batch = [request]
+            stop = False
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                if request[0] not in self.WRITE_METHODS:
+                    pending = request
+                    break
+                batch.append(request)
+            
+            self._execute_writes(batch)
+            if stop:
+                break
+    
+    def _execute(self, request):
+        """Выполнение одного запроса"""
+        method, args, kwargs, future = request
+        if future is not None and not future.set_running_or_notify_cancel():
+            return
+        try:
+            # method None — барьер flush(): выполняется после коммита предыдущих записей
+            result = getattr(self.db, method)(*args, **kwargs) if method else None
+        except Exception as e:
+            if future is None:
+                logger.error(f"Ошибка фоновой записи {method}: {e}")
+                return
+            future.set_exception(e)
+        else:
+            if future is not None:
+                future.set_result(result)
+    
+    def _execute_writes(self, batch: List[Tuple]):
+        """Выполнение пачки записей в одной транзакции"""
+        results = []
+        try:
+            with stage('db.write_batch'), self.db.batch():
+                for method, args, kwargs, future in batch:
+                    try:
+                        results.append((future, getattr(self.db, method)(*args, **kwargs), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+        except Exception as e:
+            # Коммит не удался: ни одна запись пачки не сохранена
+            results = [(future, None, e) for _, _, _, future in batch]
+        
+        self.write_batches += 1
+        self.writes += len(batch)
+        
+        for (method, _, _, _), (future, result, error) in zip(batch, results):
+            if future is None:
+                if error is not None:
+                    logger.error(f"Ошибка фоновой записи {method}: {error}")
+            elif future.set_running_or_notify_cancel():
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+    
+    def _call(self, method: str, *args, **kwargs) -> asyncio.Future:
+        """Постановка вызова метода DatabaseManager в очередь потока"""
+        if self.durability == 'buffered' and method in self.WRITE_BEHIND_METHODS:
+            # Запись в фоне: обработчик не ждет диска
+            self._requests.put((method, args, kwargs, None))
+            done = asyncio.get_running_loop().create_future()
+            done.set_result(None)
+            return done
+        
+        future = Future()
+        self._requests.put((method, args, kwargs, future))
+        return asyncio.wrap_future(future)
+    
+    def queue_depth(self) -> int:
+        """Операций в очереди потока базы данных"""
+        return self._requests.qsize()
+    
+    async def flush(self):
+        """Ожидание записи всех ранее поставленных операций"""
+        await self._call(None)
+    
+    async def _chat_state(self, chat_id: str) -> Optional[ChatState]:
+        """Состояние чата из кэша или одной загрузкой из базы"""
+        state = self.chat_cache.get(chat_id)
+        if state is not None:
+            return state
         
-        cursor.execute('''
-        UPDATE chats 
-        SET empathy_level = ?
-        WHERE chat_id = ?
-        ''', (empathy_level, chat_id))
+        self._loading[chat_id] = False
+        try:
+            row = await self._call('get_chat_state', chat_id, CHAT_CACHE_HISTORY)
+        finally:
+            changed = self._loading.pop(chat_id)
+        if row is None:
+            return None
+        
+        state = ChatState(*row)
+        # Запись, поставленная во время загрузки, могла не попасть в прочитанное состояние
+        if not changed:
+            self.chat_cache.put(chat_id, state)
+        return state
+    
+    def _chat_changed(self, chat_id: str) -> Optional[ChatState]:
+        """Отметка записи в чат; возвращает закэшированное состояние для сквозного обновления"""
+        if chat_id in self._loading:
+            self._loading[chat_id] = True
+        return self.chat_cache.get(chat_id)
+    
+    def _forget_chat(self, chat_id: str):
+        """Сброс закэшированного состояния чата"""
+        self._chat_changed(chat_id)
+        self.chat_cache.invalidate(chat_id)
+    
+    async def add_user(self, user_id: int, username: str = None, first_name: str = None,
+                       last_name: str = None, gender: str = 'unknown'):
+        """Добавление или обновление пользователя"""
+        return await self._call('add_user', user_id, username, first_name, last_name, gender)
+    
+    async def create_chat(self, user_id: int, chat_name: str, scenario: str = "Небесная Гостиница") -> str:
+        """Создание нового чата"""
+        chat_id = await self._call('create_chat', user_id, chat_name, scenario)
+        self.chat_cache.put(chat_id, ChatState(35, 0, scenario, []))
+        return chat_id
+    
+    async def get_user_chats(self, user_id: int) -> List[Tuple]:
+        """Получение списка чатов пользователя"""
+        return await self._call('get_user_chats', user_id)
+    
+    async def add_message(self, chat_id: str, user_id: int, message_text: str, response_text: str = None,
+                          emotion_analysis: str = None, empathy_level: int = 35):
+        """Добавление сообщения в чат"""
+        state = self._chat_changed(chat_id)
+        if state is not None:
+            # Формат строки как у get_chat_history; CURRENT_TIMESTAMP в SQLite — UTC
+            timestamp = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+            state.history.append((message_text, response_text, 0, emotion_analysis, timestamp))
+            state.message_count += 1
+        return await self._call('add_message', chat_id, user_id, message_text, response_text,
+                                emotion_analysis, empathy_level)
+    
+    async def get_chat_history(self, chat_id: str, limit: int = 20) -> List[Tuple]:
+        """Получение истории чата"""
+        if limit <= CHAT_CACHE_HISTORY:
+            state = await self._chat_state(chat_id)
+            if state is None:
+                return []
+            return list(state.history)[-limit:]
+        return await self._call('get_chat_history', chat_id, limit)
+    
+    async def ignore_message(self, chat_id: str, message_text: str):
+        """Пометить сообщение как игнорируемое"""
+        self._forget_chat(chat_id)
+        return await self._call('ignore_message', chat_id, message_text)
+    
+    async def unignore_message(self, chat_id: str, message_text: str):
+        """Убрать пометку игнорирования сообщения"""
+        self._forget_chat(chat_id)
+        return await self._call('unignore_message', chat_id, message_text)
+    
+    async def delete_chat(self, chat_id: str):
+        """Удаление чата и всех его сообщений"""
+        self._forget_chat(chat_id)
+        return await self._call('delete_chat', chat_id)
+    
+    async def get_current_chat(self, user_id: int) -> Optional[str]:
+        """Активный чат пользователя"""
+        return await self._call('get_current_chat', user_id)
+    
+    async def set_current_chat(self, user_id: int, chat_id: str):
+        """Сохранение активного чата пользователя"""
+        return await self._call('set_current_chat', user_id, chat_id)
+    
+    async def get_chat_empathy_level(self, chat_id: str) -> int:
+        """Получение уровня эмпатии для чата"""
+        state = await self._chat_state(chat_id)
+        return state.empathy_level if state else 35
+    
+    async def update_chat_empathy(self, chat_id: str, empathy_level: int):
+        """Обновление уровня эмпатии чата"""
+        state = self._chat_changed(chat_id)
+        if state is not None:
+            state.empathy_level = empathy_level
+        return await self._call('update_chat_empathy', chat_id, empathy_level)
+    
+    def close(self):
+        """Запись накопленных операций и завершение потока"""
+        if self._thread.is_alive():
+            self._requests.put(None)
+            self._thread.join()
+        self.db.close()
+
+# torch и transformers импортируются при загрузке модели: импорт модуля и старт бота не ждут их
+torch = None
+AutoTokenizer = AutoModelForCausalLM = StoppingCriteriaList = None
+
+def _import_ml():
+    """Отложенный импорт torch и transformers"""
+    global torch, AutoTokenizer, AutoModelForCausalLM, StoppingCriteriaList
+    if torch is None:
+        import torch as _torch
+        from transformers import AutoTokenizer, AutoModelForCausalLM, StoppingCriteriaList
+        torch = _torch
+
+class BatchStreamer:
+    """Стример generate для батча: у каждой строки свой callback
+    
+    generate передает в put сначала промпт, затем по токену каждой строки за шаг.
+    Ответ строки декодируется заново на каждом шаге (он не длиннее MAX_NEW_TOKENS),
+    и в callback уходит только новый фрагмент текста.
+    """
+    
+    def __init__(self, tokenizer, callbacks: List[Optional[Callable[[str], None]]]):
+        self.tokenizer = tokenizer
+        self.callbacks = callbacks
+        self.tokens: List[List[int]] = [[] for _ in callbacks]
+        self.sent = [0] * len(callbacks)  # Уже переданных символов строки
+        self.prompt_seen = False
+    
+    def put(self, value):
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        for row, token in enumerate(value.tolist()):
+            if self.callbacks[row] is not None:
+                self.tokens[row].append(token)
+                self._emit(row, final=False)
+    
+    def end(self):
+        for row, callback in enumerate(self.callbacks):
+            if callback is not None:
+                self._emit(row, final=True)
+    
+    def _emit(self, row: int, final: bool):
+        text = self.tokenizer.decode(self.tokens[row], skip_special_tokens=True)
+        if not final:
+            # Недостающие байты многобайтного символа придут со следующим токеном
+            text = text.rstrip('\ufffd')
+        if len(text) > self.sent[row]:
+            self.callbacks[row](text[self.sent[row]:])
+            self.sent[row] = len(text)
+
+def _resolve_device(device: str):
+    """Устройство инференса; auto — GPU при наличии"""
+    if device == 'auto':
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.device(device)
+
+def _conv1d_to_linear(model):
+    """Замена Conv1D (GPT-2) на эквивалентные nn.Linear: динамическая квантизация видит только Linear"""
+    from transformers.pytorch_utils import Conv1D
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                # Conv1D хранит веса как (in, out), Linear — как (out, in)
+                linear = torch.nn.Linear(child.weight.shape[0], child.weight.shape[1])
+                linear.weight.data = child.weight.data.t().contiguous()
+                linear.bias.data = child.bias.data
+                setattr(module, name, linear)
+
+def _load_torch_model(model_name: str, device, dtype: str):
+    """Модель transformers; int8 — динамическая квантизация линейных слоев для CPU"""
+    if dtype == 'auto':
+        dtype = 'float16' if device.type == 'cuda' else 'float32'
+    
+    if dtype == 'int8':
+        if device.type != 'cpu':
+            raise ValueError("MODEL_DTYPE=int8 поддерживается только на CPU")
+        model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32)
+        _conv1d_to_linear(model)
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    
+    return AutoModelForCausalLM.from_pretrained(
+        model_name,
+        torch_dtype=getattr(torch, dtype),
+        device_map="auto" if device.type == 'cuda' else None
+    )
+
+def _load_onnx_model(model_name: str, device, dtype: str):
+    """Граф модели, экспортированный в ONNX Runtime (нужен пакет optimum[onnxruntime])"""
+    try:
+        from optimum.onnxruntime import ORTModelForCausalLM
+    except ImportError as e:
+        raise RuntimeError("MODEL_BACKEND=onnx требует пакет optimum[onnxruntime]") from e
+    
+    provider = 'CUDAExecutionProvider' if device.type == 'cuda' else 'CPUExecutionProvider'
+    path = _onnx_model_path(model_name)
+    if _has_onnx_graph(path):
+        return ORTModelForCausalLM.from_pretrained(path, provider=provider, use_cache=True)
+    
+    # Экспорт занимает минуты: он выполняется один раз, следующие запуски и рабочие процессы загружают готовый граф
+    logger.info(f"Экспорт {model_name} в ONNX: {path}")
+    model = ORTModelForCausalLM.from_pretrained(model_name, export=True, provider=provider, use_cache=True)
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix='.export-', dir=parent)
+    try:
+        model.save_pretrained(staging)
+        # Каталог появляется целиком: процесс, экспортирующий одновременно, не прочитает недописанный граф
+        os.rename(staging, path)
+    except OSError as e:
+        logger.warning(f"Экспорт ONNX не сохранен ({e}), вероятно его уже сохранил другой процесс")
+        shutil.rmtree(staging, ignore_errors=True)
+    return model
+
+def _has_onnx_graph(path: str) -> bool:
+    return os.path.isdir(path) and any(name.endswith('.onnx') for name in os.listdir(path))
+
+def _onnx_model_path(model_name: str) -> str:
+    """Каталог экспортированного графа модели: сам MODEL_NAME, если это уже экспорт, иначе в ONNX_MODEL_DIR"""
+    if _has_onnx_graph(model_name):
+        return model_name
+    return os.path.join(ONNX_MODEL_DIR, re.sub(r'[^\w.-]+', '--', model_name).strip('-'))
+
+def has_repetition_loop(token_ids: List[int], max_ngram: int = REPEAT_MAX_NGRAM,
+                        min_copies: int = REPEAT_MIN_COPIES) -> bool:
+    """Хвост последовательности — одна n-грамма, повторенная min_copies раз подряд"""
+    for n in range(1, max_ngram + 1):
+        span = n * min_copies
+        if len(token_ids) < span:
+            break
+        tail = token_ids[-span:]
+        # Хвост с периодом n совпадает сам с собой при сдвиге на n
+        if tail[n:] == tail[:-n]:
+            return True
+    return False
+
+class RepetitionStopper:
+    """Критерий остановки generate: все последовательности батча зациклились или закончились
+    
+    Проверяется только окно последних max_ngram * min_copies сгенерированных токенов,
+    поэтому шаг генерации стоит O(1) независимо от длины ответа.
+    """
+    
+    def __init__(self, prompt_length: int, max_ngram: int = REPEAT_MAX_NGRAM, min_copies: int = REPEAT_MIN_COPIES):
+        self.prompt_length = prompt_length
+        self.max_ngram = max_ngram
+        self.min_copies = min_copies
+    
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        start = max(self.prompt_length, input_ids.shape[1] - self.max_ngram * self.min_copies)
+        # Закончившиеся последовательности дополняются pad и тоже выглядят как повтор
+        return all(
+            has_repetition_loop(row, self.max_ngram, self.min_copies)
+            for row in input_ids[:, start:].tolist()
+        )
+
+class CancelStopper:
+    """Критерий остановки generate: ответы всех запросов батча больше не нужны"""
+    
+    def __init__(self, events: List[Optional[threading.Event]]):
+        self.events = events
+    
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        return all(event is not None and event.is_set() for event in self.events)
+
+_TEXT_TOKEN_RE = re.compile(r'\S+\s*')
+_TOKEN_TAIL_RE = re.compile(r'\W*$')  # Пунктуация и пробелы после слова
+_CHAR_RUN_RE = re.compile(r'([^\s\d])\1{3,}')  # Цифры не трогаем: 1000000 — не повтор
+
+def suppress_repetitions(text: str, max_ngram: int = REPEAT_MAX_NGRAM) -> str:
+    """Удаление зацикленных повторов из текста за линейное время
+    
+    Серии одного символа сокращаются до трех, подряд идущие повторы фраз из
+    2..max_ngram слов — до одной копии, одно слово три и более раз подряд — до
+    одного (сравнение без регистра и пунктуации). Каждая длина фразы —
+    один проход по словам, итого O(max_ngram² · длина).
+    """
+    text = _CHAR_RUN_RE.sub(r'\1\1\1', text)
+    tokens = _TEXT_TOKEN_RE.findall(text)
+    keys = [re.sub(r'\W', '', token.lower()) or token.strip() for token in tokens]
+    
+    # Одно слово: серии из трех и более повторов
+    keep: List[int] = []
+    start = 0
+    while start < len(tokens):
+        end = start + 1
+        while end < len(tokens) and keys[end] == keys[start]:
+            end += 1
+        if end - start >= 3:
+            # Из серии остается одна копия: слово первой (с заглавной буквой начала фразы),
+            # пунктуация и перевод строки — последней
+            first, last = tokens[start], tokens[end - 1]
+            tokens[start] = first[:_TOKEN_TAIL_RE.search(first).start()] + _TOKEN_TAIL_RE.search(last).group()
+            keep.append(start)
+        else:
+            keep.extend(range(start, end))
+        start = end
+    
+    # Фразы: повтор сразу после предыдущей копии удаляется
+    for n in range(2, max_ngram + 1):
+        kept: List[int] = []
+        for i in keep:
+            kept.append(i)
+            if len(kept) >= 2 * n and all(keys[kept[-k]] == keys[kept[-n - k]] for k in range(1, n + 1)):
+                del kept[-n:]
+        keep = kept
+    
+    return ''.join(tokens[i] for i in keep)
+
+# Бэкенды исполнения модели: {MODEL_BACKEND: загрузчик(model_name, device, dtype)}
+MODEL_BACKENDS: Dict[str, Callable] = {
+    'torch': _load_torch_model,
+    'onnx': _load_onnx_model
+}
+# Бэкенды, чьи past_key_values можно переиспользовать между вызовами (кэш префикса и KV-кэши чатов)
+KV_REUSE_BACKENDS = {'torch'}
+
+class KVCacheEntry:
+    """Состояние модели для контекста чата"""
+    __slots__ = ('token_ids', 'past_key_values', 'nbytes', 'history_anchor')
+    
+    def __init__(self, token_ids: List[int], past_key_values, history_anchor: Optional[str]):
+        self.token_ids = token_ids
+        self.past_key_values = past_key_values
+        self.nbytes = sum(tensor.element_size() * tensor.nelement() for layer in past_key_values for tensor in layer)
+        self.history_anchor = history_anchor
+
+class KVCachePool:
+    """KV-кэши контекстов по chat_id с бюджетом памяти и вытеснением LRU"""
+    
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self.total_bytes = 0
+        self._entries: OrderedDict = OrderedDict()  # {chat_id: KVCacheEntry}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.evictions = 0
+    
+    @property
+    def enabled(self) -> bool:
+        return self.budget_bytes > 0
+    
+    def lookup(self, chat_id: str, token_ids: List[int]):
+        """Кэш для самого длинного общего префикса с token_ids: (past_key_values, длина) или (None, 0)"""
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is None:
+                self.misses += 1
+                return None, 0
+            self._entries.move_to_end(chat_id)
+        
+        cached = entry.token_ids
+        length = 0
+        limit = min(len(cached), len(token_ids) - 1)  # Хотя бы один токен должен пройти через модель
+        while length < limit and cached[length] == token_ids[length]:
+            length += 1
+        
+        if length == 0:
+            self.misses += 1
+            return None, 0
+        
+        self.hits += 1
+        self.reused_tokens += length
+        past_key_values = tuple(
+            tuple(tensor[:, :, :length] for tensor in layer)
+            for layer in entry.past_key_values
+        )
+        return past_key_values, length
+    
+    def history_anchor(self, chat_id: str) -> Optional[str]:
+        """Первая строка истории в закэшированном контексте чата"""
+        entry = self._entries.get(chat_id)
+        return entry.history_anchor if entry else None
+    
+    def store(self, chat_id: str, token_ids: List[int], past_key_values, history_anchor: Optional[str] = None):
+        """Сохранение состояния модели для контекста чата"""
+        entry = KVCacheEntry(token_ids, past_key_values, history_anchor)
+        if entry.nbytes > self.budget_bytes:
+            self.invalidate(chat_id)
+            return
+        
+        with self._lock:
+            old = self._entries.pop(chat_id, None)
+            if old is not None:
+                self.total_bytes -= old.nbytes
+            self._entries[chat_id] = entry
+            self.total_bytes += entry.nbytes
+            
+            while self.total_bytes > self.budget_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.total_bytes -= evicted.nbytes
+                self.evictions += 1
+    
+    def invalidate(self, chat_id: str):
+        """Удаление кэша чата"""
+        with self._lock:
+            entry = self._entries.pop(chat_id, None)
+            if entry is not None:
+                self.total_bytes -= entry.nbytes
+    
+    def stats(self) -> Dict:
+        """Статистика пула"""
+        return {
+            'chats': len(self._entries),
+            'total_mb': self.total_bytes / 2**20,
+            'hits': self.hits,
+            'misses': self.misses,
+            'reused_tokens': self.reused_tokens,
+            'evictions': self.evictions
+        }
+
+class ResponseCache:
+    """Кэш готовых ответов модели на повторяющиеся реплики с TTL и вытеснением LRU
+    
+    На ключ копится несколько вариантов ответа; пока их меньше variants, запрос
+    уходит в модель, после — отвечает случайный вариант из кэша.
+    """
+    
+    def __init__(self, max_size: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL,
+                 variants: int = RESPONSE_CACHE_VARIANTS, context_lines: int = RESPONSE_CACHE_CONTEXT):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.variants = variants
+        self.context_lines = context_lines
+        self._entries: OrderedDict = OrderedDict()  # {ключ: (истекает, [ответы])}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+    
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Нормализация реплики: регистр, ё, пунктуация, растянутые буквы ("привееет!!" → "привет")"""
+        text = text.lower().replace('ё', 'е')
+        text = re.sub(r'[^\w\s]', ' ', text)
+        text = re.sub(r'(\w)\1+', r'\1', text)
+        return ' '.join(text.split())
+    
+    def key(self, request: Dict) -> Tuple:
+        """Ключ запроса: сценарий, уровень эмпатии с шагом 10, эмоция, недавний контекст и реплика"""
+        context = tuple(request['chat_history'][-self.context_lines:]) if self.context_lines else ()
+        return (
+            request['scenario'],
+            request['empathy_level'] // 10,
+            request['emotion'],
+            hashlib.blake2b('\n'.join(context).encode('utf-8'), digest_size=8).digest(),
+            self.normalize(request['user_message'])
+        )
+    
+    def get(self, request: Dict) -> Optional[str]:
+        """Закэшированный ответ или None, если запрос нужно отдать модели"""
+        if not self.enabled:
+            return None
+        
+        key = self.key(request)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] <= time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            entry = None
+        
+        if entry is None or len(entry[1]) < self.variants:
+            self.misses += 1
+            return None
+        
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return random.choice(entry[1])
+    
+    def put(self, request: Dict, response: str):
+        """Сохранение ответа модели как варианта для ключа запроса"""
+        if not self.enabled:
+            return
         
-        conn.commit()
-        conn.close()
+        key = self.key(request)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = (time.monotonic() + self.ttl, [])
+            self._entries[key] = entry
+        if response not in entry[1] and len(entry[1]) < self.variants:
+            entry[1].append(response)
+        self._entries.move_to_end(key)
+        
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def stats(self) -> Dict:
+        """Статистика кэша"""
+        lookups = self.hits + self.misses
+        return {
+            'keys': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+class EmotionAnalyzer:
+    """Словарный анализ эмоций за один проход по словам текста
+    
+    Словарь: {эмоция: {слово: вес}}. Слово с "*" на конце — основа и совпадает
+    с любым словом, которое с нее начинается. Каждое слово текста проверяется
+    одним поиском в хеш-таблице слов и по одному на каждую длину основ, так что
+    стоимость анализа не растет с размером словаря.
+    """
+    
+    TOKEN_RE = re.compile(r'\w+(?:-\w+)*|[?!]')
+    
+    # Словарь на случай отсутствия файла (исходные списки ключевых слов)
+    BUILTIN_LEXICON = {
+        'радость': {w: 1.0 for w in ['хорошо', 'отлично', 'прекрасно', 'спасибо', 'рад*', 'счастлив*', 'люблю']},
+        'грусть': {w: 1.0 for w in ['плохо', 'ужасно', 'грустно', 'злой', 'расстроен*', 'больно', 'устал*']},
+        'любопытство': {w: 1.0 for w in ['что', 'как', 'где', 'когда', 'почему', 'зачем', '?']},
+        'возбуждение': {'!': 1.0}
+    }
+    
+    def __init__(self, lexicon: Dict[str, Dict[str, float]], threshold: float = EMOTION_THRESHOLD):
+        self.emotions = list(lexicon)
+        self.threshold = threshold
+        self._words: Dict[str, List[Tuple[str, float]]] = {}
+        self._stems: Dict[str, List[Tuple[str, float]]] = {}
+        for emotion, entries in lexicon.items():
+            for word, weight in entries.items():
+                word = word.lower().replace('ё', 'е')
+                if word.endswith('*'):
+                    self._stems.setdefault(word[:-1], []).append((emotion, weight))
+                else:
+                    self._words.setdefault(word, []).append((emotion, weight))
+        self._stem_lengths = sorted({len(stem) for stem in self._stems})
+    
+    @classmethod
+    def from_file(cls, path: str = EMOTION_LEXICON) -> 'EmotionAnalyzer':
+        """Загрузка словаря из JSON; без файла — встроенный минимальный словарь"""
+        try:
+            with open(path, encoding='utf-8') as f:
+                return cls(json.load(f))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Словарь эмоций {path} не загружен ({e}), используется встроенный")
+            return cls(cls.BUILTIN_LEXICON)
+    
+    def scores(self, text: str) -> Dict[str, float]:
+        """Баллы эмоций текста"""
+        scores: Dict[str, float] = {}
+        words, stems, stem_lengths = self._words, self._stems, self._stem_lengths
+        for token in self.TOKEN_RE.findall(text.lower().replace('ё', 'е')):
+            for emotion, weight in words.get(token, ()):
+                scores[emotion] = scores.get(emotion, 0.0) + weight
+            for length in stem_lengths:
+                if length > len(token):
+                    break
+                for emotion, weight in stems.get(token[:length], ()):
+                    scores[emotion] = scores.get(emotion, 0.0) + weight
+        return scores
+    
+    def labels(self, text: str) -> List[str]:
+        """Эмоции текста с баллом не ниже порога в порядке словаря"""
+        scores = self.scores(text)
+        return [emotion for emotion in self.emotions if scores.get(emotion, 0.0) >= self.threshold]
 
 class AIManager:
     """Управление нейросетью для генерации ответов"""
     
-    def __init__(self):
+    def __init__(self, preload: bool = True, model_name: str = MODEL_NAME, device: str = DEVICE,
+                 dtype: str = MODEL_DTYPE, backend: str = MODEL_BACKEND):
+        if backend not in MODEL_BACKENDS:
+            raise ValueError(f"Неизвестный бэкенд модели: {backend}")
+        self.model_name = model_name
+        self.device_name = device
+        self.dtype = dtype
+        self.backend = backend
+        self.reuse_kv = backend in KV_REUSE_BACKENDS
         self.model = None
         self.tokenizer = None
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.load_model()
+        self.prefix_ids: List[int] = []  # Токены системного промпта
+        self.prefix_cache = None  # past_key_values системного промпта
+        self.kv_pool = KVCachePool(KV_CACHE_BUDGET_MB * 2**20 if self.reuse_kv else 0)  # KV-кэши чатов
+        self.response_cache = ResponseCache()  # Ответы на повторяющиеся реплики
+        self.emotion_analyzer = EmotionAnalyzer.from_file()
+        self._segment_cache: OrderedDict = OrderedDict()  # {текст сегмента: токены}
+        self._segment_lock = threading.Lock()
+        self.device = None
+        self.ready = threading.Event()  # Модель загружена, генерация доступна
+        if preload:
+            self.load_model()
+    
+    def load_in_background(self) -> threading.Thread:
+        """Загрузка модели в фоновом потоке; до ее окончания отвечает _fallback_response"""
+        thread = threading.Thread(target=self.load_model, name='model-loader', daemon=True)
+        thread.start()
+        return thread
     
     def load_model(self):
-        """Загрузка модели Llama 3"""
+        """Загрузка модели выбранным бэкендом"""
         try:
-            model_name = "microsoft/DialoGPT-medium"  # Альтернатива для бесплатного использования
-            
-            logger.info(f"Загрузка модели {model_name}...")
-            
-            self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-            self.model = AutoModelForCausalLM.from_pretrained(
-                model_name,
-                torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-                device_map="auto" if torch.cuda.is_available() else None
-            )
-            
-            # Добавляем pad_token если его нет
-            if self.tokenizer.pad_token is None:
-                self.tokenizer.pad_token = self.tokenizer.eos_token
+            self.load_weights()
+            self._prepare_prefix_cache()
             
+            # Генерация начинается только с полностью подготовленной моделью
+            self.ready.set()
             logger.info("Модель успешно загружена!")
             
         except Exception as e:
@@ -322,27 +1336,44 @@ class AIManager:
             self.model = None
             self.tokenizer = None
     
-    def analyze_emotion(self, text: str) -> str:
-        """Анализ эмоций в тексте"""
-        # Простой анализ эмоций на основе ключевых слов
-        positive_words = ['хорошо', 'отлично', 'прекрасно', 'спасибо', 'рад', 'счастлив', 'люблю']
-        negative_words = ['плохо', 'ужасно', 'грустно', 'злой', 'расстроен', 'больно', 'устал']
-        question_words = ['что', 'как', 'где', 'когда', 'почему', 'зачем', '?']
+    def load_weights(self):
+        """Загрузка токенизатора и весов без вычислений на модели"""
+        _import_ml()
+        self.device = _resolve_device(self.device_name)
+        
+        logger.info(f"Загрузка модели {self.model_name} ({self.backend}, {self.dtype}, {self.device})...")
         
-        text_lower = text.lower()
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        self.model = MODEL_BACKENDS[self.backend](self.model_name, self.device, self.dtype)
         
-        emotions = []
+        # Добавляем pad_token если его нет
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+    
+    def _max_prompt_tokens(self) -> int:
+        """Длина промпта, при которой промпт и ответ умещаются в окно позиций модели"""
+        return getattr(self.model.config, 'n_positions', 1024) - MAX_NEW_TOKENS
+    
+    def _prepare_prefix_cache(self):
+        """Однократное кодирование системного промпта и предвычисление его KV-кэша"""
+        # Системный промпт длиннее окна модели: оставляем место под хвост контекста
+        prefix_budget = max(0, self._max_prompt_tokens() - PROMPT_TAIL_TOKENS)
+        self.prefix_ids = self.tokenizer.encode(ODANNA_SYSTEM_PROMPT)[:prefix_budget]
+        self.prefix_cache = None
+        
+        if not PREFIX_CACHE or not self.reuse_kv or not self.prefix_ids:
+            return
         
-        if any(word in text_lower for word in positive_words):
-            emotions.append('радость')
-        if any(word in text_lower for word in negative_words):
-            emotions.append('грусть')
-        if any(word in text_lower for word in question_words):
-            emotions.append('любопытство')
+        with torch.no_grad():
+            outputs = self.model(torch.tensor([self.prefix_ids], device=self.device), use_cache=True)
+        self.prefix_cache = outputs.past_key_values
+        logger.info(f"KV-кэш системного промпта готов: {len(self.prefix_ids)} токенов")
+    
+    def analyze_emotion(self, text: str) -> str:
+        """Анализ эмоций в тексте"""
+        emotions = self.emotion_analyzer.labels(text)
         if len(text) > 100:
             emotions.append('многословность')
-        if '!' in text:
-            emotions.append('возбуждение')
         
         return ', '.join(emotions) if emotions else 'нейтральное'
     
@@ -367,62 +1398,291 @@ class AIManager:
         return max(35, min(85, base_level))
     
     def generate_odanna_response(self, user_message: str, chat_history: List[str], 
-                                empathy_level: int, emotion: str, scenario: str) -> str:
-        """Генерация ответа в стиле Оданны"""
+                                empathy_level: int, emotion: str, scenario: str,
+                                chat_id: Optional[str] = None,
+                                on_text: Optional[Callable[[str], None]] = None,
+                                cancel: Optional[threading.Event] = None) -> str:
+        """Генерация ответа в стиле Оданны
+        
+        on_text получает фрагменты сырого текста по мере генерации (из потока генерации);
+        установленный cancel обрывает генерацию.
+        """
+        return self.generate_odanna_batch([{
+            'user_message': user_message,
+            'chat_history': chat_history,
+            'empathy_level': empathy_level,
+            'emotion': emotion,
+            'scenario': scenario,
+            'chat_id': chat_id,
+            'on_text': on_text,
+            'cancel': cancel
+        }])[0]
+    
+    def generate_odanna_batch(self, requests: List[Dict]) -> List[str]:
+        """Генерация ответов для батча запросов одним вызовом generate
+        
+        Необязательные поля запроса: on_text — callback фрагментов ответа, cancel — отмена.
+        """
         
-        if not self.model or not self.tokenizer:
-            return self._fallback_response(user_message, empathy_level, emotion)
+        if not self.ready.is_set():
+            return [self._fallback_response(r['user_message'], r['empathy_level'], r['emotion']) for r in requests]
         
+        with profiler.session('generate'):
+            return self._generate(requests)
+    
+    def _generate(self, requests: List[Dict]) -> List[str]:
+        """Генерация батча: сборка контекста, generate, постобработка"""
+        started = time.perf_counter()
         try:
-            # Формируем контекст для генерации
-            context = self._build_context(user_message, chat_history, empathy_level, emotion, scenario)
+            # Токены части контекста после системного промпта в пределах бюджета
+            with stage('context'), profiler.region('context'):
+                assembled = [self._assemble_tail(r) for r in requests]
+            tails = [tail for tail, _ in assembled]
             
-            # Токенизация
-            inputs = self.tokenizer.encode(context, return_tensors='pt', max_length=1024, truncation=True)
-            inputs = inputs.to(self.device)
+            chat_id = requests[0].get('chat_id')
+            with stage('prefill'):
+                if len(requests) == 1 and chat_id and self.kv_pool.enabled:
+                    # Одиночный запрос продолжает закэшированный контекст своего чата
+                    input_ids, attention_mask, past_key_values = self._prepare_chat_inputs(chat_id, tails[0], assembled[0][1])
+                else:
+                    input_ids, attention_mask, past_key_values = self._prepare_inputs(tails)
+            prompt_length = input_ids.shape[1]
             
             # Генерация
-            with torch.no_grad():
+            # Зациклившаяся генерация обрывается, не дожидаясь max_new_tokens
+            stopping_criteria = StoppingCriteriaList([RepetitionStopper(prompt_length)])
+            cancels = [r.get('cancel') for r in requests]
+            if any(cancels):
+                # Запросы, вытесненные новыми сообщениями, останавливают генерацию, когда отменены все
+                stopping_criteria.append(CancelStopper(cancels))
+            
+            # Потоковые запросы батча получают фрагменты своих ответов
+            callbacks = [r.get('on_text') for r in requests]
+            streamer = BatchStreamer(self.tokenizer, callbacks) if any(callbacks) else None
+            
+            generate_started = time.perf_counter()
+            with stage('generate'), profiler.region('generate'), torch.no_grad():
                 outputs = self.model.generate(
-                    inputs,
-                    max_length=inputs.shape[1] + 150,
+                    input_ids,
+                    attention_mask=attention_mask,
+                    past_key_values=past_key_values,
+                    max_new_tokens=MAX_NEW_TOKENS,
+                    streamer=streamer,
                     num_return_sequences=1,
                     temperature=0.8,
                     do_sample=True,
-                    pad_token_id=self.tokenizer.eos_token_id,
-                    eos_token_id=self.tokenizer.eos_token_id
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    eos_token_id=self.tokenizer.eos_token_id,
+                    stopping_criteria=stopping_criteria
                 )
             
-            # Декодирование ответа
-            response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-            response = response[len(context):].strip()
+            generate_finished = time.perf_counter()
+            
+            if metrics.enabled:
+                for mask, output in zip(attention_mask, outputs):
+                    metrics.observe_tokens('prompt', int(mask.sum()))
+                    metrics.observe_tokens('generated', int((output[prompt_length:] != self.tokenizer.pad_token_id).sum()))
             
-            # Постобработка ответа
-            response = self._post_process_response(response, empathy_level, emotion)
+            responses = []
+            with stage('post_process'), profiler.region('post_process'):
+                for request, output in zip(requests, outputs):
+                    # Декодирование только сгенерированной части
+                    response = self.tokenizer.decode(output[prompt_length:], skip_special_tokens=True).strip()
+                    
+                    # Постобработка ответа
+                    responses.append(self._post_process_response(response, request['empathy_level'], request['emotion']))
             
-            return response
+            finished = time.perf_counter()
+            profiler.log_slow((finished - started) * 1000, {
+                'chat_ids': [r.get('chat_id') for r in requests],
+                'batch': len(requests),
+                'prompt_tokens': prompt_length,
+                'generated_tokens': outputs.shape[1] - prompt_length,
+                'context_ms': round((generate_started - started) * 1000, 1),
+                'generate_ms': round((generate_finished - generate_started) * 1000, 1),
+                'post_process_ms': round((finished - generate_finished) * 1000, 1)
+            })
+            return responses
             
         except Exception as e:
             logger.error(f"Ошибка генерации ответа: {e}")
-            return self._fallback_response(user_message, empathy_level, emotion)
+            return [self._fallback_response(r['user_message'], r['empathy_level'], r['emotion']) for r in requests]
+    
+    def _prepare_inputs(self, tails: List[List[int]]):
+        """Сборка батча: [системный промпт][паддинг][хвост] и KV-кэш префикса"""
+        tail_length = max(len(tail) for tail in tails)
+        pad_id = self.tokenizer.pad_token_id
+        
+        input_ids = []
+        attention_mask = []
+        for tail in tails:
+            padding = tail_length - len(tail)
+            # Паддинг между префиксом и хвостом: общий префикс остается в тех же позициях
+            input_ids.append(self.prefix_ids + [pad_id] * padding + tail)
+            attention_mask.append([1] * len(self.prefix_ids) + [0] * padding + [1] * len(tail))
+        
+        input_ids = torch.tensor(input_ids, device=self.device)
+        attention_mask = torch.tensor(attention_mask, device=self.device)
+        
+        past_key_values = None
+        if self.prefix_cache is not None:
+            # Генерация продолжается с кэша префикса и пересчитывает только хвосты
+            batch_size = len(tails)
+            past_key_values = tuple(
+                tuple(tensor.expand(batch_size, -1, -1, -1) for tensor in layer)
+                for layer in self.prefix_cache
+            )
+        
+        return input_ids, attention_mask, past_key_values
+    
+    def _prepare_chat_inputs(self, chat_id: str, tail: List[int], history_anchor: Optional[str]):
+        """Вход для одного запроса с инкрементальным дозаполнением KV-кэша чата"""
+        token_ids = self.prefix_ids + tail
+        # В пуле хранится только часть после системного промпта: KV-кэш промпта общий и лежит в памяти один раз
+        offset = len(self.prefix_ids) if self.prefix_cache is not None else 0
+        
+        segment, cached_length = self.kv_pool.lookup(chat_id, token_ids[offset:])
+        if segment is None:
+            past_key_values = self.prefix_cache
+        elif offset:
+            past_key_values = tuple(
+                tuple(torch.cat([prefix, tensor], dim=2) for prefix, tensor in zip(prefix_layer, layer))
+                for prefix_layer, layer in zip(self.prefix_cache, segment)
+            )
+        else:
+            past_key_values = segment
+        cached_length += offset
+        
+        # Прогоняем через модель только новые токены, кроме последнего — его обработает generate
+        if len(token_ids) - 1 > cached_length:
+            new_tokens = torch.tensor([token_ids[cached_length:-1]], device=self.device)
+            with torch.no_grad():
+                outputs = self.model(new_tokens, past_key_values=past_key_values, use_cache=True)
+            past_key_values = outputs.past_key_values
+        
+        if past_key_values is not None and len(token_ids) - 1 > offset:
+            # Копия среза: представление удерживало бы в памяти весь тензор вместе с промптом
+            segment = tuple(
+                tuple(tensor[:, :, offset:].clone() for tensor in layer)
+                for layer in past_key_values
+            )
+            self.kv_pool.store(chat_id, token_ids[offset:-1], segment, history_anchor)
+        
+        input_ids = torch.tensor([token_ids], device=self.device)
+        attention_mask = torch.ones_like(input_ids)
+        return input_ids, attention_mask, past_key_values
+    
+    def cached_response(self, request: Dict) -> Optional[str]:
+        """Ответ из кэша ответов без обращения к модели"""
+        response = self.response_cache.get(request)
+        lookups = self.response_cache.hits + self.response_cache.misses
+        if lookups and lookups % 1000 == 0:
+            logger.info(f"Кэш ответов: {self.response_cache.stats()}")
+        return response
+    
+    def cache_response(self, request: Dict, response: str) -> bool:
+        """Сохранение ответа модели в кэш ответов; False — ответ оказался запасным"""
+        # Запасной ответ — признак таймаута или незагруженной модели, а не ответ модели
+        if response == self._fallback_response(request['user_message'], request['empathy_level'], request['emotion']):
+            return False
+        self.response_cache.put(request, response)
+        return True
+    
+    def invalidate_chat(self, chat_id: str):
+        """Сброс KV-кэша чата после изменения его истории"""
+        self.kv_pool.invalidate(chat_id)
+    
+    def _segment_ids(self, text: str) -> List[int]:
+        """Токены сегмента контекста (кэшируются: строки истории повторяются от сообщения к сообщению)"""
+        with self._segment_lock:
+            token_ids = self._segment_cache.get(text)
+            if token_ids is not None:
+                self._segment_cache.move_to_end(text)
+                return token_ids
+        
+        with stage('tokenize'):
+            token_ids = self.tokenizer.encode(text)
+        with self._segment_lock:
+            self._segment_cache[text] = token_ids
+            if len(self._segment_cache) > SEGMENT_CACHE_SIZE:
+                self._segment_cache.popitem(last=False)
+        return token_ids
+    
+    def _assemble_tail(self, request: Dict) -> Tuple[List[int], Optional[str]]:
+        """Токены контекста после системного промпта в пределах бюджета окна модели
+        
+        Возвращает токены и первую вошедшую строку истории.
+        Сегменты токенизируются по отдельности и начинаются с перевода строки,
+        поэтому их склейка совпадает с токенизацией текста _build_context_tail.
+        """
+        budget = self._max_prompt_tokens() - len(self.prefix_ids)
+        
+        header = self._segment_ids(f"\n\nСценарий: {request['scenario']}\n\nИстория разговора:")
+        with stage('tokenize'):
+            footer = self.tokenizer.encode(
+                f"\n\nУровень эмпатии: {request['empathy_level']}%"
+                f"\n\nЭмоциональное состояние собеседника: {request['emotion']}"
+                f"\n\nПользователь: {request['user_message']}"
+                "\n\nОданна:"
+            )
+        # Место под сообщение пользователя и реплику "Оданна:" резервируется первым;
+        # от слишком длинного сообщения остается конец
+        footer = footer[-max(1, budget - len(header)):]
+        
+        lines = request['chat_history']
+        line_ids = [self._segment_ids(f"\n{line}") for line in lines]
+        start = self._history_start(request.get('chat_id'), lines, line_ids, budget - len(header) - len(footer))
+        
+        tail = header + [token for ids in line_ids[start:] for token in ids] + footer
+        return tail, (lines[start] if start < len(lines) else None)
+    
+    def _history_start(self, chat_id: Optional[str], lines: List[str],
+                       line_ids: List[List[int]], budget: int) -> int:
+        """Индекс первой строки истории, попадающей в бюджет токенов"""
+        lengths = [len(ids) for ids in line_ids]
+        
+        # Пока история от начала закэшированного контекста умещается, начало не меняется
+        # и KV-кэш чата переиспользуется
+        anchor = self.kv_pool.history_anchor(chat_id) if chat_id else None
+        if anchor is not None and anchor in lines:
+            start = len(lines) - 1 - lines[::-1].index(anchor)
+            if sum(lengths[start:]) <= budget:
+                return start
+        
+        # Иначе заполняем бюджет от новых строк к старым; при сдвиге окна берем половину бюджета,
+        # чтобы следующие сообщения снова дописывались к закэшированному контексту
+        limit = budget // 2 if anchor is not None else budget
+        start = len(lines)
+        used = 0
+        while start > 0 and used + lengths[start - 1] <= limit:
+            start -= 1
+            used += lengths[start]
+        return start
     
     def _build_context(self, user_message: str, chat_history: List[str], 
                       empathy_level: int, emotion: str, scenario: str) -> str:
         """Построение контекста для генерации"""
+        tail = self._build_context_tail(user_message, chat_history, empathy_level, emotion, scenario)
+        return f"{ODANNA_SYSTEM_PROMPT}\n{tail}"
+    
+    def _build_context_tail(self, user_message: str, chat_history: List[str], 
+                            empathy_level: int, emotion: str, scenario: str) -> str:
+        """Часть контекста после системного промпта"""
         
+        # Сначала стабильные части, затем меняющиеся от сообщения к сообщению:
+        # так соседние сообщения чата имеют общий префикс для KV-кэша
         context_parts = [
-            ODANNA_SYSTEM_PROMPT,
             f"\nСценарий: {scenario}",
-            f"\nУровень эмпатии: {empathy_level}%",
-            f"\nЭмоциональное состояние собеседника: {emotion}",
             "\nИстория разговора:"
         ]
         
         # Добавляем историю чата
-        for msg in chat_history[-5:]:  # Последние 5 сообщений
+        for msg in chat_history:
             context_parts.append(msg)
         
         context_parts.extend([
+            f"\nУровень эмпатии: {empathy_level}%",
+            f"\nЭмоциональное состояние собеседника: {emotion}",
             f"\nПользователь: {user_message}",
             "\nОданна:"
         ])
@@ -433,7 +1693,7 @@ class AIManager:
         """Постобработка ответа для соответствия характеру Оданны"""
         
         # Убираем лишние повторы и обрезаем длинные ответы
-        response = re.sub(r'(.+?)\1+', r'\1', response)  # Убираем повторы
+        response = suppress_repetitions(response)  # Убираем повторы
         response = response[:500]  # Ограничиваем длину
         
         # Добавляем характерные элементы Оданны
@@ -494,21 +1754,887 @@ class AIManager:
         
         return level_responses[len(user_message) % len(level_responses)]
 
+# AIManager рабочего процесса (режимы INFERENCE_MODE=process и sharded)
+_worker_ai: Optional[AIManager] = None
+
+def _init_inference_worker(reports):
+    """Инициализация рабочего процесса инференса; в reports — (PID, загружена ли модель или None)"""
+    global _worker_ai
+    # Первым делом: до установки обработчика SIGUSR1 завершил бы процесс, поэтому сигналы
+    # получают только процессы, отчитавшиеся о запуске
+    profiler.install_signal_handler()
+    reports.put((os.getpid(), None))
+    _worker_ai = AIManager()
+    reports.put((os.getpid(), _worker_ai.ready.is_set()))
+
+def _init_forked_worker(threads: int, reports):
+    """Инициализация процесса, созданного fork после загрузки весов
+    
+    Веса унаследованы от родителя и остаются общими страницами (copy-on-write),
+    пока их никто не изменяет. Вычисления на модели начинаются только здесь:
+    потоки torch родителя в fork не переносятся.
+    """
+    profiler.install_signal_handler()
+    reports.put((os.getpid(), None))
+    torch.set_num_threads(threads)
+    _worker_ai._prepare_prefix_cache()
+    _worker_ai.ready.set()
+    reports.put((os.getpid(), True))
+
+def _ping_worker() -> int:
+    """Пустой вызов для запуска процессов пула"""
+    return os.getpid()
+
+def _call_worker_ai(method: str, args: tuple, kwargs: dict):
+    """Вызов метода AIManager внутри рабочего процесса"""
+    return getattr(_worker_ai, method)(*args, **kwargs)
+
+class HashRing:
+    """Консистентное хеширование ключей (chat_id) по шардам"""
+    
+    def __init__(self, shards: int, replicas: int = 64):
+        # Стабильный хеш (не hash()): одинаковое распределение во всех процессах и после перезапуска
+        self._ring = sorted(
+            (self._hash(f"{shard}:{replica}"), shard)
+            for shard in range(shards) for replica in range(replicas)
+        )
+        self._points = [point for point, _ in self._ring]
+    
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+    
+    def shard_for(self, key) -> int:
+        """Шард, владеющий ключом"""
+        index = bisect.bisect(self._points, self._hash(str(key))) % len(self._ring)
+        return self._ring[index][1]
+
+class InferenceExecutor:
+    """Пул исполнителей для генерации ответов вне цикла событий"""
+    
+    def __init__(self, ai: AIManager, mode: str = INFERENCE_MODE, workers: int = INFERENCE_WORKERS,
+                 queue_size: int = INFERENCE_QUEUE_SIZE, timeout: float = INFERENCE_TIMEOUT,
+                 shared_weights: bool = SHARED_WEIGHTS):
+        self.ai = ai
+        self.mode = mode
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.pending = 0  # Запросы в очереди и в работе
+        self._lock = threading.Lock()
+        self.shards: List[ProcessPoolExecutor] = []
+        self.ring: Optional[HashRing] = None
+        self.shared_weights = shared_weights and mode in ('process', 'sharded')
+        self._reports = None  # Отчеты инициализаторов рабочих процессов
+        if mode in ('process', 'sharded'):
+            # Очередь spawn передается и процессам fork, наоборот — нельзя
+            self._reports = multiprocessing.get_context('spawn').SimpleQueue()
+        self._loading_pool: Optional[ThreadPoolExecutor] = None
+        self._workers_started = threading.Event()  # Все рабочие процессы запущены и загрузили модель
+        self._starter: Optional[threading.Thread] = None
+        self._worker_state: Dict[int, Optional[bool]] = {}  # {PID: загружена ли модель; None — загружается}
+        
+        if mode not in ('thread', 'process', 'sharded'):
+            raise ValueError(f"Неизвестный режим инференса: {mode}")
+        
+        if mode == 'thread':
+            self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='inference')
+        elif self.shared_weights:
+            # Пока веса грузятся, запросы идут в незагруженный AIManager родителя и получают запасной ответ
+            self.pool = None
+            self._loading_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='inference-loading')
+            self._starter = threading.Thread(target=self._load_and_fork, name='model-loader', daemon=True)
+            self._starter.start()
+        else:
+            self._start_process_pools()
+            self._starter = threading.Thread(target=self._warm_up, name='inference-warmup', daemon=True)
+            self._starter.start()
+        
+        if mode != 'thread':
+            threading.Thread(target=self._watch_workers, name='inference-reports', daemon=True).start()
+        
+        logger.info(f"Пул инференса: {mode}, воркеров: {workers}, очередь: {queue_size}"
+                    f"{', общие веса' if self.shared_weights else ''}")
+    
+    def _start_process_pools(self):
+        if self.mode == 'process':
+            self.pool = self._process_pool(self.workers)
+        else:
+            # Каждый чат закреплен за одним процессом: его KV-кэш остается локальным,
+            # а запросы чата выполняются по порядку
+            self.pool = None
+            self.shards = [self._process_pool(1) for _ in range(self.workers)]
+            self.ring = HashRing(self.workers)
+    
+    def _process_pool(self, workers: int) -> ProcessPoolExecutor:
+        if self.shared_weights:
+            # fork после загрузки: процессы разделяют страницы весов родителя
+            return ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('fork'),
+                initializer=_init_forked_worker,
+                initargs=(max(1, (os.cpu_count() or 1) // self.workers), self._reports)
+            )
+        # spawn: рабочие процессы не наследуют состояние потоков torch родителя
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_inference_worker,
+            initargs=(self._reports,)
+        )
+    
+    def _load_and_fork(self):
+        """Однократная загрузка весов и запуск рабочих процессов fork"""
+        global _worker_ai
+        try:
+            _import_ml()
+            if _resolve_device(self.ai.device_name).type == 'cpu':
+                self.ai.load_weights()
+                _worker_ai = self.ai
+            else:
+                # CUDA не переживает fork: каждый процесс загружает свою копию
+                logger.warning("Общие веса поддерживаются только на CPU, процессы загрузят модель сами")
+                self.shared_weights = False
+            
+            self._start_process_pools()
+        except Exception as e:
+            logger.error(f"Ошибка запуска процессов инференса: {e}")
+            return
+        
+        # Процессы запускаются сейчас, из этого потока, а не при первом сообщении
+        self._warm_up()
+        # Запросы переходят в процессы, когда все они отчитались о загрузке
+        self._workers_started.wait()
+        self._loading_pool.shutdown(wait=False)
+    
+    def _warm_up(self):
+        """Запуск всех рабочих процессов при старте; о загрузке модели каждый отчитывается сам"""
+        pools = self.shards or [self.pool]
+        try:
+            # Пул создает новый процесс на каждую задачу, пока свободных нет: по пингу на процесс
+            for pool in pools:
+                for _ in range(self.workers // len(pools)):
+                    pool.submit(_ping_worker)
+        except Exception as e:
+            logger.error(f"Ошибка запуска процессов инференса: {e}")
+    
+    def _watch_workers(self):
+        """Прием отчетов инициализаторов; готовность — когда модель загрузили все процессы"""
+        while True:
+            report = self._reports.get()
+            if report is None:
+                return
+            pid, loaded = report
+            self._worker_state[pid] = loaded
+            if loaded is False:
+                logger.error(f"Модель не загрузилась в рабочем процессе {pid}, используются запасные ответы")
+            elif loaded and not self._workers_started.is_set() and \
+                    sum(state is True for state in self._worker_state.values()) >= self.workers:
+                self._workers_started.set()
+                logger.info("Рабочие процессы инференса запущены")
+    
+    def is_ready(self) -> bool:
+        """Готовность генерировать ответы моделью"""
+        if self.mode == 'thread':
+            return self.ai.ready.is_set()
+        return self._workers_started.is_set()
+    
+    def worker_pids(self) -> List[int]:
+        """PID живых рабочих процессов, уже установивших обработчик SIGUSR1 (пусто в режиме thread)"""
+        pools = self.shards or [self.pool]
+        return [pid for pool in pools if isinstance(pool, ProcessPoolExecutor)
+                for pid in list(pool._processes or {}) if pid in self._worker_state]
+    
+    def shard_for(self, chat_id: Optional[str]) -> Optional[int]:
+        """Шард чата (None вне режима sharded)"""
+        if self.ring is None:
+            return None
+        return self.ring.shard_for(chat_id)
+    
+    def submit(self, method: str, *args, **kwargs):
+        """Отправка вызова метода AIManager в пул, возвращает concurrent.futures.Future"""
+        if self._loading_pool is not None and not self._workers_started.is_set():
+            return self._loading_pool.submit(getattr(self.ai, method), *args, **kwargs)
+        if self.mode == 'sharded':
+            return self.submit_to(self.shard_for(kwargs.get('chat_id')), method, *args, **kwargs)
+        if self.mode == 'process':
+            try:
+                return self.pool.submit(_call_worker_ai, method, args, kwargs)
+            except BrokenProcessPool:
+                # Упавший рабочий процесс (например, по нехватке памяти) ломает весь пул: он поднимается заново
+                logger.error("Рабочий процесс инференса завершился аварийно, перезапуск пула")
+                self.pool = self._process_pool(self.workers)
+                return self.pool.submit(_call_worker_ai, method, args, kwargs)
+        return self.pool.submit(getattr(self.ai, method), *args, **kwargs)
+    
+    def submit_to(self, shard: int, method: str, *args, **kwargs):
+        """Отправка вызова в процесс конкретного шарда"""
+        try:
+            return self.shards[shard].submit(_call_worker_ai, method, args, kwargs)
+        except BrokenProcessPool:
+            # Упавший процесс шарда поднимается заново; его KV-кэши потеряны, но не нужны для корректности
+            logger.error(f"Процесс шарда {shard} завершился аварийно, перезапуск")
+            self.shards[shard] = self._process_pool(1)
+            return self.shards[shard].submit(_call_worker_ai, method, args, kwargs)
+    
+    def _release(self, _future):
+        with self._lock:
+            self.pending -= 1
+    
+    async def generate(self, user_message: str, chat_history: List[str],
+                       empathy_level: int, emotion: str, scenario: str,
+                       chat_id: Optional[str] = None,
+                       on_text: Optional[Callable[[str], None]] = None,
+                       cancel: Optional[threading.Event] = None) -> str:
+        """Генерация ответа в пуле с ограничением очереди и таймаутом
+        
+        on_text (только режим thread) получает фрагменты текста из потока генерации,
+        cancel (только режим thread) обрывает генерацию.
+        """
+        with self._lock:
+            if self.pending >= self.queue_size:
+                logger.warning("Очередь инференса переполнена, используется запасной ответ")
+                return self.ai._fallback_response(user_message, empathy_level, emotion)
+            self.pending += 1
+        
+        try:
+            future = self.submit(
+                'generate_odanna_response',
+                user_message=user_message,
+                chat_history=chat_history,
+                empathy_level=empathy_level,
+                emotion=emotion,
+                scenario=scenario,
+                chat_id=chat_id,
+                on_text=on_text if self.mode == 'thread' else None,
+                cancel=cancel if self.mode == 'thread' else None
+            )
+        except Exception as e:
+            # Пул остановлен или сломан: запрос не попал в очередь, место освобождается сразу
+            self._release(None)
+            logger.error(f"Ошибка отправки в пул инференса: {e}")
+            return self.ai._fallback_response(user_message, empathy_level, emotion)
+        # Место в очереди освобождается только когда воркер действительно закончил
+        future.add_done_callback(self._release)
+        
+        try:
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), self.timeout)
+        except asyncio.TimeoutError:
+            future.cancel()  # Сработает, если генерация еще не началась
+            logger.warning(f"Генерация не уложилась в {self.timeout} с, используется запасной ответ")
+        except Exception as e:
+            logger.error(f"Ошибка в пуле инференса: {e}")
+        
+        return self.ai._fallback_response(user_message, empathy_level, emotion)
+    
+    def invalidate_chat(self, chat_id: str):
+        """Сброс KV-кэша чата"""
+        if self.mode == 'sharded':
+            self.submit('invalidate_chat', chat_id=chat_id)
+        elif self.mode == 'process':
+            # Кэш живет в одном из процессов; корректность обеспечивает сверка токенов в KVCachePool
+            self.submit('invalidate_chat', chat_id)
+        else:
+            self.ai.invalidate_chat(chat_id)
+    
+    def shutdown(self):
+        """Остановка пула"""
+        for pool in self.shards + [self.pool, self._loading_pool]:
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+        if self._reports is not None:
+            self._reports.put(None)
+
+class BatchMetrics:
+    """Метрики микробатчинга: распределение размеров батчей и ожидание в очереди"""
+    
+    def __init__(self, window: int = 1000):
+        self.batches = 0
+        self.requests = 0
+        self.batch_sizes: Dict[int, int] = {}  # {размер батча: количество}
+        self.queue_waits = deque(maxlen=window)  # Последние ожидания в очереди, с
+    
+    def record(self, queue_waits: List[float]):
+        """Учет отправленного батча"""
+        size = len(queue_waits)
+        self.batches += 1
+        self.requests += size
+        self.batch_sizes[size] = self.batch_sizes.get(size, 0) + 1
+        self.queue_waits.extend(queue_waits)
+    
+    def snapshot(self) -> Dict:
+        """Сводка метрик"""
+        waits = sorted(self.queue_waits)
+        
+        def percentile(p: float) -> float:
+            if not waits:
+                return 0.0
+            return waits[min(len(waits) - 1, int(p * len(waits)))] * 1000
+        
+        return {
+            'batches': self.batches,
+            'requests': self.requests,
+            'avg_batch_size': self.requests / self.batches if self.batches else 0.0,
+            'batch_sizes': dict(sorted(self.batch_sizes.items())),
+            'queue_wait_p50_ms': percentile(0.5),
+            'queue_wait_p95_ms': percentile(0.95),
+            'queue_wait_max_ms': waits[-1] * 1000 if waits else 0.0
+        }
+
+class Histogram:
+    """Гистограмма Prometheus с фиксированными границами корзин"""
+    
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Последняя корзина — +Inf
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+    
+    def render(self, name: str, labels: str) -> List[str]:
+        """Строки текстового формата Prometheus"""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+class Metrics:
+    """Метрики процесса для /metrics: задержки этапов, токены, источники ответов, очереди
+    
+    Выключены по умолчанию: тогда этапы не замеряются, а вызовы записи сразу возвращаются.
+    В режимах process и sharded токены и этапы генерации считаются в рабочих процессах и сюда не попадают.
+    """
+    
+    LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    TOKEN_BUCKETS = (8, 16, 32, 64, 128, 256, 512, 1024, 2048)
+    
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._stages: Dict[str, Histogram] = {}
+        self._db: Dict[str, Histogram] = {}
+        self._tokens: Dict[str, Histogram] = {}
+        self._responses: Dict[str, int] = {}
+        self._gauges: Dict[str, Tuple[str, Callable[[], float]]] = {}
+    
+    def enable(self):
+        """Включение замеров этапов"""
+        if not self.enabled:
+            self.enabled = True
+            STAGE_OBSERVERS.append(self.observe_stage)
+    
+    def disable(self):
+        """Выключение замеров; накопленные значения сохраняются"""
+        if self.enabled:
+            self.enabled = False
+            STAGE_OBSERVERS.remove(self.observe_stage)
+    
+    def _observe(self, histograms: Dict[str, Histogram], key: str, value: float, buckets: Tuple):
+        with self._lock:
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+    
+    def observe_stage(self, name: str, seconds: float):
+        """Наблюдатель STAGE_OBSERVERS: этапы базы данных — отдельной метрикой"""
+        if name.startswith('db.'):
+            self._observe(self._db, name[3:], seconds, self.LATENCY_BUCKETS)
+        else:
+            self._observe(self._stages, name, seconds, self.LATENCY_BUCKETS)
+    
+    def observe_tokens(self, kind: str, count: int):
+        """Число токенов запроса: prompt или generated"""
+        if self.enabled:
+            self._observe(self._tokens, kind, count, self.TOKEN_BUCKETS)
+    
+    def count_response(self, source: str):
+        """Источник ответа: model, cache или fallback"""
+        if self.enabled:
+            with self._lock:
+                self._responses[source] = self._responses.get(source, 0) + 1
+    
+    def gauge(self, name: str, help_text: str, read: Callable[[], float]):
+        """Показатель, читаемый в момент запроса /metrics"""
+        self._gauges[name] = (help_text, read)
+    
+    def render(self) -> str:
+        """Текстовый формат Prometheus"""
+        lines = []
+        with self._lock:
+            for name, help_text, label, histograms in (
+                ('odanna_stage_seconds', "Длительность этапа обработки сообщения", 'stage', self._stages),
+                ('odanna_db_seconds', "Длительность операции DatabaseManager", 'method', self._db),
+                ('odanna_tokens', "Токенов в промпте и в ответе", 'kind', self._tokens)
+            ):
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+                for key, histogram in sorted(histograms.items()):
+                    lines += histogram.render(name, f'{label}="{key}"')
+            
+            lines += ['# HELP odanna_responses_total Ответов по источнику', '# TYPE odanna_responses_total counter']
+            lines += [f'odanna_responses_total{{source="{source}"}} {count}'
+                      for source, count in sorted(self._responses.items())]
+        
+        for name, (help_text, read) in sorted(self._gauges.items()):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {read()}']
+        return "\n".join(lines) + "\n"
+
+# Метрики процесса; включаются при METRICS=1
+metrics = Metrics()
+
+class GenerationProfiler:
+    """Профилирование генерации под реальной нагрузкой
+    
+    Включенный профилировщик снимает профиль доли sample_rate генераций: cProfile
+    (.prof, смотреть в snakeviz или pstats) или torch.profiler (.json, chrome://tracing)
+    с разметкой этапов context, generate и post_process. Файлы ротируются. Независимо
+    от профилирования генерации дольше slow_ms пишутся в slow.log.
+    """
+    
+    KINDS = ('cprofile', 'torch')
+    
+    def __init__(self, enabled: bool = PROFILE, sample_rate: float = PROFILE_SAMPLE_RATE, kind: str = PROFILE_KIND,
+                 directory: str = PROFILE_DIR, max_files: int = PROFILE_MAX_FILES, slow_ms: float = SLOW_LOG_MS):
+        if kind not in self.KINDS:
+            raise ValueError(f"Неизвестный профилировщик: {kind}")
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.kind = kind
+        self.directory = directory
+        self.max_files = max_files
+        self.slow_ms = slow_ms
+        self.captured = 0
+        # Профилировщики Python и torch глобальны: одновременно снимается один профиль
+        self._busy = threading.Lock()
+        self._local = threading.local()
+        self._slow_log: Optional[logging.Logger] = None
+        self._workers: Optional[Callable[[], List[int]]] = None  # PID рабочих процессов инференса
+    
+    def toggle(self) -> bool:
+        self.enabled = not self.enabled
+        logger.info(f"Профилирование генерации {'включено' if self.enabled else 'выключено'}")
+        return self.enabled
+    
+    def install_signal_handler(self, workers: Optional[Callable[[], List[int]]] = None):
+        """SIGUSR1 переключает профилирование; workers — PID процессов, которым сигнал передается дальше"""
+        self._workers = workers
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self._on_signal())
+    
+    def _on_signal(self):
+        self.toggle()
+        self.signal_workers()
+    
+    def signal_workers(self):
+        """Переключение профилирования в рабочих процессах инференса"""
+        if self._workers is None or not hasattr(signal, 'SIGUSR1'):
+            return
+        for pid in self._workers():
+            try:
+                os.kill(pid, signal.SIGUSR1)
+            except ProcessLookupError:
+                pass  # Процесс уже завершился
+    
+    @contextmanager
+    def session(self, label: str):
+        """Профиль одной генерации, если она попала в выборку"""
+        if not self.enabled or random.random() >= self.sample_rate or not self._busy.acquire(blocking=False):
+            yield
+            return
+        try:
+            if self.kind == 'torch':
+                activities = [torch.profiler.ProfilerActivity.CPU]
+                if torch.cuda.is_available():
+                    activities.append(torch.profiler.ProfilerActivity.CUDA)
+                with torch.profiler.profile(activities=activities) as trace:
+                    self._local.torch_active = True
+                    try:
+                        yield
+                    finally:
+                        self._local.torch_active = False
+                trace.export_chrome_trace(self._next_path(label, 'json'))
+            else:
+                profile = cProfile.Profile()
+                profile.enable()
+                try:
+                    yield
+                finally:
+                    profile.disable()
+                profile.dump_stats(self._next_path(label, 'prof'))
+            self._rotate()
+        finally:
+            self._busy.release()
+    
+    def region(self, name: str):
+        """Именованный участок в трассе torch.profiler"""
+        if getattr(self._local, 'torch_active', False):
+            return torch.profiler.record_function(name)
+        return _NO_STAGE
+    
+    def _next_path(self, label: str, extension: str) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        self.captured += 1
+        return os.path.join(self.directory, f"{label}-{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}-{self.captured}.{extension}")
+    
+    def _rotate(self):
+        """Удаление самых старых профилей сверх max_files"""
+        profiles = sorted(
+            (entry for entry in os.scandir(self.directory) if entry.name.endswith(('.prof', '.json'))),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        for entry in profiles[:max(0, len(profiles) - self.max_files)]:
+            os.unlink(entry.path)
+    
+    def log_slow(self, elapsed_ms: float, entry: Dict):
+        """Запись о медленной генерации в slow.log (JSON на строку)"""
+        if not self.slow_ms or elapsed_ms < self.slow_ms:
+            return
+        if self._slow_log is None:
+            os.makedirs(self.directory, exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(
+                os.path.join(self.directory, 'slow.log'), maxBytes=10 * 2**20, backupCount=3, encoding='utf-8'
+            )
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self._slow_log = logging.getLogger(f'{__name__}.slow')
+            self._slow_log.addHandler(handler)
+            self._slow_log.setLevel(logging.INFO)
+            self._slow_log.propagate = False
+        self._slow_log.info(json.dumps(dict(time=datetime.now().isoformat(timespec='milliseconds'),
+                                            elapsed_ms=round(elapsed_ms, 1), **entry), ensure_ascii=False))
+        logger.warning(f"Медленная генерация: {elapsed_ms:.0f} мс")
+
+# Профилировщик генерации процесса
+profiler = GenerationProfiler()
+
+class BatchScheduler:
+    """Динамический микробатчинг запросов генерации перед пулом инференса"""
+    
+    def __init__(self, executor: InferenceExecutor, max_batch: int = BATCH_MAX_SIZE,
+                 max_wait_ms: float = BATCH_MAX_WAIT_MS, workers: int = INFERENCE_WORKERS,
+                 log_every: int = 100):
+        self.executor = executor
+        self.ai = executor.ai
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.log_every = log_every
+        self.metrics = BatchMetrics()
+        self._pending: List[Tuple[Dict, asyncio.Future, float]] = []
+        self._in_flight = 0  # Запросы в отправленных батчах
+        self._wakeup: Optional[asyncio.Event] = None
+        self._free_workers: Optional[asyncio.Semaphore] = None
+        self._workers = workers
+        self._collector: Optional[asyncio.Task] = None
+    
+    def queue_depth(self) -> int:
+        """Запросов в ожидании батча и в отправленных батчах"""
+        return len(self._pending) + self._in_flight
+    
+    def _ensure_started(self):
+        if self._collector is None:
+            self._wakeup = asyncio.Event()
+            self._free_workers = asyncio.Semaphore(self._workers)
+            self._collector = asyncio.get_running_loop().create_task(self._collect())
+    
+    async def generate(self, user_message: str, chat_history: List[str],
+                       empathy_level: int, emotion: str, scenario: str,
+                       chat_id: Optional[str] = None,
+                       on_text: Optional[Callable[[str], None]] = None,
+                       cancel: Optional[threading.Event] = None) -> str:
+        """Постановка запроса в батч и ожидание его ответа
+        
+        Только в режиме thread: on_text получает фрагменты ответа из потока генерации,
+        cancel обрывает генерацию, если отменены все запросы батча.
+        """
+        self._ensure_started()
+        
+        if len(self._pending) + self._in_flight >= self.executor.queue_size:
+            logger.warning("Очередь батчинга переполнена, используется запасной ответ")
+            return self.ai._fallback_response(user_message, empathy_level, emotion)
+        
+        request = {
+            'user_message': user_message,
+            'chat_history': chat_history,
+            'empathy_level': empathy_level,
+            'emotion': emotion,
+            'scenario': scenario,
+            'chat_id': chat_id
+        }
+        if self.executor.mode == 'thread':
+            # Callback и событие не передаются в другие процессы
+            request['on_text'] = on_text
+            request['cancel'] = cancel
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((request, future, time.monotonic()))
+        self._wakeup.set()
+        
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.executor.timeout)
+        except asyncio.CancelledError:
+            # Запрос, еще не попавший в батч, больше не генерируется
+            self._drop_pending(future)
+            raise
+        except asyncio.TimeoutError:
+            # Ответ уже не нужен: запрос не должен занимать место в следующем батче
+            self._drop_pending(future)
+            logger.warning(f"Генерация не уложилась в {self.executor.timeout} с, используется запасной ответ")
+        except Exception as e:
+            logger.error(f"Ошибка батчевой генерации: {e}")
+        
+        return self.ai._fallback_response(user_message, empathy_level, emotion)
+    
+    def _drop_pending(self, future: asyncio.Future):
+        """Удаление запроса, еще не попавшего в батч"""
+        self._pending = [entry for entry in self._pending if entry[1] is not future]
+    
+    def invalidate_chat(self, chat_id: str):
+        """Сброс KV-кэша чата"""
+        self.executor.invalidate_chat(chat_id)
+    
+    async def _collect(self):
+        """Сбор батчей: ждем первый запрос, затем добираем до max_batch не дольше max_wait"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wakeup.wait()
+            # Пока все воркеры заняты, запросы копятся и следующий батч будет больше
+            await self._free_workers.acquire()
+            
+            deadline = loop.time() + self.max_wait
+            while len(self._pending) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            
+            batch = self._pending[:self.max_batch]
+            self._pending = self._pending[self.max_batch:]
+            if self._pending:
+                self._wakeup.set()
+            else:
+                self._wakeup.clear()
+            
+            if not batch:
+                # Все ожидавшие запросы отменены
+                self._free_workers.release()
+                continue
+            loop.create_task(self._run_batch(batch))
+    
+    async def _run_batch(self, batch: List[Tuple[Dict, asyncio.Future, float]]):
+        """Выполнение батча в пуле и раздача ответов ожидающим обработчикам"""
+        now = time.monotonic()
+        self.metrics.record([now - enqueued for _, _, enqueued in batch])
+        if self.metrics.batches % self.log_every == 0:
+            logger.info(f"Метрики батчинга: {self.metrics.snapshot()}")
+        
+        self._in_flight += len(batch)
+        try:
+            responses = await self._generate_batch([request for request, _, _ in batch])
+        except Exception as e:
+            logger.error(f"Ошибка в пуле инференса: {e}")
+            responses = [
+                self.ai._fallback_response(r['user_message'], r['empathy_level'], r['emotion'])
+                for r, _, _ in batch
+            ]
+        finally:
+            self._in_flight -= len(batch)
+            self._free_workers.release()
+        
+        for (_, future, _), response in zip(batch, responses):
+            if not future.done():
+                future.set_result(response)
+    
+    async def _generate_batch(self, requests: List[Dict]) -> List[str]:
+        """Генерация батча; в режиме sharded батч делится по шардам чатов"""
+        if self.executor.ring is None:
+            return await asyncio.wrap_future(self.executor.submit('generate_odanna_batch', requests))
+        
+        groups: Dict[int, List[int]] = {}
+        for i, request in enumerate(requests):
+            groups.setdefault(self.executor.shard_for(request['chat_id']), []).append(i)
+        results = await asyncio.gather(*[
+            asyncio.wrap_future(self.executor.submit_to(
+                shard, 'generate_odanna_batch', [requests[i] for i in indexes]
+            ))
+            for shard, indexes in groups.items()
+        ])
+        
+        responses: List[Optional[str]] = [None] * len(requests)
+        for indexes, group_responses in zip(groups.values(), results):
+            for i, response in zip(indexes, group_responses):
+                responses[i] = response
+        return responses
+
+class AdmissionController:
+    """Допуск запросов к генерации перед пулом инференса
+    
+    Каждая генерация списывает токен из корзины пользователя (user_rate_per_min в минуту,
+    запас burst). Одновременно генерируется не больше capacity запросов, остальные ждут
+    допуска с приоритетом: первыми идут пользователи с большим остатком токенов, то есть
+    писавшие реже. Пустая корзина, переполненная очередь или истекшее ожидание — отказ,
+    и бот отвечает запасной репликой. Методы вызываются только из цикла событий.
+    """
+    
+    def __init__(self, capacity: int = ADMISSION_CONCURRENCY, queue_limit: int = ADMISSION_QUEUE,
+                 wait: float = ADMISSION_WAIT, rate: int = ADMISSION_RATE,
+                 user_rate_per_min: float = USER_RATE_PER_MIN, user_burst: int = USER_BURST,
+                 max_users: int = 100000):
+        self.capacity = capacity
+        self.queue_limit = queue_limit
+        self.wait = wait
+        self.user_rate = user_rate_per_min / 60
+        self.user_burst = user_burst
+        self.max_users = max_users
+        self.active = 0  # Допущенные генерации
+        self.waiting = 0  # Ожидающие допуска
+        self.rejected = 0
+        self._waiters: List[Tuple[float, int, asyncio.Future]] = []  # Куча (приоритет, порядок, future)
+        self._sequence = 0
+        self._buckets: OrderedDict = OrderedDict()  # {user_id: (токены, время обновления)}
+        # Общий темп запуска генераций сглаживает всплески сверх capacity
+        self._throttler = Throttler(rate_limit=rate) if rate > 0 else None
+    
+    def _take_token(self, user_id: int) -> Optional[float]:
+        """Списание токена пользователя; остаток токенов или None, если корзина пуста"""
+        if self.user_rate <= 0:
+            return float(self.user_burst)
+        
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(user_id, (float(self.user_burst), now))
+        tokens = min(float(self.user_burst), tokens + (now - updated) * self.user_rate)
+        admitted = tokens >= 1
+        if admitted:
+            tokens -= 1
+        self._buckets[user_id] = (tokens, now)
+        if len(self._buckets) > self.max_users:
+            # Давно не писавшие пользователи начнут с полной корзиной
+            self._buckets.popitem(last=False)
+        return tokens if admitted else None
+    
+    def _reject(self, reason: str) -> bool:
+        self.rejected += 1
+        logger.debug(f"Генерация не допущена: {reason}")
+        return False
+    
+    async def acquire(self, user_id: int) -> bool:
+        """Ожидание допуска; False — отвечать запасной репликой"""
+        remaining = self._take_token(user_id)
+        if remaining is None:
+            return self._reject(f"лимит пользователя {user_id}")
+        
+        if self.active < self.capacity and not self.waiting:
+            self.active += 1
+        else:
+            if self.waiting >= self.queue_limit:
+                return self._reject("очередь переполнена")
+            
+            future = asyncio.get_running_loop().create_future()
+            self._sequence += 1
+            heapq.heappush(self._waiters, (-remaining, self._sequence, future))
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(asyncio.shield(future), self.wait)
+            except asyncio.TimeoutError:
+                pass
+            except BaseException:
+                # Место, выданное одновременно с отменой, возвращается следующему
+                if not future.cancel():
+                    self.release()
+                raise
+            finally:
+                self.waiting -= 1
+            # cancel() не срабатывает, если место уже выдано
+            if future.cancel():
+                return self._reject(f"ожидание дольше {self.wait} с")
+        
+        if self._throttler is not None:
+            try:
+                await self._throttler.acquire()
+            except BaseException:
+                # Отмена во время ожидания темпа: место уже занято и должно вернуться
+                self.release()
+                raise
+        return True
+    
+    def release(self):
+        """Освобождение места: оно переходит к ожидающему с наивысшим приоритетом"""
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(True)
+                return
+        self.active -= 1
+    
+    @asynccontextmanager
+    async def admit(self, user_id: int) -> AsyncIterator[bool]:
+        """Место для генерации на время блока; внутри — допущен ли запрос"""
+        admitted = await self.acquire(user_id)
+        try:
+            yield admitted
+        finally:
+            if admitted:
+                self.release()
+
 class OdannaBot:
     """Основной класс бота Оданна"""
     
-    def __init__(self, token: str):
+    def __init__(self, token: str, db_path: str = DB_PATH, ai: Optional[AIManager] = None):
         self.token = token
-        self.db = DatabaseManager(DB_PATH)
-        self.ai = AIManager()
-        self.current_chats = {}  # {user_id: current_chat_id}
+        self.db = DatabaseManager(db_path)
+        # Обработчики обращаются к базе только через поток базы данных
+        self.storage = AsyncDatabase(self.db)
+        if ai is not None:
+            # Готовый AIManager (бенчмарки, тесты)
+            self.ai = ai
+        else:
+            # В режимах process и sharded модель загружается только в рабочих процессах
+            self.ai = AIManager(preload=False)
+            if INFERENCE_MODE == 'thread':
+                # Бот отвечает сразу: меню и запасные ответы работают, пока модель загружается
+                self.ai.load_in_background()
+        self.inference = InferenceExecutor(self.ai)
+        # Генератор ответов: микробатчинг поверх пула или пул напрямую
+        self.generator = BatchScheduler(self.inference) if BATCH_MAX_SIZE > 1 else self.inference
+        # Лимиты пользователей и общий лимит генераций перед пулом
+        self.admission = AdmissionController()
+        # Забытые/восстановленные сообщения и удаленные чаты сбрасывают KV-кэш чата
+        self.db.history_listeners.append(self.generator.invalidate_chat)
+        self.current_chats = CurrentChatCache()  # Кэш над таблицей user_state
+        self._user_locks: Dict[int, asyncio.Lock] = {}  # Порядок сообщений одного пользователя
+        self._lock_users: Dict[int, int] = {}  # Обработчики, ждущие или держащие блокировку пользователя
+        self._pending_updates: Dict[int, List[Update]] = {}  # Сообщения, ждущие обработки
+        self._generations: Dict[int, Tuple[threading.Event, asyncio.Future]] = {}  # Генерации в работе
+        self.debounce = MESSAGE_DEBOUNCE_MS / 1000
+        if METRICS:
+            self._register_metrics()
+    
+    def _register_metrics(self):
+        """Включение метрик и показателей очередей для /metrics"""
+        metrics.enable()
+        metrics.gauge('odanna_inference_queue_depth', "Запросов в пуле инференса", lambda: self.inference.pending)
+        metrics.gauge('odanna_db_queue_depth', "Операций в очереди базы данных", self.storage.queue_depth)
+        if isinstance(self.generator, BatchScheduler):
+            metrics.gauge('odanna_batch_queue_depth', "Запросов в микробатчинге", self.generator.queue_depth)
+        metrics.gauge('odanna_admission_active', "Допущенных генераций", lambda: self.admission.active)
+        metrics.gauge('odanna_admission_queue_depth', "Ожидающих допуска", lambda: self.admission.waiting)
+        metrics.gauge('odanna_model_ready', "Модель загружена", lambda: int(self.is_ready()))
         
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /start"""
         user = update.effective_user
         
         # Добавляем/обновляем пользователя в БД
-        self.db.add_user(
+        await self.storage.add_user(
             user_id=user.id,
             username=user.username,
             first_name=user.first_name,
@@ -596,7 +2722,7 @@ class OdannaBot:
     
     async def _show_chats_list(self, query, user_id: int):
         """Показать список чатов пользователя"""
-        chats = self.db.get_user_chats(user_id)
+        chats = await self.storage.get_user_chats(user_id)
         
         if not chats:
             keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")]]
@@ -637,11 +2763,11 @@ class OdannaBot:
     
     async def _show_settings(self, query, user_id: int):
         """Показать настройки"""
-        current_chat_id = self.current_chats.get(user_id)
+        current_chat_id = await self._get_current_chat(user_id)
         current_empathy = 50
         
         if current_chat_id:
-            current_empathy = self.db.get_chat_empathy_level(current_chat_id)
+            current_empathy = await self.storage.get_chat_empathy_level(current_chat_id)
         
         keyboard = [
             [InlineKeyboardButton(f"😊 Эмпатия: {current_empathy}%", callback_data="empathy_menu")],
@@ -671,8 +2797,8 @@ class OdannaBot:
         """Обработка создания чата"""
         if data == "create_default":
             chat_name = f"Чат от {datetime.now().strftime('%d.%m.%Y %H:%M')}"
-            chat_id = self.db.create_chat(user_id, chat_name)
-            self.current_chats[user_id] = chat_id
+            chat_id = await self.storage.create_chat(user_id, chat_name)
+            await self._set_current_chat(user_id, chat_id)
             
             message = """*Новый чат создан* ✨
 
@@ -692,8 +2818,8 @@ class OdannaBot:
             # Здесь можно добавить форму для создания чата с настройками
             # Пока используем упрощенную версию
             chat_name = f"Чат (настройки) от {datetime.now().strftime('%d.%m.%Y %H:%M')}"
-            chat_id = self.db.create_chat(user_id, chat_name, "Пользовательский сценарий")
-            self.current_chats[user_id] = chat_id
+            chat_id = await self.storage.create_chat(user_id, chat_name, "Пользовательский сценарий")
+            await self._set_current_chat(user_id, chat_id)
             
             message = """*Чат с настройками создан* 🎭
 
@@ -707,15 +2833,25 @@ class OdannaBot:
     
     async def _handle_chat_action(self, query, user_id: int, data: str):
         """Обработка действий с чатами"""
-        parts = data.split('_')
+        # chat_id сам содержит '_' ({user_id}_{дата}_{время})
+        parts = data.split('_', 2)
         action = parts[1]
         chat_id = parts[2] if len(parts) > 2 else None
         
         if action == "select":
-            self.current_chats[user_id] = chat_id
+            # Активным становится только существующий чат пользователя: значение сохраняется в базе
+            if chat_id not in {row[0] for row in await self.storage.get_user_chats(user_id)}:
+                keyboard = [[InlineKeyboardButton("◀️ К списку чатов", callback_data="list_chats")]]
+                await query.edit_message_text(
+                    "*Чат не найден* 🌫\n\n*равнодушно пожимает плечами*",
+                    reply_markup=InlineKeyboardMarkup(keyboard),
+                    parse_mode='Markdown'
+                )
+                return
+            await self._set_current_chat(user_id, chat_id)
             
             # Показываем последние сообщения чата
-            history = self.db.get_chat_history(chat_id, 5)
+            history = await self.storage.get_chat_history(chat_id, 5)
             
             history_text = ""
             for msg_text, response_text, is_ignored, emotion, timestamp in history:
@@ -746,6 +2882,19 @@ class OdannaBot:
                 parse_mode='Markdown'
             )
     
+    async def _get_current_chat(self, user_id: int) -> Optional[str]:
+        """Активный чат пользователя; из базы читается раз в CURRENT_CHAT_TTL"""
+        chat_id = self.current_chats.get(user_id)
+        if chat_id is None:
+            chat_id = await self.storage.get_current_chat(user_id)
+            self.current_chats.put(user_id, chat_id)
+        return chat_id
+    
+    async def _set_current_chat(self, user_id: int, chat_id: str):
+        """Смена активного чата пользователя"""
+        self.current_chats.put(user_id, chat_id)
+        await self.storage.set_current_chat(user_id, chat_id)
+    
     async def _show_main_menu(self, query):
         """Показать главное меню"""
         keyboard = [
@@ -771,39 +2920,109 @@ class OdannaBot:
     
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка обычных сообщений"""
+        user_id = update.effective_user.id
+        # Сообщения, пришедшие во время обработки предыдущего, получат один общий ответ
+        self._pending_updates.setdefault(user_id, []).append(update)
+        in_flight = self._generations.get(user_id)
+        if in_flight is not None:
+            # Ответ на предыдущие сообщения устарел: генерация прерывается, они войдут в новую реплику
+            cancel, generation = in_flight
+            cancel.set()
+            generation.cancel()
+        
+        # Обновления обрабатываются параллельно, но сообщения одного пользователя — по порядку
+        user_lock = self._user_locks.setdefault(user_id, asyncio.Lock())
+        self._lock_users[user_id] = self._lock_users.get(user_id, 0) + 1
+        try:
+            with stage('message'):
+                async with user_lock:
+                    await self._debounce(user_id)
+                    # Пусто — сообщение уже вошло в ответ вместе с более ранним
+                    updates = self._pending_updates.pop(user_id, [])
+                    await self._process_updates(updates, context)
+        finally:
+            self._lock_users[user_id] -= 1
+            if not self._lock_users[user_id] and user_id not in self._pending_updates:
+                # Блокировка больше никому не нужна: словари не растут с числом пользователей
+                del self._lock_users[user_id]
+                del self._user_locks[user_id]
+    
+    async def _debounce(self, user_id: int):
+        """Ожидание паузы в сообщениях пользователя, но не дольше трех окон"""
+        pending = self._pending_updates.get(user_id)
+        if not pending or self.debounce <= 0:
+            return
+        
+        with stage('debounce'):
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + 3 * self.debounce
+            seen = 0
+            while len(pending) != seen and loop.time() < deadline:
+                seen = len(pending)
+                await asyncio.sleep(self.debounce)
+    
+    async def _process_updates(self, updates: List[Update], context: ContextTypes.DEFAULT_TYPE):
+        """Подряд идущие сообщения — одна реплика; команды «забудь» — по отдельности и по порядку"""
+        groups: List[List[Update]] = []
+        for update in updates:
+            forget = update.message.text.lower().startswith('забудь')
+            if forget or not groups or groups[-1][-1].message.text.lower().startswith('забудь'):
+                groups.append([update])
+            else:
+                groups[-1].append(update)
+        
+        for index, group in enumerate(groups):
+            # Ответ — на последнее сообщение группы
+            if not await self._process_message(group[-1], context, "\n".join(u.message.text for u in group)):
+                # Пришло новое сообщение: неотвеченные войдут в следующую реплику вместе с ним
+                user_id = group[-1].effective_user.id
+                unanswered = [u for g in groups[index:] for u in g]
+                self._pending_updates[user_id] = unanswered + self._pending_updates.get(user_id, [])
+                return
+    
+    async def _process_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                               user_message: Optional[str] = None) -> bool:
+        """Обработка сообщения пользователя (user_message — текст объединенных сообщений)
+        
+        False — генерацию вытеснило новое сообщение, ничего не сохранено и не отправлено.
+        """
         user = update.effective_user
-        user_message = update.message.text
+        user_message = user_message if user_message is not None else update.message.text
         user_id = user.id
         
         # Обновляем информацию о пользователе
-        self.db.add_user(
-            user_id=user_id,
-            username=user.username,
-            first_name=user.first_name,
-            last_name=user.last_name
-        )
+        with stage('add_user'):
+            await self.storage.add_user(
+                user_id=user_id,
+                username=user.username,
+                first_name=user.first_name,
+                last_name=user.last_name
+            )
         
         # Проверяем, есть ли активный чат
-        current_chat_id = self.current_chats.get(user_id)
+        with stage('current_chat'):
+            current_chat_id = await self._get_current_chat(user_id)
         if not current_chat_id:
             # Создаем новый чат автоматически
             chat_name = f"Авточат от {datetime.now().strftime('%d.%m.%Y %H:%M')}"
-            current_chat_id = self.db.create_chat(user_id, chat_name)
-            self.current_chats[user_id] = current_chat_id
+            current_chat_id = await self.storage.create_chat(user_id, chat_name)
+            await self._set_current_chat(user_id, current_chat_id)
         
         # Проверяем команды "забыть"
         if user_message.lower().startswith('забудь'):
             await self._handle_forget_command(update, current_chat_id, user_message)
-            return
+            return True
         
         # Анализируем эмоции сообщения
-        emotion = self.ai.analyze_emotion(user_message)
+        with stage('emotion'):
+            emotion = self.ai.analyze_emotion(user_message)
         
-        # Получаем текущий уровень эмпатии
-        current_empathy = self.db.get_chat_empathy_level(current_chat_id)
-        
-        # Получаем историю чата
-        chat_history = self.db.get_chat_history(current_chat_id, 10)
+        with stage('history'):
+            # Получаем текущий уровень эмпатии
+            current_empathy = await self.storage.get_chat_empathy_level(current_chat_id)
+            
+            # Получаем историю чата
+            chat_history = await self.storage.get_chat_history(current_chat_id, 10)
         history_text = []
         for msg_text, response_text, is_ignored, _, _ in chat_history:
             if not is_ignored:
@@ -815,30 +3034,164 @@ class OdannaBot:
         message_count = len(chat_history) + 1
         new_empathy = self.ai.calculate_empathy_level(emotion, current_empathy, message_count)
         
-        # Генерируем ответ
-        response = self.ai.generate_odanna_response(
-            user_message=user_message,
-            chat_history=history_text,
-            empathy_level=new_empathy,
-            emotion=emotion,
-            scenario="Небесная Гостиница"
-        )
-        
-        # Сохраняем сообщение и ответ в БД
-        self.db.add_message(
-            chat_id=current_chat_id,
-            user_id=user_id,
-            message_text=user_message,
-            response_text=response,
-            emotion_analysis=emotion,
-            empathy_level=new_empathy
-        )
+        request = {
+            'user_message': user_message,
+            'chat_history': history_text,
+            'empathy_level': new_empathy,
+            'emotion': emotion,
+            'scenario': "Небесная Гостиница",
+            'chat_id': current_chat_id
+        }
         
-        # Обновляем уровень эмпатии чата
-        self.db.update_chat_empathy(current_chat_id, new_empathy)
+        # Повторяющиеся реплики отвечаются из кэша; пока модель не готова — запасной ответ без очереди
+        response = self.ai.cached_response(request)
+        source = 'cache'
+        streaming = False
+        if response is None and not self.inference.is_ready():
+            response = self.ai._fallback_response(user_message, new_empathy, emotion)
+            source = 'fallback'
+        
+        if response is None:
+            async with self.admission.admit(user_id) as admitted:
+                if not admitted:
+                    # Лимит пользователя или перегрузка: ответ без модели, задержка остальных не растет
+                    response = self.ai._fallback_response(user_message, new_empathy, emotion)
+                    source = 'throttled'
+                else:
+                    # Генерируем ответ в пуле инференса, не блокируя цикл событий
+                    streaming = STREAM_RESPONSES and self.inference.mode == 'thread'
+                    cancel = threading.Event()
+                    with stage('inference'):
+                        if streaming:
+                            # Ответ виден по мере появления токенов; генерация идет в общем батче
+                            generation = asyncio.ensure_future(self._stream_response(update.message, request, cancel))
+                        else:
+                            generation = asyncio.ensure_future(self.generator.generate(**request, cancel=cancel))
+                        # Новое сообщение пользователя отменяет generation (см. handle_message)
+                        self._generations[user_id] = (cancel, generation)
+                        try:
+                            await asyncio.wait({generation})
+                        finally:
+                            del self._generations[user_id]
+                            if not generation.done():
+                                cancel.set()
+                                generation.cancel()
+                    if generation.cancelled():
+                        return False
+                    response = generation.result()
+                    source = 'model' if self.ai.cache_response(request, response) else 'fallback'
+        metrics.count_response(source)
+        
+        with stage('persist'):
+            # Сохраняем сообщение и ответ в БД
+            await self.storage.add_message(
+                chat_id=current_chat_id,
+                user_id=user_id,
+                message_text=user_message,
+                response_text=response,
+                emotion_analysis=emotion,
+                empathy_level=new_empathy
+            )
+            
+            # Обновляем уровень эмпатии чата
+            await self.storage.update_chat_empathy(current_chat_id, new_empathy)
         
         # Отправляем ответ
-        await update.message.reply_text(response, parse_mode='Markdown')
+        if not streaming:
+            with stage('reply'):
+                await update.message.reply_text(response, parse_mode='Markdown')
+        return True
+    
+    async def _stream_response(self, message, request: Dict, cancel: Optional[threading.Event] = None) -> str:
+        """Потоковый ответ: заглушка, затем правки сообщения по мере генерации"""
+        placeholder = await message.reply_text(STREAM_PLACEHOLDER, parse_mode='Markdown')
+        
+        loop = asyncio.get_running_loop()
+        chunks: List[str] = []
+        
+        def on_text(text: str):
+            # Вызывается из потока генерации
+            loop.call_soon_threadsafe(chunks.append, text)
+        
+        generation = asyncio.ensure_future(self.generator.generate(**request, on_text=on_text, cancel=cancel))
+        shown = ""
+        next_edit = loop.time() + STREAM_EDIT_INTERVAL
+        
+        try:
+            while not generation.done():
+                await asyncio.wait({generation}, timeout=max(0.0, next_edit - loop.time()))
+                if generation.done():
+                    break
+                
+                next_edit = loop.time() + STREAM_EDIT_INTERVAL
+                partial = "".join(chunks).strip()
+                if not partial or partial == shown:
+                    continue
+                try:
+                    # Промежуточный текст без Markdown: разметка может быть еще не закрыта
+                    await placeholder.edit_text(partial + " …")
+                    shown = partial
+                except RetryAfter as e:
+                    next_edit = loop.time() + e.retry_after
+                except TelegramError as e:
+                    logger.debug(f"Правка потокового ответа не удалась: {e}")
+            
+            # Итоговый текст — после постобработки
+            response = generation.result()
+            await self._finish_stream(placeholder, response)
+        except asyncio.CancelledError:
+            # Ответ вытеснен новым сообщением (в том числе во время итоговой правки): недописанный текст убирается
+            generation.cancel()
+            try:
+                await placeholder.delete()
+            except TelegramError as e:
+                logger.debug(f"Удаление потокового ответа не удалось: {e}")
+            raise
+        
+        return response
+    
+    async def _finish_stream(self, placeholder, response: str):
+        """Итоговая правка потокового ответа; неразобранная разметка — повтор без Markdown"""
+        parse_mode = 'Markdown'
+        while True:
+            try:
+                await placeholder.edit_text(response, parse_mode=parse_mode)
+                return
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                if parse_mode is None:
+                    logger.warning(f"Итоговая правка потокового ответа не удалась: {e}")
+                    return
+                # Разметка модели может быть незакрытой: текст важнее форматирования
+                logger.debug(f"Markdown ответа не разобран, отправляется без разметки: {e}")
+                parse_mode = None
+    
+    async def profile_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Команда администратора /profile [on|off] [доля запросов]"""
+        if update.effective_user.id not in ADMIN_IDS:
+            return
+        
+        args = context.args or []
+        if args and args[0] in ('on', 'off') and profiler.enabled != (args[0] == 'on'):
+            profiler.toggle()
+            profiler.signal_workers()
+        if len(args) > 1:
+            try:
+                rate = float(args[1])
+            except ValueError:
+                rate = -1.0
+            if not 0.0 < rate <= 1.0:
+                await update.message.reply_text("Доля запросов — число от 0 до 1, например /profile on 0.1")
+                return
+            profiler.sample_rate = rate
+        
+        status = (f"Профилирование: {'включено' if profiler.enabled else 'выключено'}\n"
+                  f"Доля запросов: {profiler.sample_rate:g}, профилировщик: {profiler.kind}\n"
+                  f"Снято профилей: {profiler.captured}, каталог: {profiler.directory}")
+        if self.inference.mode != 'thread':
+            status += f"\nВ рабочих процессах доля запросов — PROFILE_SAMPLE_RATE ({PROFILE_SAMPLE_RATE:g})"
+        await update.message.reply_text(status)
     
     async def _handle_forget_command(self, update: Update, chat_id: str, message: str):
         """Обработка команды забыть сообщение"""
@@ -847,7 +3200,7 @@ class OdannaBot:
         
         if forget_text:
             # Помечаем сообщение как игнорируемое
-            self.db.ignore_message(chat_id, forget_text)
+            await self.storage.ignore_message(chat_id, forget_text)
             
             responses = [
                 "*спокойно кивает* Как пожелаете. Этих слов здесь не было.",
@@ -861,17 +3214,113 @@ class OdannaBot:
         
         await update.message.reply_text(response, parse_mode='Markdown')
     
+    def is_ready(self) -> bool:
+        """Готовность принимать сообщения: модель загружена там, где идет генерация"""
+        return self.inference.is_ready()
+    
+    def _web_app(self, application: Application, webhook: bool = True):
+        """HTTP-приложение: прием вебхуков Telegram, проверки состояния и метрики"""
+        from aiohttp import web  # Нужен только в режиме вебхука или с метриками
+        
+        async def webhook_handler(request: web.Request) -> web.Response:
+            if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+                return web.Response(status=403)
+            try:
+                update = Update.de_json(await request.json(), application.bot)
+            except (ValueError, TypeError, KeyError):
+                return web.Response(status=400)
+            # Ответ Telegram сразу, обработка — в очереди приложения
+            await application.update_queue.put(update)
+            return web.Response()
+        
+        async def healthz(request: web.Request) -> web.Response:
+            return web.json_response({'status': 'ok'})
+        
+        async def readyz(request: web.Request) -> web.Response:
+            ready = self.is_ready()
+            return web.json_response({'ready': ready}, status=200 if ready else 503)
+        
+        async def metrics_handler(request: web.Request) -> web.Response:
+            if not metrics.enabled:
+                return web.Response(status=404)
+            return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+        
+        app = web.Application()
+        if webhook:
+            app.router.add_post(WEBHOOK_PATH, webhook_handler)
+        app.router.add_get('/healthz', healthz)
+        app.router.add_get('/readyz', readyz)
+        app.router.add_get('/metrics', metrics_handler)
+        return app
+    
+    async def _serve_webhook(self, application: Application):
+        """Прием обновлений через вебхук на HOST:PORT"""
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        
+        from aiohttp import web
+        
+        runner = web.AppRunner(self._web_app(application))
+        await runner.setup()
+        async with application:
+            await application.start()
+            await web.TCPSite(runner, HOST, PORT).start()
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=Update.ALL_TYPES
+            )
+            logger.info(f"Вебхук слушает {HOST}:{PORT}{WEBHOOK_PATH}")
+            try:
+                await stop.wait()
+            finally:
+                await runner.cleanup()
+                await application.stop()
+    
+    async def _start_status_server(self, application: Application):
+        """HTTP-сервер проверок состояния и метрик рядом с long polling"""
+        from aiohttp import web
+        
+        self._status_runner = web.AppRunner(self._web_app(application, webhook=False))
+        await self._status_runner.setup()
+        await web.TCPSite(self._status_runner, HOST, PORT).start()
+        logger.info(f"Метрики и проверки состояния на {HOST}:{PORT}")
+    
+    async def _stop_status_server(self, application: Application):
+        await self._status_runner.cleanup()
+    
     def run(self):
         """Запуск бота"""
-        application = Application.builder().token(self.token).build()
+        builder = Application.builder().token(self.token).concurrent_updates(True)
+        if WEBHOOK_URL:
+            # Обновления приходят в HTTP-сервер бота, опрос Telegram не нужен
+            builder = builder.updater(None)
+        elif METRICS:
+            # Без вебхука порт занимает только сервер метрик
+            builder = builder.post_init(self._start_status_server).post_shutdown(self._stop_status_server)
+        application = builder.build()
         
         # Добавляем обработчики
         application.add_handler(CommandHandler("start", self.start_command))
+        application.add_handler(CommandHandler("profile", self.profile_command))
         application.add_handler(CallbackQueryHandler(self.button_callback))
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
         
+        # Сигнал и /profile переключают профилирование и в рабочих процессах
+        profiler.install_signal_handler(self.inference.worker_pids)
+        
         logger.info("Бот Оданна запущен!")
-        application.run_polling()
+        try:
+            if WEBHOOK_URL:
+                asyncio.run(self._serve_webhook(application))
+            else:
+                application.run_polling()
+        finally:
+            self.inference.shutdown()
+            # Отложенные записи сохраняются до выхода
+            self.storage.close()
 
 # Точка входа
 if __name__ == '__main__':
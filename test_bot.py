@@ -9,9 +9,15 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from odanna_bot import DatabaseManager, AIManager, OdannaBot
+from odanna_bot import (DatabaseManager, AsyncDatabase, AIManager, OdannaBot, AdmissionController,
+                        InferenceExecutor, BatchScheduler, KVCachePool, HashRing, ResponseCache,
+                        EmotionAnalyzer, RepetitionStopper, CurrentChatCache, has_repetition_loop,
+                        suppress_repetitions)
+import asyncio
 import sqlite3
 import tempfile
+import threading
+import time
 
 def test_database():
     """Тест базы данных"""
@@ -190,6 +196,1365 @@ def test_empathy_progression():
     
     print("🎉 Тест прогрессии эмпатии пройден!")
 
+def test_inference_executor():
+    """Тест пула инференса"""
+    print("\n⚙️ Тестирование пула инференса...")
+    
+    class SlowAI(AIManager):
+        def generate_odanna_response(self, user_message, chat_history, empathy_level, emotion, scenario, **kwargs):
+            time.sleep(0.3)
+            return f"Ответ: {user_message}"
+    
+    ai = SlowAI(preload=False)
+    
+    async def scenario():
+        executor = InferenceExecutor(ai, mode='thread', workers=2, queue_size=2, timeout=1.0)
+        try:
+            # Два запроса выполняются параллельно, третий не помещается в очередь
+            results = await asyncio.gather(*[
+                executor.generate(f"сообщение {i}", [], 35, "нейтральное", "Небесная Гостиница")
+                for i in range(3)
+            ])
+            assert results[0] == "Ответ: сообщение 0"
+            assert results[1] == "Ответ: сообщение 1"
+            assert results[2] == ai._fallback_response("сообщение 2", 35, "нейтральное")
+            print("✅ Очередь ограничена, переполнение обслуживается запасным ответом")
+            
+            # Таймаут приводит к запасному ответу
+            executor.timeout = 0.05
+            result = await executor.generate("долго", [], 35, "нейтральное", "Небесная Гостиница")
+            assert result == ai._fallback_response("долго", 35, "нейтральное")
+            print("✅ Таймаут генерации обрабатывается")
+        finally:
+            executor.shutdown()
+        
+        # Остановленный пул отвечает запасным ответом и не занимает места в очереди
+        for _ in range(executor.queue_size + 1):
+            result = await executor.generate("после остановки", [], 35, "нейтральное", "Небесная Гостиница")
+            assert result == ai._fallback_response("после остановки", 35, "нейтральное")
+        print("✅ Ошибка отправки в пул не занимает место в очереди")
+    
+    asyncio.run(scenario())
+    
+    # Процессы spawn загружают модель при старте; готовность — по ответам всех процессов
+    import signal
+    from benchmark import _build_stub_model
+    from odanna_bot import GenerationProfiler
+    model_name = os.environ.get('MODEL_NAME')
+    with tempfile.TemporaryDirectory() as model_dir:
+        _build_stub_model(model_dir)
+        for path, loaded in ((model_dir, True), (os.path.join(model_dir, 'missing'), False)):
+            os.environ['MODEL_NAME'] = path
+            executor = InferenceExecutor(ai, mode='process', workers=2)
+            try:
+                assert not executor.is_ready(), "До запуска процессов бот не готов"
+                # Каждый процесс сам сообщает, загрузилась ли в нем модель. Переключение профилирования
+                # во время запуска доходит только до процессов с обработчиком и не убивает остальные
+                forwarder = GenerationProfiler(enabled=False)
+                forwarder._workers = executor.worker_pids
+                deadline = time.monotonic() + 120
+                while sum(state is not None for state in executor._worker_state.values()) < 2 \
+                        and time.monotonic() < deadline:
+                    forwarder.signal_workers()
+                    time.sleep(0.02)
+                assert list(executor._worker_state.values()) == [loaded, loaded], executor._worker_state
+                assert executor._workers_started.wait(5 if loaded else 0.1) == loaded, f"Готовность процессов ({path})"
+                assert len(executor.worker_pids()) == 2
+                if loaded:
+                    # Аварийно завершившийся процесс не оставляет пул сломанным навсегда
+                    os.kill(executor.worker_pids()[0], signal.SIGKILL)
+                    deadline = time.monotonic() + 10
+                    while not executor.pool._broken and time.monotonic() < deadline:
+                        time.sleep(0.05)
+                    assert executor.submit('invalidate_chat', "chat").result(120) is None
+            finally:
+                executor.shutdown()
+                if model_name is None:
+                    os.environ.pop('MODEL_NAME', None)
+                else:
+                    os.environ['MODEL_NAME'] = model_name
+    print("✅ Готовность процессов spawn определяется при старте")
+    print("🎉 Тест пула инференса пройден!")
+
+def test_batch_scheduler():
+    """Тест микробатчинга"""
+    print("\n📦 Тестирование микробатчинга...")
+    
+    class BatchAI(AIManager):
+        def generate_odanna_batch(self, requests):
+            time.sleep(0.05)
+            return [f"Ответ: {r['user_message']}" for r in requests]
+    
+    ai = BatchAI(preload=False)
+    
+    async def scenario():
+        executor = InferenceExecutor(ai, mode='thread', workers=1, queue_size=32, timeout=5.0)
+        scheduler = BatchScheduler(executor, max_batch=4, max_wait_ms=20, workers=1)
+        try:
+            results = await asyncio.gather(*[
+                scheduler.generate(f"сообщение {i}", [], 35, "нейтральное", "Небесная Гостиница")
+                for i in range(10)
+            ])
+        finally:
+            executor.shutdown()
+        
+        # Каждый обработчик получает ответ на свое сообщение
+        assert results == [f"Ответ: сообщение {i}" for i in range(10)]
+        print("✅ Ответы доставлены своим запросам")
+        
+        metrics = scheduler.metrics.snapshot()
+        print(f"✅ Метрики: {metrics}")
+        assert metrics['requests'] == 10
+        assert max(metrics['batch_sizes']) <= 4
+        assert metrics['batches'] < 10, "Запросы должны объединяться в батчи"
+    
+    asyncio.run(scenario())
+    
+    generated = []
+    
+    class SlowBatchAI(AIManager):
+        def generate_odanna_batch(self, requests):
+            generated.extend(r['user_message'] for r in requests)
+            time.sleep(0.2)
+            return [f"Ответ: {r['user_message']}" for r in requests]
+    
+    async def timed_out():
+        executor = InferenceExecutor(SlowBatchAI(preload=False), mode='thread', workers=1, queue_size=32, timeout=0.1)
+        scheduler = BatchScheduler(executor, max_batch=1, max_wait_ms=0, workers=1)
+        try:
+            # Второй запрос ждет батча, пока воркер занят первым, и не дожидается ответа
+            await asyncio.gather(*(scheduler.generate(text, [], 35, "нейтральное", "Небесная Гостиница")
+                                   for text in ("первый", "второй")))
+            await asyncio.sleep(0.3)
+        finally:
+            executor.shutdown()
+        assert generated == ["первый"], f"Запрос с истекшим ожиданием не генерируется: {generated}"
+        assert scheduler.queue_depth() == 0
+    
+    asyncio.run(timed_out())
+    print("✅ Запрос с истекшим ожиданием удаляется из очереди батчинга")
+    print("🎉 Тест микробатчинга пройден!")
+
+def test_kv_cache_pool():
+    """Тест пула KV-кэшей чатов"""
+    print("\n🧮 Тестирование KV-кэшей чатов...")
+    import torch
+    
+    def fake_past(length):
+        # 1 слой, (batch, heads, length, head_dim) float32: 16 байт на токен для ключей и значений
+        return ((torch.zeros(1, 1, length, 2), torch.zeros(1, 1, length, 2)),)
+    
+    pool = KVCachePool(budget_bytes=16 * 25)
+    pool.store("chat_a", list(range(10)), fake_past(10))
+    
+    # Переиспользуется общий префикс, минимум один токен остается для модели
+    past, length = pool.lookup("chat_a", list(range(5)) + [99, 100])
+    assert length == 5 and past[0][0].shape[2] == 5
+    past, length = pool.lookup("chat_a", list(range(10)))
+    assert length == 9
+    print("✅ Общий префикс токенов переиспользуется")
+    
+    # Вытеснение LRU по бюджету памяти
+    pool.store("chat_b", list(range(10)), fake_past(10))
+    pool.lookup("chat_a", list(range(12)))
+    pool.store("chat_c", list(range(10)), fake_past(10))
+    assert pool.lookup("chat_b", list(range(12)))[0] is None
+    assert pool.lookup("chat_a", list(range(12)))[0] is not None
+    assert pool.total_bytes <= pool.budget_bytes
+    print("✅ Давно не использованный чат вытеснен")
+    
+    # Изменение истории в БД сбрасывает кэш чата
+    with tempfile.NamedTemporaryFile(suffix='.db', delete=False) as temp_db:
+        db_path = temp_db.name
+    try:
+        db = DatabaseManager(db_path)
+        db.history_listeners.append(pool.invalidate)
+        db.ignore_message("chat_a", "Привет!")
+        assert pool.lookup("chat_a", list(range(12)))[0] is None
+        print("✅ Забытое сообщение сбрасывает кэш чата")
+    finally:
+        os.unlink(db_path)
+    
+    print("🎉 Тест KV-кэшей пройден!")
+
+def test_cached_generation_equivalence():
+    """Тест совпадения генерации с кэшами и без них на крошечной GPT-2"""
+    print("\n🧪 Тестирование генерации с KV-кэшами...")
+    import odanna_bot
+    from benchmark import _build_stub_model
+    odanna_bot._import_ml()
+    import torch
+    
+    with tempfile.TemporaryDirectory() as model_dir:
+        _build_stub_model(model_dir)
+        ai = AIManager(model_name=model_dir)
+    assert ai.prefix_cache is not None
+    
+    def greedy(input_ids, attention_mask=None, past_key_values=None):
+        with torch.no_grad():
+            outputs = ai.model.generate(input_ids, attention_mask=attention_mask, past_key_values=past_key_values,
+                                        max_new_tokens=8, do_sample=False,
+                                        pad_token_id=ai.tokenizer.pad_token_id, eos_token_id=None)
+        return outputs[:, input_ids.shape[1]:].tolist()
+    
+    def uncached(tail):
+        return greedy(torch.tensor([ai.prefix_ids + tail]))[0]
+    
+    tails = [ai.tokenizer.encode(text) for text in ("\nГость: Привет\nОданна:",
+                                                    "\nГость: Я снова в гостинице и хочу поговорить\nОданна:")]
+    assert len(tails[0]) != len(tails[1]), "Хвосты разной длины: нужен паддинг"
+    
+    # Батч [префикс][паддинг][хвост] с общим кэшем префикса
+    input_ids, attention_mask, past_key_values = ai._prepare_inputs(tails)
+    assert past_key_values is not None
+    assert greedy(input_ids, attention_mask, past_key_values) == [uncached(tail) for tail in tails]
+    print("✅ Батч с кэшем префикса и паддингом совпадает с генерацией без кэша")
+    
+    # KV-кэш чата: первое сообщение, затем продолжение того же контекста
+    longer = tails[0] + ai.tokenizer.encode(" Добро пожаловать.\nГость: Спасибо\nОданна:")
+    for tail in (tails[0], longer):
+        hits = ai.kv_pool.hits
+        input_ids, attention_mask, past_key_values = ai._prepare_chat_inputs("chat", tail, None)
+        assert greedy(input_ids, attention_mask, past_key_values)[0] == uncached(tail)
+    assert ai.kv_pool.hits == hits + 1, "Второй вызов продолжает закэшированный контекст"
+    
+    # В пуле только часть после системного промпта
+    entry = ai.kv_pool._entries["chat"]
+    assert entry.token_ids == longer[:-1]
+    assert all(tensor.shape[2] == len(longer) - 1 for layer in entry.past_key_values for tensor in layer)
+    print("✅ KV-кэш чата совпадает с генерацией без кэша и хранит только хвост контекста")
+    
+    print("🎉 Тест генерации с KV-кэшами пройден!")
+
+def test_context_budget():
+    """Тест сборки контекста по бюджету токенов"""
+    print("\n📏 Тестирование бюджета контекста...")
+    from types import SimpleNamespace
+    
+    class CharTokenizer:
+        """Один символ — один токен"""
+        def __init__(self):
+            self.calls = 0
+        
+        def encode(self, text):
+            self.calls += 1
+            return [ord(c) for c in text]
+    
+    ai = AIManager(preload=False)
+    ai.tokenizer = CharTokenizer()
+    ai.model = SimpleNamespace(config=SimpleNamespace(n_positions=150 + 400))
+    ai.prefix_ids = [0] * 100  # Бюджет хвоста: 550 - 150 - 100 = 300 токенов
+    
+    history = [f"Пользователь: сообщение {i:02d}" for i in range(30)]
+    request = {
+        'user_message': "Как дела?",
+        'chat_history': history,
+        'empathy_level': 50,
+        'emotion': "любопытство",
+        'scenario': "Небесная Гостиница"
+    }
+    
+    tail, first_line = ai._assemble_tail(request)
+    text = "".join(chr(t) for t in tail)
+    assert len(tail) <= 300
+    assert text.endswith("Пользователь: Как дела?\n\nОданна:"), "Сообщение и реплика не должны обрезаться"
+    assert history[-1] in text and first_line != history[0], "В бюджет попадают самые новые строки"
+    start = history.index(first_line)
+    assert text == "\n" + ai._build_context_tail("Как дела?", history[start:], 50, "любопытство", "Небесная Гостиница")
+    print(f"✅ В контекст вошли строки истории с {start} по {len(history) - 1}")
+    
+    # Повторная сборка берет токены строк истории из кэша
+    calls = ai.tokenizer.calls
+    ai._assemble_tail(request)
+    assert ai.tokenizer.calls == calls + 1, "Заново токенизируется только сообщение пользователя"
+    print("✅ Токенизация строк истории кэшируется")
+    
+    print("🎉 Тест бюджета контекста пройден!")
+
+def test_streaming_response():
+    """Тест потокового ответа правками сообщения"""
+    print("\n📡 Тестирование потоковых ответов...")
+    import odanna_bot
+    from odanna_bot import BatchStreamer
+    from telegram.error import BadRequest
+    
+    class CharTokenizer:
+        def decode(self, ids, skip_special_tokens=False):
+            return "".join(chr(i) for i in ids if not (skip_special_tokens and i == 0))
+    
+    class FakeTensor(list):
+        def tolist(self):
+            return list(self)
+    
+    pieces = {0: [], 1: []}
+    streamer = BatchStreamer(CharTokenizer(), [pieces[0].append, None, pieces[1].append])
+    streamer.put(FakeTensor([[1, 2], [1, 2], [1, 2]]))  # Промпт не передается
+    for step in ("ад", "бе", "\0в"):
+        streamer.put(FakeTensor([ord(step[0]), ord('x'), ord(step[1])]))
+    streamer.end()
+    assert "".join(pieces[0]) == "аб" and "".join(pieces[1]) == "дев", pieces
+    print("✅ Каждая строка батча получает свой поток текста")
+    
+    batch_sizes = []
+    
+    class StreamingAI(AIManager):
+        def generate_odanna_batch(self, requests):
+            batch_sizes.append(len(requests))
+            for word in ["Добро ", "пожаловать ", "в ", "гостиницу."]:
+                time.sleep(0.03)
+                for request in requests:
+                    request['on_text'](word)
+            return ["Добро пожаловать в гостиницу. *едва заметная усмешка*"] * len(requests)
+    
+    class FakeMessage:
+        def __init__(self):
+            self.texts = []
+        
+        async def reply_text(self, text, parse_mode=None):
+            self.texts.append(text)
+            return self
+        
+        async def edit_text(self, text, parse_mode=None):
+            self.texts.append(text)
+    
+    bot = OdannaBot.__new__(OdannaBot)
+    bot.inference = InferenceExecutor(StreamingAI(preload=False), mode='thread', workers=1)
+    bot.generator = BatchScheduler(bot.inference, max_batch=4, max_wait_ms=20, workers=1)
+    messages = [FakeMessage(), FakeMessage()]
+    
+    def request(chat_id):
+        return {
+            'user_message': "Привет",
+            'chat_history': [],
+            'empathy_level': 35,
+            'emotion': "нейтральное",
+            'scenario': "Небесная Гостиница",
+            'chat_id': chat_id
+        }
+    
+    class MarkdownMessage(FakeMessage):
+        async def edit_text(self, text, parse_mode=None):
+            if parse_mode == 'Markdown' and not text.endswith(" …"):
+                raise BadRequest("Can't parse entities: can't find end of the entity")
+            self.texts.append((text, parse_mode))
+    
+    class SlowMessage(FakeMessage):
+        def __init__(self):
+            super().__init__()
+            self.deleted = False
+            self.final_edit = asyncio.Event()
+        
+        async def edit_text(self, text, parse_mode=None):
+            if not text.endswith(" …"):
+                self.final_edit.set()
+                await asyncio.sleep(10)
+        
+        async def delete(self):
+            self.deleted = True
+    
+    markdown_message = MarkdownMessage()
+    slow_message = SlowMessage()
+    
+    async def scenario():
+        responses = await asyncio.gather(*(bot._stream_response(message, request(f"chat{i}"))
+                                           for i, message in enumerate(messages)))
+        await bot._stream_response(markdown_message, request("markdown"))
+        
+        task = asyncio.ensure_future(bot._stream_response(slow_message, request("slow")))
+        await slow_message.final_edit.wait()
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        return responses
+    
+    edit_interval = odanna_bot.STREAM_EDIT_INTERVAL
+    odanna_bot.STREAM_EDIT_INTERVAL = 0.05
+    try:
+        responses = asyncio.run(scenario())
+    finally:
+        odanna_bot.STREAM_EDIT_INTERVAL = edit_interval
+        bot.inference.shutdown()
+    
+    assert batch_sizes[0] == 2, f"Потоковые ответы генерируются одним батчем: {batch_sizes}"
+    for message, response in zip(messages, responses):
+        assert message.texts[0] == odanna_bot.STREAM_PLACEHOLDER
+        assert any(text.endswith(" …") for text in message.texts[1:-1]), "Ожидались промежуточные правки"
+        assert message.texts[-1] == response, "Последняя правка — итоговый текст после постобработки"
+    print(f"✅ Сообщение обновлено {len(messages[0].texts) - 1} раз(а), оба ответа — из одного батча")
+    assert markdown_message.texts[-1] == (responses[0], None), "Неразобранная разметка — итог без Markdown"
+    print("✅ Ошибка разметки в итоговой правке — текст отправлен без Markdown")
+    assert slow_message.deleted, "Отмена во время итоговой правки убирает заглушку"
+    print("✅ Отмена во время итоговой правки удаляет заглушку")
+    print("🎉 Тест потоковых ответов пройден!")
+
+def test_database_connections():
+    """Тест постоянных соединений SQLite"""
+    print("\n🔌 Тестирование соединений с базой данных...")
+    import threading
+    
+    with tempfile.NamedTemporaryFile(suffix='.db', delete=False) as temp_db:
+        db_path = temp_db.name
+    
+    try:
+        db = DatabaseManager(db_path)
+        conn = db._connection()
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert db._connection() is conn, "Соединение потока должно переиспользоваться"
+        print("✅ WAL включен, соединение переиспользуется")
+        
+        # Другой поток получает свое соединение и видит закоммиченные данные
+        db.add_user(12345, "test_user")
+        chat_id = db.create_chat(12345, "Тест соединений")
+        db.add_message(chat_id, 12345, "Привет!", "Добро пожаловать.", "радость", 40)
+        
+        seen = []
+        thread = threading.Thread(target=lambda: seen.append((db._connection(), db.get_chat_history(chat_id))))
+        thread.start()
+        thread.join()
+        assert seen[0][0] is not conn and len(seen[0][1]) == 1
+        print("✅ Потоки используют отдельные соединения")
+        
+        db.close()
+        assert not db._connections
+        print("🎉 Тест соединений пройден!")
+        
+    finally:
+        os.unlink(db_path)
+
+def test_async_database():
+    """Тест асинхронного доступа к базе данных"""
+    print("\n⏳ Тестирование асинхронной базы данных...")
+    
+    with tempfile.NamedTemporaryFile(suffix='.db', delete=False) as temp_db:
+        db_path = temp_db.name
+    
+    storage = AsyncDatabase(DatabaseManager(db_path))
+    
+    async def scenario():
+        await storage.add_user(12345, "test_user")
+        chat_id = await storage.create_chat(12345, "Асинхронный чат")
+        
+        # Запросы многих пользователей выполняются по порядку в потоке базы
+        await asyncio.gather(*[
+            storage.add_message(chat_id, 12345, f"Сообщение {i}", f"Ответ {i}", "нейтральное", 40)
+            for i in range(20)
+        ])
+        await storage.update_chat_empathy(chat_id, 60)
+        
+        history = await storage.get_chat_history(chat_id, 50)
+        assert len(history) == 20
+        assert await storage.get_chat_empathy_level(chat_id) == 60
+        chats = await storage.get_user_chats(12345)
+        assert chats[0][0] == chat_id and chats[0][3] == 20
+        print("✅ Чтение и запись через поток базы данных работают")
+    
+    try:
+        asyncio.run(scenario())
+    finally:
+        storage.close()
+        os.unlink(db_path)
+    
+    print("🎉 Тест асинхронной базы данных пройден!")
+
+def test_schema_migrations():
+    """Тест миграций схемы базы данных"""
+    print("\n🧱 Тестирование миграций схемы...")
+    
+    with tempfile.NamedTemporaryFile(suffix='.db', delete=False) as temp_db:
+        db_path = temp_db.name
+    
+    try:
+        # База в формате до появления миграций: таблицы без индексов, user_version = 0
+        conn = sqlite3.connect(db_path)
+        for statement in DatabaseManager.MIGRATIONS[0]:
+            conn.execute(statement)
+        conn.execute("INSERT INTO chats (chat_id, user_id, chat_name, scenario) VALUES ('old_chat', 1, 'Старый', 'x')")
+        conn.execute("INSERT INTO messages (chat_id, user_id, message_text) VALUES ('old_chat', 1, 'Старое сообщение')")
+        conn.commit()
+        conn.close()
+        
+        db = DatabaseManager(db_path)
+        conn = db._connection()
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == len(DatabaseManager.MIGRATIONS)
+        assert len(db.get_chat_history('old_chat')) == 1, "Данные должны сохраниться"
+        print("✅ Существующая база обновлена на месте")
+        
+        plan = " ".join(row[-1] for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT message_text FROM messages WHERE chat_id = ? ORDER BY message_id DESC LIMIT 10",
+            ('old_chat',)
+        ))
+        assert "idx_messages_chat" in plan, plan
+        plan = " ".join(row[-1] for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT chat_id FROM chats WHERE user_id = ? ORDER BY last_activity DESC", (1,)
+        ))
+        assert "idx_chats_user_activity" in plan, plan
+        print("✅ История и список чатов читаются по индексам")
+        
+        # Повторный запуск ничего не меняет
+        DatabaseManager(db_path)
+        db.close()
+        print("🎉 Тест миграций пройден!")
+        
+    finally:
+        os.unlink(db_path)
+
+def test_write_behind():
+    """Тест пакетной фоновой записи"""
+    print("\n🧺 Тестирование пакетной записи...")
+    
+    with tempfile.NamedTemporaryFile(suffix='.db', delete=False) as temp_db:
+        db_path = temp_db.name
+    
+    storage = AsyncDatabase(DatabaseManager(db_path), durability='buffered', batch_size=100, flush_ms=50)
+    
+    async def scenario():
+        await storage.add_user(12345, "test_user")
+        chat_id = await storage.create_chat(12345, "Пакетный чат")
+        for i in range(50):
+            await storage.add_message(chat_id, 12345, f"Сообщение {i}", f"Ответ {i}", "нейтральное", 40)
+            await storage.update_chat_empathy(chat_id, 40 + i % 10)
+        
+        # Чтение видит все предыдущие записи
+        assert len(await storage.get_chat_history(chat_id, 100)) == 50
+        assert storage.write_batches < storage.writes / 10, "Записи должны группироваться в транзакции"
+        print(f"✅ {storage.writes} записей в {storage.write_batches} транзакциях")
+        
+        # Записи, не дошедшие до диска, сохраняются при закрытии
+        await storage.add_message(chat_id, 12345, "Последнее", "Ответ", "нейтральное", 40)
+        return chat_id
+    
+    try:
+        chat_id = asyncio.run(scenario())
+        storage.close()
+        assert len(DatabaseManager(db_path).get_chat_history(chat_id, 100)) == 51
+        print("✅ Накопленные записи сохранены при остановке")
+    finally:
+        os.unlink(db_path)
+    
+    print("🎉 Тест пакетной записи пройден!")
+
+def test_chat_state_cache():
+    """Тест кэша состояния чатов"""
+    print("\n🗂 Тестирование кэша состояния чатов...")
+    
+    with tempfile.NamedTemporaryFile(suffix='.db', delete=False) as temp_db:
+        db_path = temp_db.name
+    
+    db = DatabaseManager(db_path)
+    storage = AsyncDatabase(db)
+    reads = []
+    for method in ('get_chat_state', 'get_chat_history', 'get_chat_empathy_level'):
+        original = getattr(db, method)
+        setattr(db, method, lambda *args, _name=method, _original=original: reads.append(_name) or _original(*args))
+    
+    async def scenario():
+        chat_id = await storage.create_chat(12345, "Кэшируемый чат")
+        
+        # Путь обычного сообщения: чтения эмпатии и истории без обращений к базе
+        for i in range(30):
+            await storage.get_chat_empathy_level(chat_id)
+            await storage.get_chat_history(chat_id, 10)
+            await storage.add_message(chat_id, 12345, f"Сообщение {i}", f"Ответ {i}", "нейтральное", 40)
+            await storage.update_chat_empathy(chat_id, 50)
+        assert reads == [], reads
+        history = await storage.get_chat_history(chat_id, 10)
+        assert [row[0] for row in history] == [f"Сообщение {i}" for i in range(20, 30)]
+        assert await storage.get_chat_empathy_level(chat_id) == 50
+        print("✅ Состояние чата обслуживается из кэша")
+        
+        # "Забыть" сбрасывает кэш: история перечитывается с отметкой is_ignored
+        await storage.ignore_message(chat_id, "Сообщение 29")
+        history = await storage.get_chat_history(chat_id, 10)
+        assert reads.count('get_chat_state') == 1, "Одна загрузка состояния"
+        assert history[-1][0] == "Сообщение 29" and history[-1][2] == 1
+        assert history == DatabaseManager(db_path).get_chat_history(chat_id, 10)
+        print("✅ Забытое сообщение сбрасывает кэш чата")
+    
+    try:
+        asyncio.run(scenario())
+    finally:
+        storage.close()
+        os.unlink(db_path)
+    
+    print("🎉 Тест кэша состояния чатов пройден!")
+
+def test_current_chat_persistence():
+    """Тест сохранения активного чата между перезапусками"""
+    print("\n📌 Тестирование сохранения активного чата...")
+    from types import SimpleNamespace
+    
+    with tempfile.NamedTemporaryFile(suffix='.db', delete=False) as temp_db:
+        db_path = temp_db.name
+    
+    def start_bot():
+        bot = OdannaBot.__new__(OdannaBot)
+        bot.db = DatabaseManager(db_path)
+        bot.storage = AsyncDatabase(bot.db)
+        bot.current_chats = CurrentChatCache(max_size=2, ttl=0.2)
+        return bot
+    
+    async def scenario():
+        bot = start_bot()
+        assert await bot._get_current_chat(12345) is None
+        chat_id = await bot.storage.create_chat(12345, "Активный чат")
+        await bot._set_current_chat(12345, chat_id)
+        bot.storage.close()
+        
+        # После перезапуска активный чат читается из базы один раз
+        bot = start_bot()
+        assert await bot._get_current_chat(12345) == chat_id
+        read_current_chat = bot.storage.db.get_current_chat
+        bot.storage.db.get_current_chat = lambda user_id: None
+        assert await bot._get_current_chat(12345) == chat_id
+        bot.storage.db.get_current_chat = read_current_chat
+        print("✅ Активный чат восстановлен после перезапуска")
+        
+        # Смена чата другой репликой видна после истечения срока записи; кэш ограничен по размеру
+        DatabaseManager(db_path).set_current_chat(12345, "другая реплика")
+        assert await bot._get_current_chat(12345) == chat_id
+        await asyncio.sleep(0.25)
+        assert await bot._get_current_chat(12345) == "другая реплика"
+        for user_id in (1, 2, 3):
+            await bot._set_current_chat(user_id, f"чат {user_id}")
+        assert len(bot.current_chats) == 2 and bot.current_chats.get(1) is None
+        await bot._set_current_chat(12345, chat_id)
+        print("✅ Кэш активных чатов ограничен по размеру и времени жизни записи")
+        
+        # Выбор чата кнопкой: chat_id целиком, несуществующий чат не сохраняется
+        edits = []
+        
+        async def edit_message_text(text, **kwargs):
+            edits.append(text)
+        
+        query = SimpleNamespace(edit_message_text=edit_message_text)
+        await asyncio.sleep(1.1)  # chat_id включает время с точностью до секунды
+        other_chat = await bot.storage.create_chat(12345, "Второй чат")
+        await bot._handle_chat_action(query, 12345, f"chat_select_{other_chat}")
+        await bot.storage.flush()
+        assert DatabaseManager(db_path).get_current_chat(12345) == other_chat
+        await bot._handle_chat_action(query, 12345, "chat_select_12345_20000101_000000")
+        await bot._handle_chat_action(query, 54321, f"chat_select_{other_chat}")
+        await bot.storage.flush()
+        assert DatabaseManager(db_path).get_current_chat(12345) == other_chat
+        assert DatabaseManager(db_path).get_current_chat(54321) is None
+        assert all('не найден' in text for text in edits[1:]), edits
+        await bot._set_current_chat(12345, chat_id)
+        print("✅ Выбор чата сохраняет полный chat_id и только существующего чата")
+        
+        await bot.storage.delete_chat(chat_id)
+        await bot.storage.flush()
+        assert DatabaseManager(db_path).get_current_chat(12345) is None
+        bot.storage.close()
+        print("✅ Удаление чата сбрасывает активный чат")
+    
+    try:
+        asyncio.run(scenario())
+    finally:
+        os.unlink(db_path)
+    
+    print("🎉 Тест сохранения активного чата пройден!")
+
+def test_sharding():
+    """Тест распределения чатов по шардам"""
+    print("\n🧩 Тестирование шардирования...")
+    
+    keys = [f"chat_{i}" for i in range(2000)]
+    ring = HashRing(4)
+    owners = [ring.shard_for(key) for key in keys]
+    assert owners == [HashRing(4).shard_for(key) for key in keys], "Распределение детерминировано"
+    assert all(owners.count(shard) > 300 for shard in range(4)), "Нагрузка распределена по всем шардам"
+    
+    # Добавление шарда переносит только часть чатов
+    moved = sum(owner != HashRing(5).shard_for(key) for key, owner in zip(keys, owners))
+    assert moved < len(keys) * 0.35, moved
+    print("✅ Консистентное хеширование стабильно и равномерно")
+    
+    class BatchAI(AIManager):
+        def generate_odanna_batch(self, requests):
+            return [f"Ответ: {r['user_message']}" for r in requests]
+    
+    ai = BatchAI(preload=False)
+    
+    async def scenario():
+        executor = InferenceExecutor(ai, mode='thread', workers=2, queue_size=32, timeout=5.0)
+        # Шарды подменены потоками пула: проверяется только маршрутизация батча
+        executor.ring = HashRing(2)
+        routed = []
+        executor.submit_to = lambda shard, method, requests: routed.append(
+            (shard, [r['chat_id'] for r in requests])
+        ) or executor.pool.submit(ai.generate_odanna_batch, requests)
+        scheduler = BatchScheduler(executor, max_batch=8, max_wait_ms=20, workers=1)
+        try:
+            results = await asyncio.gather(*[
+                scheduler.generate(f"сообщение {i}", [], 35, "нейтральное", "Небесная Гостиница",
+                                   chat_id=f"chat_{i}")
+                for i in range(8)
+            ])
+        finally:
+            executor.shutdown()
+        
+        assert results == [f"Ответ: сообщение {i}" for i in range(8)]
+        assert len(routed) == 2, routed
+        for shard, chat_ids in routed:
+            assert all(executor.shard_for(chat_id) == shard for chat_id in chat_ids)
+        print("✅ Батч разделен по шардам, ответы сохраняют порядок")
+    
+    asyncio.run(scenario())
+    print("🎉 Тест шардирования пройден!")
+
+def test_webhook_server():
+    """Тест HTTP-сервера вебхука и проверок состояния"""
+    print("\n🌐 Тестирование вебхука...")
+    from types import SimpleNamespace
+    from aiohttp.test_utils import TestClient, TestServer
+    
+    bot = OdannaBot.__new__(OdannaBot)
+    bot.ai = AIManager(preload=False)
+    bot.inference = InferenceExecutor(bot.ai, mode='thread', workers=1)
+    
+    async def scenario():
+        application = SimpleNamespace(bot=None, update_queue=asyncio.Queue())
+        async with TestClient(TestServer(bot._web_app(application))) as client:
+            response = await client.get('/healthz')
+            assert response.status == 200
+            
+            # Модель не загружена — бот жив, но не готов
+            response = await client.get('/readyz')
+            assert response.status == 503
+            bot.ai.ready.set()
+            response = await client.get('/readyz')
+            assert response.status == 200
+            print("✅ /healthz и /readyz отражают состояние модели")
+            
+            update = {'update_id': 1, 'message': {'message_id': 1, 'date': 0, 'text': 'Привет',
+                                                  'chat': {'id': 12345, 'type': 'private'}}}
+            response = await client.post('/webhook', json=update)
+            assert response.status == 200
+            received = application.update_queue.get_nowait()
+            assert received.update_id == 1 and received.message.text == 'Привет'
+            
+            response = await client.post('/webhook', data='не json')
+            assert response.status == 400
+            assert application.update_queue.empty()
+            print("✅ Вебхук ставит обновления в очередь приложения")
+    
+    asyncio.run(scenario())
+    print("🎉 Тест вебхука пройден!")
+
+def test_lazy_model_loading():
+    """Тест фоновой загрузки модели и отложенных импортов"""
+    print("\n⏳ Тестирование фоновой загрузки модели...")
+    import subprocess
+    
+    # Импорт модуля не тянет torch и transformers
+    result = subprocess.run(
+        [sys.executable, '-c', "import sys, odanna_bot; print('torch' in sys.modules, 'transformers' in sys.modules)"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    assert result.stdout.split() == ['False', 'False'], result.stdout + result.stderr
+    print("✅ torch и transformers не импортируются вместе с модулем")
+    
+    release = threading.Event()
+    
+    class SlowLoadingAI(AIManager):
+        def load_model(self):
+            release.wait(5)
+            self.ready.set()
+    
+    ai = SlowLoadingAI(preload=False)
+    loader = ai.load_in_background()
+    request = {'user_message': "Привет", 'chat_history': [], 'empathy_level': 35,
+               'emotion': "нейтральное", 'scenario': "Небесная Гостиница", 'chat_id': None}
+    
+    # Пока модель грузится, ответы запасные и бот не готов
+    assert not ai.ready.is_set()
+    assert ai.generate_odanna_batch([request]) == [ai._fallback_response("Привет", 35, "нейтральное")]
+    release.set()
+    loader.join(5)
+    assert ai.ready.is_set()
+    print("✅ До загрузки модели используются запасные ответы")
+    
+    print("🎉 Тест фоновой загрузки модели пройден!")
+
+def test_model_backends():
+    """Тест бэкендов модели и int8-квантизации"""
+    print("\n🧮 Тестирование бэкендов модели...")
+    import odanna_bot
+    odanna_bot._import_ml()
+    import torch
+    from transformers import GPT2Config, GPT2LMHeadModel
+    
+    try:
+        AIManager(preload=False, backend='tensorrt')
+        assert False, "Неизвестный бэкенд должен отклоняться"
+    except ValueError:
+        pass
+    assert not AIManager(preload=False, backend='onnx').kv_pool.enabled, "ONNX не переиспользует KV-кэш"
+    
+    # Conv1D GPT-2 заменяется на эквивалентные Linear, после чего их квантует quantize_dynamic
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(GPT2Config(vocab_size=100, n_positions=64, n_embd=32, n_layer=2, n_head=2)).eval()
+    input_ids = torch.tensor([[1, 2, 3, 4, 5]])
+    with torch.no_grad():
+        expected = model(input_ids).logits
+        odanna_bot._conv1d_to_linear(model)
+        assert torch.allclose(model(input_ids).logits, expected, atol=1e-5)
+        quantized = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        assert (quantized(input_ids).logits.argmax(-1) == expected.argmax(-1)).float().mean() > 0.5
+    assert 'quantized' in type(quantized.transformer.h[0].attn.c_attn).__module__
+    print("✅ Слои GPT-2 квантуются в int8 без изменения архитектуры")
+    
+    print("🎉 Тест бэкендов модели пройден!")
+
+def test_shared_weights():
+    """Тест общих весов для рабочих процессов"""
+    print("\n🧬 Тестирование общих весов рабочих процессов...")
+    from types import SimpleNamespace
+    import odanna_bot
+    odanna_bot._import_ml()
+    import torch
+    from transformers import GPT2Config, GPT2LMHeadModel
+    
+    release = threading.Event()
+    loads = []
+    
+    class TinyAI(AIManager):
+        def load_weights(self):
+            release.wait(5)
+            loads.append(os.getpid())
+            self.device = torch.device('cpu')
+            self.tokenizer = SimpleNamespace(encode=lambda text: [ord(c) % 100 for c in text])
+            self.model = GPT2LMHeadModel(GPT2Config(vocab_size=100, n_positions=1024, n_embd=32,
+                                                    n_layer=1, n_head=2)).eval()
+        
+        def weights_info(self):
+            return os.getpid(), self.model.transformer.wte.weight.data_ptr(), self.ready.is_set()
+    
+    ai = TinyAI(preload=False)
+    executor = InferenceExecutor(ai, mode='sharded', workers=2, shared_weights=True)
+    try:
+        # Пока веса грузятся, бот не готов и отвечает запасными ответами
+        assert not executor.is_ready()
+        request = {'user_message': "Привет", 'chat_history': [], 'empathy_level': 35,
+                   'emotion': "нейтральное", 'scenario': "Небесная Гостиница", 'chat_id': "chat_1"}
+        assert executor.submit('generate_odanna_batch', [request]).result(5) == \
+            [ai._fallback_response("Привет", 35, "нейтральное")]
+        
+        release.set()
+        assert executor._workers_started.wait(30), "Рабочие процессы не запустились"
+        assert executor.is_ready()
+        
+        infos = [executor.submit_to(shard, 'weights_info').result(30) for shard in range(2)]
+        parent_ptr = ai.model.transformer.wte.weight.data_ptr()
+        assert loads == [os.getpid()], "Веса загружены один раз в родителе"
+        assert len({pid for pid, _, _ in infos}) == 2
+        assert all(ptr == parent_ptr and ready for _, ptr, ready in infos), infos
+        print("✅ Веса загружены один раз и унаследованы процессами")
+    finally:
+        executor.shutdown()
+    
+    print("🎉 Тест общих весов пройден!")
+
+def test_response_cache():
+    """Тест кэша ответов"""
+    print("\n💾 Тестирование кэша ответов...")
+    
+    ai = AIManager(preload=False)
+    ai.response_cache = ResponseCache(max_size=2, ttl=60, variants=2)
+    request = {'user_message': "Привет!", 'chat_history': [], 'empathy_level': 35,
+               'emotion': "нейтральное", 'scenario': "Небесная Гостиница", 'chat_id': "chat_1"}
+    
+    # Ответ появляется в кэше, только когда накоплено нужное число вариантов
+    assert ai.cached_response(request) is None
+    ai.cache_response(request, "Добро пожаловать.")
+    assert ai.cached_response(request) is None
+    ai.cache_response(request, "Входите, гость.")
+    
+    # Почти одинаковые приветствия и эмпатия в пределах десятка дают тот же ключ
+    variant = dict(request, user_message="  приивееет ", empathy_level=38, chat_id="chat_2")
+    assert ai.cached_response(variant) in ("Добро пожаловать.", "Входите, гость.")
+    assert ai.cached_response(dict(request, chat_history=["Пользователь: ранее"])) is None
+    print("✅ Ответы копятся вариантами, ключ нормализуется")
+    
+    # Запасные ответы не кэшируются
+    other = dict(request, user_message="Как дела?")
+    fallback = ai._fallback_response(other['user_message'], other['empathy_level'], other['emotion'])
+    ai.cache_response(other, fallback)
+    assert ai.response_cache.key(other) not in ai.response_cache._entries
+    
+    # Вытеснение по размеру и истечение TTL
+    for i in range(3):
+        ai.cache_response(dict(request, user_message=f"сообщение {i}"), "ответ")
+    assert len(ai.response_cache._entries) == 2 and ai.response_cache.evictions == 2
+    ai.response_cache.ttl = 0
+    ai.cache_response(request, "a")
+    ai.cache_response(request, "b")
+    assert ai.cached_response(request) is None and ai.response_cache.expirations == 1
+    
+    stats = ai.response_cache.stats()
+    assert stats['hits'] == 1 and stats['hit_rate'] == 1 / (stats['hits'] + stats['misses'])
+    print("✅ TTL, вытеснение и метрики работают")
+    
+    print("🎉 Тест кэша ответов пройден!")
+
+def test_emotion_analyzer():
+    """Тест словарного анализатора эмоций"""
+    print("\n🎭 Тестирование анализатора эмоций...")
+    
+    analyzer = EmotionAnalyzer({
+        'радость': {'рад': 1.0, 'счастлив*': 1.0, 'тепл*': 0.3},
+        'любопытство': {'?': 1.0, 'как': 0.8}
+    })
+    assert analyzer.scores("Я счастливая и РАД!") == {'радость': 2.0}
+    assert analyzer.labels("Как дела?") == ['любопытство']
+    # Целые слова не совпадают внутри других слов, основы — только с начала слова
+    assert analyzer.labels("Парад, никак, несчастливый") == []
+    # Слабые признаки учитываются только в сумме
+    assert analyzer.labels("тепло") == [] and analyzer.labels("тепло, теплее, теплый") == ['радость']
+    print("✅ Слова и основы сопоставляются по границам слов")
+    
+    ai = AIManager(preload=False)
+    assert 'грусть' in ai.analyze_emotion("Мне очень грустно сегодня...")
+    assert ai.analyze_emotion("Как дела? Что нового?") == 'любопытство'
+    assert ai.analyze_emotion("Спасибо, я так рада!") == 'радость, возбуждение'
+    assert ai.analyze_emotion("Привет") == 'нейтральное'
+    assert len(ai.emotion_analyzer._words) + len(ai.emotion_analyzer._stems) > 200, "Загружен словарь из файла"
+    
+    builtin = EmotionAnalyzer.from_file('/nonexistent/emotion_lexicon.json')
+    assert builtin.labels("Мне грустно") == ['грусть']
+    print("✅ Словарь загружается из файла, встроенный словарь — запасной")
+    
+    print("🎉 Тест анализатора эмоций пройден!")
+
+def test_repetition_suppression():
+    """Тест подавления повторов и его времени работы"""
+    print("\n🔁 Тестирование подавления повторов...")
+    import random
+    import odanna_bot
+    odanna_bot._import_ml()
+    import torch
+    
+    assert suppress_repetitions("Я здесь. Я здесь. Я здесь. Я слушаю.") == "Я здесь. Я слушаю."
+    assert suppress_repetitions("Да да да да, я слушаю.") == "Да, я слушаю."
+    assert suppress_repetitions("Ну... «Да да да», сказал он.") == "Ну... «Да», сказал он."
+    assert suppress_repetitions("Нет, нет. Анна, сообщение!!!!!!") == "Нет, нет. Анна, сообщение!!!"
+    assert suppress_repetitions("Счет: 1000000 монет.") == "Счет: 1000000 монет."
+    assert suppress_repetitions("хорошо хорошо хорошо\nдалее") == "хорошо\nдалее"
+    print("✅ Зацикленные фразы сокращаются, обычный текст не меняется")
+    
+    assert has_repetition_loop([7, 1, 2, 3, 1, 2, 3, 1, 2, 3]) and not has_repetition_loop([1, 2, 3, 1, 2, 3, 4])
+    stopper = RepetitionStopper(prompt_length=6)
+    prompt = [5, 5, 5, 5, 5, 5]
+    assert not stopper(torch.tensor([prompt + [1, 2]]), None), "Повторы в промпте не учитываются"
+    assert not stopper(torch.tensor([prompt + [1, 2] * 3, prompt + [1, 2, 3, 4, 5, 6]]), None)
+    assert stopper(torch.tensor([prompt + [1, 2] * 3, prompt + [9, 4, 0, 0, 0, 0]]), None)
+    print("✅ Генерация останавливается, когда все ответы батча зациклились")
+    
+    # Фаззинг: вырожденные строки, на которых обратная ссылка (.+?)\1+ работает сверхлинейно
+    rng = random.Random(0)
+    generators = [
+        lambda n: 'а' * n,
+        lambda n: 'ab' * (n // 2),
+        lambda n: ''.join(rng.choice('ab ') for _ in range(n)),
+        lambda n: ''.join(rng.choice(['ха', 'ха ', 'Я здесь. ', '!', ' ']) for _ in range(n // 4)),
+        lambda n: ' '.join(rng.choice(['да', 'нет', 'да нет', 'может']) for _ in range(n // 4)),
+        lambda n: ''.join(rng.choice('абвгдежзийклмнопрст \n.,!?') for _ in range(n))
+    ]
+    
+    def timed(text):
+        started = time.perf_counter()
+        result = suppress_repetitions(text)
+        return result, time.perf_counter() - started
+    
+    for generate in generators:
+        for _ in range(20):
+            text = generate(rng.randint(0, 300))
+            result, _ = timed(text)
+            assert len(result) <= len(text)
+            assert 'аааа' not in result
+        
+        small = generate(5000)
+        large = small * 8
+        _, small_time = timed(small)
+        _, large_time = timed(large)
+        assert large_time < 2.0, f"{large_time:.2f} с на {len(large)} символов"
+        assert large_time < 8 * 4 * max(small_time, 1e-3), "Время растет сверхлинейно"
+    print("✅ Время работы линейно на вырожденных строках")
+    
+    print("🎉 Тест подавления повторов пройден!")
+
+def test_pipeline_stages():
+    """Тест замеров этапов обработки сообщения"""
+    print("\n⏱️ Тестирование замеров этапов...")
+    from types import SimpleNamespace
+    import odanna_bot
+    
+    with tempfile.NamedTemporaryFile(suffix='.db', delete=False) as temp_db:
+        db_path = temp_db.name
+    
+    # Готовый AIManager без модели: бот отвечает запасными ответами
+    bot = OdannaBot("test", db_path=db_path, ai=AIManager(preload=False))
+    assert not bot.ai.ready.is_set(), "Переданный AIManager не загружается повторно"
+    replies = []
+    
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+    
+    update = SimpleNamespace(
+        effective_user=SimpleNamespace(id=12345, username="test", first_name="Гость", last_name=None),
+        message=SimpleNamespace(text="Привет, Оданна!", reply_text=reply_text)
+    )
+    
+    stages = []
+    asyncio.run(bot.handle_message(update, None))
+    assert replies, "Без наблюдателей сообщение обрабатывается как обычно"
+    
+    odanna_bot.STAGE_OBSERVERS.append(lambda name, seconds: stages.append((name, seconds)))
+    try:
+        asyncio.run(bot.handle_message(update, None))
+    finally:
+        odanna_bot.STAGE_OBSERVERS.clear()
+        bot.inference.shutdown()
+        bot.storage.close()
+        os.unlink(db_path)
+    
+    names = [name for name, _ in stages]
+    for name in ('add_user', 'current_chat', 'emotion', 'history', 'persist', 'reply', 'message'):
+        assert name in names, f"Нет этапа {name}: {names}"
+    assert names[-1] == 'message' and all(seconds >= 0 for _, seconds in stages)
+    print(f"✅ Этапы замерены: {', '.join(names)}")
+    
+    print("🎉 Тест замеров этапов пройден!")
+
+def test_metrics():
+    """Тест метрик этапов и эндпоинта /metrics"""
+    print("\n📈 Тестирование метрик...")
+    from types import SimpleNamespace
+    from aiohttp.test_utils import TestClient, TestServer
+    import odanna_bot
+    from odanna_bot import Histogram, metrics
+    
+    histogram = Histogram((0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+    lines = histogram.render('x', 'stage="a"')
+    assert lines[:3] == ['x_bucket{stage="a",le="0.1"} 2', 'x_bucket{stage="a",le="1.0"} 3',
+                         'x_bucket{stage="a",le="+Inf"} 4'], lines
+    assert lines[-1] == 'x_count{stage="a"} 4'
+    print("✅ Корзины гистограммы накопительные, граница включается")
+    
+    with tempfile.NamedTemporaryFile(suffix='.db', delete=False) as temp_db:
+        db_path = temp_db.name
+    bot = OdannaBot("test", db_path=db_path, ai=AIManager(preload=False))
+    update = SimpleNamespace(
+        effective_user=SimpleNamespace(id=12345, username="test", first_name="Гость", last_name=None),
+        message=SimpleNamespace(text="Привет, Оданна!", reply_text=lambda *args, **kwargs: asyncio.sleep(0))
+    )
+    
+    async def scenario():
+        # Выключенные метрики ничего не замеряют
+        await bot.handle_message(update, None)
+        await bot.storage.flush()
+        assert not odanna_bot.STAGE_OBSERVERS and metrics.render().count('_count') == 0
+        
+        bot._register_metrics()
+        await bot.handle_message(update, None)
+        await bot.storage.flush()
+        
+        application = SimpleNamespace(bot=None, update_queue=asyncio.Queue())
+        async with TestClient(TestServer(bot._web_app(application, webhook=False))) as client:
+            response = await client.get('/metrics')
+            assert response.status == 200
+            text = await response.text()
+            
+            response = await client.post('/webhook', json={})
+            assert response.status in (404, 405), "Без вебхука обновления не принимаются"
+        return text
+    
+    try:
+        text = asyncio.run(scenario())
+    finally:
+        metrics.disable()
+        bot.inference.shutdown()
+        bot.storage.close()
+        os.unlink(db_path)
+    
+    assert 'odanna_stage_seconds_count{stage="message"} 1' in text, text
+    assert 'odanna_db_seconds_count{method="add_message"} 1' in text, text
+    assert 'odanna_responses_total{source="fallback"} 1' in text, text
+    assert 'odanna_inference_queue_depth 0' in text and 'odanna_model_ready 0' in text
+    print("✅ /metrics отдает этапы, операции базы, источники ответов и очереди")
+    
+    print("🎉 Тест метрик пройден!")
+
+def test_profiling():
+    """Тест выборочного профилирования генерации и журнала медленных генераций"""
+    print("\n🔬 Тестирование профилирования...")
+    import json
+    import signal
+    import subprocess
+    from types import SimpleNamespace
+    import odanna_bot
+    from odanna_bot import GenerationProfiler
+    
+    def work():
+        return sum(i * i for i in range(10000))
+    
+    with tempfile.TemporaryDirectory() as directory:
+        profiler = GenerationProfiler(enabled=False, sample_rate=1.0, kind='cprofile',
+                                      directory=directory, max_files=2, slow_ms=100)
+        with profiler.session('generate'):
+            work()
+        assert not os.path.exists(os.path.join(directory, 'slow.log')) and not os.listdir(directory)
+        print("✅ Выключенный профилировщик ничего не пишет")
+        
+        profiler.enabled = True
+        for _ in range(3):
+            with profiler.session('generate'):
+                work()
+        profiles = [name for name in os.listdir(directory) if name.endswith('.prof')]
+        assert profiler.captured == 3 and len(profiles) == 2, profiles
+        
+        profiler.sample_rate = 0.0
+        with profiler.session('generate'):
+            work()
+        assert profiler.captured == 3
+        print("✅ Профили снимаются с заданной долей и ротируются")
+        
+        profiler.log_slow(50, {'batch': 1})
+        profiler.log_slow(250, {'batch': 2, 'generate_ms': 240})
+        with open(os.path.join(directory, 'slow.log'), encoding='utf-8') as f:
+            entries = [json.loads(line) for line in f]
+        assert len(entries) == 1 and entries[0]['batch'] == 2 and entries[0]['elapsed_ms'] == 250
+        print("✅ В slow.log попадают только генерации дольше порога")
+        
+        previous = signal.getsignal(signal.SIGUSR1)
+        try:
+            profiler.install_signal_handler()
+            os.kill(os.getpid(), signal.SIGUSR1)
+            assert not profiler.enabled
+            
+            # Основной процесс передает сигнал рабочим процессам
+            worker = subprocess.Popen(
+                [sys.executable, '-c', "import signal, sys, time\n"
+                 "signal.signal(signal.SIGUSR1, lambda *args: (print('toggled', flush=True), sys.exit(0)))\n"
+                 "print('ready', flush=True)\n"
+                 "time.sleep(10)"],
+                stdout=subprocess.PIPE, text=True)
+            try:
+                assert worker.stdout.readline().strip() == 'ready'
+                profiler.install_signal_handler(lambda: [worker.pid])
+                os.kill(os.getpid(), signal.SIGUSR1)
+                assert profiler.enabled
+                assert worker.stdout.readline().strip() == 'toggled'
+            finally:
+                worker.kill()
+                worker.wait()
+        finally:
+            signal.signal(signal.SIGUSR1, previous)
+        print("✅ SIGUSR1 переключает профилирование, в том числе в рабочих процессах")
+    
+    # /profile доступна только администраторам
+    bot = OdannaBot.__new__(OdannaBot)
+    bot.inference = SimpleNamespace(mode='thread')
+    replies = []
+    
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+    
+    def command(user_id, *args):
+        update = SimpleNamespace(effective_user=SimpleNamespace(id=user_id), message=SimpleNamespace(reply_text=reply_text))
+        asyncio.run(bot.profile_command(update, SimpleNamespace(args=list(args))))
+    
+    enabled, rate = odanna_bot.profiler.enabled, odanna_bot.profiler.sample_rate
+    odanna_bot.ADMIN_IDS.add(777)
+    try:
+        command(12345, 'on')
+        assert not replies and odanna_bot.profiler.enabled == enabled
+        command(777, 'on', '0.5')
+        assert odanna_bot.profiler.enabled and odanna_bot.profiler.sample_rate == 0.5
+        assert 'включено' in replies[-1]
+        command(777, 'on', '2')
+        assert odanna_bot.profiler.sample_rate == 0.5
+    finally:
+        odanna_bot.ADMIN_IDS.discard(777)
+        odanna_bot.profiler.enabled, odanna_bot.profiler.sample_rate = enabled, rate
+    print("✅ /profile включает профилирование только для администраторов")
+    
+    print("🎉 Тест профилирования пройден!")
+
+def test_admission_control():
+    """Тест допуска к генерации: лимиты пользователей, приоритеты и объединение сообщений"""
+    print("\n🚦 Тестирование допуска к генерации...")
+    from types import SimpleNamespace
+    
+    async def buckets():
+        admission = AdmissionController(capacity=10, user_rate_per_min=60, user_burst=2)
+        results = [await admission.acquire(1) for _ in range(3)]
+        assert results == [True, True, False] and await admission.acquire(2)
+        await asyncio.sleep(1.1)
+        assert await admission.acquire(1), "Корзина пополняется со временем"
+    
+    asyncio.run(buckets())
+    print("✅ Корзина токенов ограничивает частые сообщения одного пользователя")
+    
+    async def priorities():
+        admission = AdmissionController(capacity=1, queue_limit=2, wait=2, user_rate_per_min=6, user_burst=5)
+        for _ in range(3):
+            admission._take_token(1)  # Пользователь 1 писал часто
+        assert await admission.acquire(3)
+        order = []
+        
+        async def waiter(user_id):
+            async with admission.admit(user_id) as admitted:
+                order.append((user_id, admitted))
+                await asyncio.sleep(0.01)
+        
+        tasks = [asyncio.create_task(waiter(1)), asyncio.create_task(waiter(2))]
+        await asyncio.sleep(0.01)
+        assert admission.waiting == 2
+        assert not await admission.acquire(4), "Переполненная очередь отказывает сразу"
+        admission.release()
+        await asyncio.gather(*tasks)
+        assert order == [(2, True), (1, True)], order
+        assert admission.active == 0 and admission.waiting == 0
+        
+        admission.wait = 0.05
+        assert await admission.acquire(5)
+        assert not await admission.acquire(6), "Ожидание ограничено по времени"
+        admission.release()
+        assert admission.active == 0
+    
+    asyncio.run(priorities())
+    print("✅ Места выдаются по приоритету, очередь и ожидание ограничены")
+    
+    async def throttled_cancel():
+        admission = AdmissionController(capacity=10, rate=1, user_rate_per_min=0)
+        assert await admission.acquire(1)
+        task = asyncio.create_task(admission.acquire(2))  # Ждет общего темпа
+        await asyncio.sleep(0.05)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        assert admission.active == 1, f"Место отмененного запроса не вернулось: {admission.active}"
+    
+    asyncio.run(throttled_cancel())
+    print("✅ Отмена во время ожидания темпа освобождает место")
+    
+    with tempfile.NamedTemporaryFile(suffix='.db', delete=False) as temp_db:
+        db_path = temp_db.name
+    bot = OdannaBot("test", db_path=db_path, ai=AIManager(preload=False))
+    bot.debounce = 0  # Объединение без паузы: только сообщения, пришедшие во время обработки
+    replies = []
+    
+    def update(text):
+        async def reply_text(response, **kwargs):
+            replies.append((text, response))
+        return SimpleNamespace(
+            effective_user=SimpleNamespace(id=12345, username="test", first_name="Гость", last_name=None),
+            message=SimpleNamespace(text=text, reply_text=reply_text)
+        )
+    
+    async def burst():
+        await asyncio.gather(*(bot.handle_message(update(text), None) for text in ("Привет", "Я снова тут", "Ответьте")))
+        await bot.storage.flush()
+        return bot.db.get_chat_history(await bot._get_current_chat(12345), 10)
+    
+    try:
+        history = asyncio.run(burst())
+    finally:
+        bot.inference.shutdown()
+        bot.storage.close()
+        os.unlink(db_path)
+    
+    # Первое сообщение обрабатывается сразу, два следующих пришли во время его обработки
+    assert [text for text, _ in replies] == ["Привет", "Ответьте"], replies
+    assert sorted(row[0] for row in history) == ["Привет", "Я снова тут\nОтветьте"], history
+    print("✅ Сообщения, пришедшие во время обработки, получают один ответ")
+    
+    print("🎉 Тест допуска к генерации пройден!")
+
+def test_message_debounce():
+    """Тест объединения сообщений подряд и отмены устаревших генераций"""
+    print("\n🧵 Тестирование объединения сообщений...")
+    from types import SimpleNamespace
+    from odanna_bot import CancelStopper
+    
+    event = threading.Event()
+    stopper = CancelStopper([event, None])
+    assert not stopper(None, None)
+    stopper = CancelStopper([event])
+    assert not stopper(None, None)
+    event.set()
+    assert stopper(None, None)
+    print("✅ Генерация останавливается, когда все ответы батча отменены")
+    
+    generations = []
+    
+    class SlowAI(AIManager):
+        def generate_odanna_batch(self, requests, on_text=None):
+            cancel = requests[0]['cancel']
+            generations.append((requests[0]['user_message'], cancel))
+            # Генерация идет, пока ее не отменят
+            stopped = cancel.wait(0.3)
+            return [f"Ответ на: {requests[0]['user_message']}" + (" (прервано)" if stopped else "")]
+    
+    with tempfile.NamedTemporaryFile(suffix='.db', delete=False) as temp_db:
+        db_path = temp_db.name
+    ai = SlowAI(preload=False)
+    ai.ready.set()
+    bot = OdannaBot("test", db_path=db_path, ai=ai)
+    bot.debounce = 0.05
+    replies = []
+    
+    def update(text):
+        async def reply_text(response, **kwargs):
+            replies.append(response)
+        return SimpleNamespace(
+            effective_user=SimpleNamespace(id=12345, username="test", first_name="Гость", last_name=None),
+            message=SimpleNamespace(text=text, reply_text=reply_text)
+        )
+    
+    async def scenario():
+        import odanna_bot
+        odanna_bot.STREAM_RESPONSES = False
+        try:
+            # Три сообщения в пределах окна — одна генерация
+            await asyncio.gather(*(bot.handle_message(update(text), None) for text in ("Привет", "Я гость", "Где я?")))
+            assert [text for text, _ in generations] == ["Привет\nЯ гость\nГде я?"], generations
+            
+            # Сообщение во время генерации прерывает ее и входит в новую реплику
+            first = asyncio.create_task(bot.handle_message(update("Расскажите"), None))
+            await asyncio.sleep(0.15)
+            await bot.handle_message(update("о гостинице"), None)
+            await first
+            # Блокировки пользователей не копятся после обработки
+            assert not bot._user_locks and not bot._lock_users and not bot._pending_updates
+        finally:
+            odanna_bot.STREAM_RESPONSES = True
+        await bot.storage.flush()
+        return bot.db.get_chat_history(await bot._get_current_chat(12345), 10)
+    
+    try:
+        history = asyncio.run(scenario())
+    finally:
+        bot.inference.shutdown()
+        bot.storage.close()
+        os.unlink(db_path)
+    
+    assert [text for text, _ in generations[1:]] == ["Расскажите", "Расскажите\nо гостинице"], generations
+    assert generations[1][1].is_set(), "Устаревшая генерация отменена"
+    assert replies == ["Ответ на: Привет\nЯ гость\nГде я?", "Ответ на: Расскажите\nо гостинице"], replies
+    assert sorted(row[0] for row in history) == ["Привет\nЯ гость\nГде я?", "Расскажите\nо гостинице"], history
+    print("✅ Сообщения подряд сохраняются одной репликой, устаревший ответ не отправляется")
+    print("✅ Блокировка пользователя удаляется, когда его сообщения обработаны")
+    
+    print("🎉 Тест объединения сообщений пройден!")
+
 def run_all_tests():
     """Запуск всех тестов"""
     print("🚀 Запуск тестов бота Оданна...\n")
@@ -200,6 +1565,31 @@ def run_all_tests():
         test_character_responses()
         test_memory_system()
         test_empathy_progression()
+        test_inference_executor()
+        test_batch_scheduler()
+        test_kv_cache_pool()
+        test_cached_generation_equivalence()
+        test_context_budget()
+        test_streaming_response()
+        test_database_connections()
+        test_async_database()
+        test_schema_migrations()
+        test_write_behind()
+        test_chat_state_cache()
+        test_current_chat_persistence()
+        test_sharding()
+        test_webhook_server()
+        test_lazy_model_loading()
+        test_model_backends()
+        test_shared_weights()
+        test_response_cache()
+        test_emotion_analyzer()
+        test_repetition_suppression()
+        test_pipeline_stages()
+        test_metrics()
+        test_profiling()
+        test_admission_control()
+        test_message_debounce()
         
         print("\n" + "="*50)
         print("🎉 ВСЕ ТЕСТЫ ПРОЙДЕНЫ УСПЕШНО! 🎉")